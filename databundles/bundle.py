@@ -120,7 +120,7 @@ class Bundle(object):
     
 class DbBundle(Bundle):
 
-    def __init__(self, database_file):
+    def __init__(self, database_file, read_only=False):
         '''Initialize a bundle and all of its sub-components. 
         
         If it does not exist, creates the bundle database and initializes the
@@ -130,12 +130,15 @@ class DbBundle(Bundle):
         
         Order of operations is:
             Create bundle.db if it does not exist
+            
+        If read_only is True, the bundle database and its partition databases 
+        are opened read-only, which is the usual case for bundles in a library. 
         '''
         
         super(DbBundle, self).__init__()
        
         self.database_file = database_file
-        self.database = Database(self, database_file)
+        self.database = Database(self, database_file, read_only=read_only)
         self.db_config = self.config = BundleDbConfig(self.database)
         
         self.partition = None # Set in Library.get() and Library.find() when the user requests a partition. 
@@ -183,6 +186,8 @@ class BuildBundle(Bundle):
         self.bundle_dir = bundle_dir
     
         self._database  = None
+        self._db_config = None
+        self._tasks = None
    
         # For build bundles, always use the FileConfig though self.config
         # to get configuration. 
@@ -351,7 +356,23 @@ class BuildBundle(Bundle):
 
     @property
     def db_config(self):
-        return BundleDbConfig(self.database)
+        '''The database configuration, which is kept for the life of the
+        bundle database so its values are only loaded once'''
+        if self._db_config is None or self._db_config.database is not self.database:
+            self._db_config = BundleDbConfig(self.database)
+            
+        return self._db_config
+
+    @property
+    def tasks(self):
+        '''The TaskGraph for running the build phases, with its journal in the 
+        build directory'''
+        from databundles.tasks import TaskGraph
+        
+        if self._tasks is None:
+            self._tasks = TaskGraph(self)
+            
+        return self._tasks
 
     def update_configuration(self):
 
@@ -408,6 +429,7 @@ class BuildBundle(Bundle):
         '''Remove all files generated by the build process'''
         import os
         self.rm_rf(self.filesystem.build_path())
+        self._tasks = None # The journal was in the build directory
         
         if clean_meta:
             mf = self.filesystem.meta_path(self.META_COMPLETE_MARKER)
@@ -772,7 +794,9 @@ class BundleDbConfig(BundleConfig):
     ''' Retrieves configuration from the database, rather than the .yaml file. '''
 
     database = None
-    dataset = None
+    dataset_id = None
+    _values = None
+    _session = None
 
     def __init__(self, database):
         '''Maintain link between bundle.yam file and Config record in database'''
@@ -783,8 +807,17 @@ class BundleDbConfig(BundleConfig):
             raise Exception("Didn't get database")
         
         self.database = database
-        self.dataset = self.get_dataset()
+        
+        # Only the id is kept. The config lives as long as the database, and
+        # a Dataset object would be expired by commits and detached when the 
+        # session is closed. 
+        self.dataset_id = self.get_dataset().id_
        
+    @property
+    def dataset(self):
+        '''The Dataset record, queried from the current session'''
+        return self.get_dataset()
+
     @property
     def dict(self): #@ReservedAssignment
         '''Return a dict/array object tree for the bundle configuration'''
@@ -795,26 +828,43 @@ class BundleDbConfig(BundleConfig):
         '''Fetch a confiration group and return the contents as an 
         attribute-accessible dict'''
         
+        if group.startswith('_'):
+            raise AttributeError(group)
+        
         return self.group(group)
 
+    def _get_values(self):
+        '''All of the configuration groups, loaded from the database once and
+        cached until the database session changes or invalidate() is called'''
+        
+        session = self.database.session
+        
+        if self._values is None or self._session is not session:
+            self._values = BundleDbConfigDict(self)
+            self._session = session
+            
+        return self._values
+
+    def invalidate(self):
+        '''Discard the cached values, so they are reloaded on the next access. Call
+        after changing the config table without using set_value'''
+        self._values = None
+        self._session = None
 
     def group(self, group):
         '''return a dict for a group of configuration items.'''
         
-        bd = BundleDbConfigDict(self)
-      
-        group = bd.get(group)
+        group = self._get_values().get(group)
         
         if not group:
             return None
         
-        
         return group
 
     def set_value(self, group, key, value):
         from databundles.orm import Config as SAConfig
         
-        if self.group == 'identity':
+        if group == 'identity':
             raise ValueError("Can't set identity group from this interface. Use the dataset")
         
         s = self.database.session
@@ -823,12 +873,19 @@ class BundleDbConfig(BundleConfig):
   
         s.query(SAConfig).filter(SAConfig.group == group,
                                  SAConfig.key == key,
-                                 SAConfig.d_id == self.dataset.id_).delete()
+                                 SAConfig.d_id == self.dataset_id).delete()
         
         o = SAConfig(group=group,
-                     key=key,d_id=self.dataset.id_,value = value)
+                     key=key,d_id=self.dataset_id,value = value)
         s.add(o)
-        s.commit()       
+        s.commit()
+        
+        # Write through to the cache, if it is loaded, rather than reloading
+        if self._values is not None and self._session is s:
+            if group not in self._values:
+                self._values[group] = {}
+                
+            self._values[group][key] = value
 
     def get_value(self, group, key):
         
@@ -11,12 +11,18 @@ from databundles.geo.sfschema import TableShapefile
 from .hdf5 import Hdf5File
 
 class FeatureInserter(object):
-    def __init__(self, partition, table, dest_srs=4326, source_srs=None):
+    '''Buffer rows and write them to a geo partition in batches, each
+    in its own OGR transaction'''
+
+    def __init__(self, partition, table, dest_srs=4326, source_srs=None, transaction_size=None):
 
         self.bundle = partition.bundle
         
         self.sf = TableShapefile(self.bundle, partition.database.path, table, dest_srs, source_srs)
-        
+
+        self.transaction_size = transaction_size if transaction_size else TableShapefile.TRANSACTION_SIZE
+        self.source_srs = source_srs
+        self.cache = []
     
     def __enter__(self):
         return self
@@ -36,10 +42,24 @@ class FeatureInserter(object):
         
         if isinstance(row, RowProxy):
             row  = dict(row)
-        
-        return self.sf.add_feature( row, source_srs)
-    
+
+        # The rows in a batch must share an SRS
+        if source_srs is not None and source_srs != self.source_srs:
+            self.flush()
+            self.source_srs = source_srs
+
+        self.cache.append(row)
+
+        if len(self.cache) >= self.transaction_size:
+            self.flush()
+
+    def flush(self):
+        if self.cache:
+            self.sf.add_features(self.cache, self.source_srs, self.transaction_size)
+            self.cache = []
+
     def close(self):
+        self.flush()
         self.sf.close()
 
 class ValueWriter(object):
@@ -98,11 +118,21 @@ class ValueWriter(object):
         
  
 class ValueInserter(ValueWriter):
-    '''Inserts arrays of values into  database table'''
-    def __init__(self, bundle, table, db, cache_size=50000, text_factory = None, replace=False): 
+    '''Inserts arrays of values into  database table
+    
+    If defer_indexes is True, the table's deferred indexes are built when the
+    inserter is closed. If sort is True, or a list of column names, the rows 
+    are held until the inserter is closed, then inserted in primary key order, 
+    or in the order of the columns. Sorting holds every row of the load in 
+    memory, so it is only for loads that fit. '''
+    def __init__(self, bundle, table, db, cache_size=50000, text_factory = None, replace=False,
+                 defer_indexes=False, sort=False): 
         super(ValueInserter, self).__init__(bundle, db, cache_size=cache_size, text_factory = text_factory)  
    
         self.table = table
+        self.defer_indexes = defer_indexes
+        self.sort = sort
+        self.replace = replace
         
         self.header = [c.name for c in self.table.columns]
    
@@ -121,7 +151,7 @@ class ValueInserter(ValueWriter):
          
             self.cache.append(d)
          
-            if len(self.cache) >= self.cache_size:
+            if len(self.cache) >= self.cache_size and not self.sort:
                 
                 self.connection.execute(self.statement, self.cache)
                 self.cache = []
@@ -140,6 +170,55 @@ class ValueInserter(ValueWriter):
             raise e
 
         return True
+
+    def insert_rows(self, columns, rows):
+        '''Insert a list of row tuples, with values for the named columns, in
+        a single executemany. '''
+
+        if self.sort:
+            self.cache.extend( dict(zip(columns, row)) for row in rows )
+            return True
+
+        sql = "INSERT {}INTO {} ({}) VALUES ({})".format(
+                'OR REPLACE ' if self.replace else '', self.table.name,
+                ','.join(columns), ','.join(['?'] * len(columns)))
+
+        try:
+            if self.cache:
+                self.connection.execute(self.statement, self.cache)
+                self.cache = []
+
+            if rows:
+                self.connection.execute(sql, rows)
+
+        except (KeyboardInterrupt, SystemExit):
+            self.transaction.rollback()
+            self.transaction = None
+            self.cache = []
+            raise
+        except Exception as e:
+            self.bundle.error("Exception during ValueInserter.insert_rows: "+str(e))
+            self.transaction.rollback()
+            self.transaction = None
+            self.cache = []
+            raise e
+
+        return True
+
+    def close(self):
+        
+        if self.sort and self.cache:
+            if self.sort is True:
+                names = [ c.name for c in self.table.primary_key.columns ]
+            else:
+                names = list(self.sort)
+                
+            self.cache.sort(key=lambda d: tuple(d.get(n) for n in names))
+        
+        super(ValueInserter, self).close()
+        
+        if self.defer_indexes:
+            self.db.build_indexes([self.table.name])
    
 class ValueUpdater(ValueWriter):
     '''Updates arrays of values into  database table'''
@@ -177,7 +256,8 @@ class ValueUpdater(ValueWriter):
                 column = self.table.c[col_name[1:]]
                 binds[column.name] = bindparam(col_name)
                 
-                self.statement = self.statement.values(**binds)
+            self.statement = self.statement.values(**binds)
+            self.values = names
        
         try:
             if isinstance(values, dict):
@@ -206,6 +286,10 @@ class ValueUpdater(ValueWriter):
 
         return True    
 class TempFile(object): 
+    
+    # Write buffer size. Builds can have hundreds of tempfiles open at once,
+    # so this is larger than the default, but not too large. 
+    BUFFER_SIZE = 256*1024
            
     def __init__(self, bundle,  db, table, suffix=None, header=None, ignore_first=False):
         self.bundle = bundle
@@ -249,7 +333,7 @@ class TempFile(object):
                 try: os.makedirs(os.path.dirname(self.path))
                 except: pass
 
-            self.file = open(self.path, mode)
+            self.file = open(self.path, mode, self.BUFFER_SIZE)
             self._writer = csv.writer(self.file)
             
             if mode == 'w':
@@ -324,6 +408,7 @@ class TempFile(object):
             self.file.close()
             self.file = None
             self._writer = None
+            self._reader = None
             
             hk = self.table.name+'-'+str(self.suffix)
             if hk in self.db._tempfiles:
@@ -400,6 +485,131 @@ class DbmFile(object):
         #print key,'<-',val
         self._file[str(key)] =  str(val)
     
+class HashIndex(object):
+    '''A translation index from 64 bit row hashes to primary keys, held as 
+    a pair of sorted NumPy arrays and stored in a .npy file beside the 
+    database. Lookups are binary searches, and can be made for a whole array 
+    of hashes at once. '''
+    
+    EXTENSION = '.hashidx.npy'
+    
+    def __init__(self, bundle, db, table=None, suffix=None):
+
+        self.bundle = bundle
+
+        try:
+            table_name = table.name
+        except:
+            table_name = table
+
+        self._path = str(db.path)
+
+        if table_name:
+            self._path += '-'+table_name
+            
+        if suffix:
+            self._path += '-'+suffix
+            
+        self._path += self.EXTENSION
+        
+        self._hashes = None
+        self._keys = None
+        
+    @property
+    def path(self):
+        return self._path
+        
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+        
+    def delete(self):
+        self.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+            
+    def close(self):
+        self._hashes = None
+        self._keys = None
+    
+    def write(self, hashes, keys):
+        '''Write the index for arrays of hashes and their primary keys. The
+        hashes must be unique. '''
+        import numpy as np
+        
+        hashes = np.asarray(hashes, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int64)
+        
+        order = np.argsort(hashes, kind='mergesort')
+        
+        tmp = self._path+'.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.vstack((hashes[order], keys[order])))
+            
+        os.rename(tmp, self._path)
+        
+        self.close()
+        
+    def _load(self):
+        import numpy as np
+        
+        if self._hashes is None:
+            a = np.load(self._path, mmap_mode='r')
+            self._hashes, self._keys = a[0], a[1]
+            
+    def lookup(self, hashes):
+        '''Return an array of the primary keys for an array of hashes. Raises
+        KeyError if any of the hashes are not in the index. '''
+        import numpy as np
+        
+        self._load()
+        
+        hashes = np.asarray(hashes, dtype=np.int64)
+        
+        if len(self._hashes) == 0:
+            if len(hashes):
+                raise KeyError("Hash index {} is empty".format(self._path))
+            return np.array([], dtype=np.int64)
+        
+        idx = np.searchsorted(self._hashes, hashes)
+        idx[idx == len(self._hashes)] = 0
+        
+        missing = self._hashes[idx] != hashes
+        if missing.any():
+            raise KeyError("Hashes not in index {}: {}".format(self._path, hashes[missing][:10]))
+        
+        return self._keys[idx]
+    
+    def __getitem__(self, key):
+        return int(self.lookup([int(key)])[0])
+    
+    def __len__(self):
+        self._load()
+        return len(self._hashes)
+        
+def dedup_hashes(hashes):
+    '''Find the first occurrence of each value in an int64 array of row hashes, 
+    and number the distinct hashes from 1 in the order they first occur.
+    
+    Returns (first, unique, keys): a boolean array that is True at the first
+    occurrence of each hash, and the distinct hashes with their numbers, 
+    suitable for HashIndex.write()'''
+    import numpy as np
+    
+    hashes = np.asarray(hashes, dtype=np.int64)
+    
+    # With return_index, unique() uses a stable sort, so the indexes are of
+    # the first occurrences
+    unique, first_idx = np.unique(hashes, return_index=True)
+    
+    keys = np.empty(len(unique), dtype=np.int64)
+    keys[np.argsort(first_idx, kind='mergesort')] = np.arange(1, len(unique)+1, dtype=np.int64)
+    
+    first = np.zeros(len(hashes), dtype=bool)
+    first[first_idx] = True
+    
+    return first, unique, keys
+
 
 class DatabaseInterface(object):
     
@@ -446,8 +656,11 @@ class Database(DatabaseInterface):
     BUNDLE_DB_NAME = 'bundle'
     PROTO_SQL_FILE = 'support/configuration-sqlite.sql' # Stored in the databundles module. 
     EXTENSION = '.db'
+    MAX_ATTACHED = 10 # Sqlite's default limit on attached databases
+    
+    defer_indexes = False # If True, create_table() leaves out indexes, for bulk loading
 
-    def __init__(self, bundle, base_path, post_create=None):   
+    def __init__(self, bundle, base_path, post_create=None, read_only=False):   
         '''Initialize the a database object
         
         Args:
@@ -458,10 +671,16 @@ class Database(DatabaseInterface):
             
             post_create. A function called during the create() method. has
             signature post_create(database)
+            
+            read_only. If True, open the database read-only, with a memory mapped 
+            file and a page cache sized to the file, for databases that
+            are installed in a library
        
         '''
         self.container = self.bundle = bundle 
         
+        self.read_only = read_only
+        
         self._engine = None
         self._session = None
         self._connection = None
@@ -491,9 +710,11 @@ class Database(DatabaseInterface):
         self._attachments = set()
         
         self._table_meta_cache = {}
+        self._deferred_indexes = {}
         
         self._tempfiles = {}
         self._dbmfiles = {}
+        self._hash_indexes = {}
        
     @property
     def name(self):
@@ -527,10 +748,14 @@ class Database(DatabaseInterface):
         from sqlalchemy import create_engine  
         
         if not self._engine:
-            self._engine = create_engine('sqlite:///'+self.path, echo=False) 
-            #self._engine = create_engine('sqlite://') 
-            from sqlalchemy import event
-            event.listen(self._engine, 'connect', _pragma_on_connect)
+            if self.read_only:
+                self._engine = create_engine('sqlite:///'+self.path, echo=False,
+                                             creator=lambda: _read_only_connect(self.path))
+            else:
+                self._engine = create_engine('sqlite:///'+self.path, echo=False) 
+                #self._engine = create_engine('sqlite://') 
+                from sqlalchemy import event
+                event.listen(self._engine, 'connect', _pragma_on_connect)
              
         return self._engine
 
@@ -550,7 +775,10 @@ class Database(DatabaseInterface):
         '''Return an DB_API connection'''
         import sqlite3
         if not self._dbapi_connection:
-            self._dbapi_connection = sqlite3.connect(self.path)
+            if self.read_only:
+                self._dbapi_connection = _read_only_connect(self.path)
+            else:
+                self._dbapi_connection = sqlite3.connect(self.path)
             
         return self._dbapi_connection
 
@@ -591,6 +819,15 @@ class Database(DatabaseInterface):
             self._dbmfiles[hk] = DbmFile(self.bundle, self, table=table, suffix=suffix)
       
         return self._dbmfiles[hk]
+
+    def hash_index(self,table=None, suffix=None):
+        
+        hk = (table,suffix)
+    
+        if hk not in self._hash_indexes:
+            self._hash_indexes[hk] = HashIndex(self.bundle, self, table=table, suffix=suffix)
+      
+        return self._hash_indexes[hk]
    
 
     @property
@@ -616,6 +853,9 @@ class Database(DatabaseInterface):
         return self.connection
    
     def close(self):
+        if self._deferred_indexes:
+            self.build_indexes()
+        
         if self._session:    
             self._session.close()
             self._session = None
@@ -638,25 +878,32 @@ class Database(DatabaseInterface):
             pass
         
 
-    def inserter(self, table_or_name=None,**kwargs):
+    def inserter(self, table_or_name=None, defer_indexes=None, **kwargs):
+        '''Return a ValueInserter for a table, creating the table if it 
+        doesn't exist. 
+        
+        If defer_indexes is True, or is None and the database's defer_indexes
+        is True, the table's indexes are dropped, or not created, and are built 
+        when the inserter is closed. '''
 
         if table_or_name is None and self.partition.table is not None:
             table_or_name = self.partition.table
       
+        if defer_indexes is None:
+            defer_indexes = self.defer_indexes
+      
         if isinstance(table_or_name, basestring):
             table_name = table_or_name
-            if not table_name in self.inspector.get_table_names():
-                t_meta, table = self.bundle.schema.get_table_meta(table_name) #@UnusedVariable
-                t_meta.create_all(bind=self.engine)
-                
-                if not table_name in self.inspector.get_table_names():
-                    raise Exception("Don't have table "+table_name)
-            table = self.table(table_name)
-            
+            self.create_table(table_name, defer_indexes=defer_indexes)
         else:
-            table = self.table(table_or_name.name)
+            table_name = table_or_name.name
+
+        if defer_indexes:
+            self.defer_table_indexes(table_name)
 
-        return ValueInserter(self.bundle, table , self,**kwargs)
+        table = self.table(table_name)
+
+        return ValueInserter(self.bundle, table , self, defer_indexes=defer_indexes, **kwargs)
         
     def updater(self, table_or_name=None,**kwargs):
       
@@ -701,9 +948,12 @@ class Database(DatabaseInterface):
         self.commit()
 
         
-    def load_tempfile(self, tempfile, table=None):
+    def load_tempfile(self, tempfile, table=None, sort=False):
         '''Load a tempfile into the database. Uses the header line of the temp file
-        for the column names '''
+        for the column names. 
+        
+        If sort is True, the rows are read into memory and loaded in primary 
+        key order. If the table's indexes are deferred, they are built after the load. '''
     
         if not tempfile.exists:
             self.bundle.log("Tempfile already deleted. Skipping")
@@ -742,13 +992,18 @@ class Database(DatabaseInterface):
             
             self.create_table(table_name)
             
+            if sort:
+                rows = sorted(lr, key=self._row_sort_key(table_name, column_names))
+            else:
+                rows = lr
+            
             if False: # For debugging some hash conflicts
-                for row in lr:
+                for row in rows:
                     print 'ROW', row
                     self.dbapi_cursor.execute(ins, row)
                     self.dbapi_connection.commit()
             else:
-                self.dbapi_cursor.executemany(ins, lr)
+                self.dbapi_cursor.executemany(ins, rows)
                 self.dbapi_connection.commit()
                 
         except Exception as e:
@@ -759,6 +1014,24 @@ class Database(DatabaseInterface):
             raise e
             
         self.dbapi_close()
+        
+        self.build_indexes([table_name])
+    
+    def _row_sort_key(self, table_name, column_names):
+        '''Return a sort key for rows of strings, which orders them on the 
+        primary key of the table'''
+        import sqlalchemy
+        
+        fields = []
+        for c in self.table(table_name).primary_key.columns:
+            if c.name in column_names:
+                if isinstance(c.type, sqlalchemy.types.Integer):
+                    conv = lambda v: int(v) if v != '' else None
+                else:
+                    conv = lambda v: v
+                fields.append((column_names.index(c.name), conv))
+
+        return lambda row: tuple( conv(row[i]) for i, conv in fields )
     
     def create(self):
         
@@ -799,7 +1072,7 @@ class Database(DatabaseInterface):
         return self
       
         
-    def create_table(self, table_name):
+    def create_table(self, table_name, defer_indexes=None):
         '''Create a table that is defined in the table table
         
         This method will issue the DDL to create a table that is defined
@@ -808,15 +1081,56 @@ class Database(DatabaseInterface):
         
         Args:
             table_name. The name of the table to create
+            
+            defer_indexes. If True, create the table without its indexes and unique 
+            constraints, which are created by build_indexes(), or when the 
+            database is closed. Defaults to the database's defer_indexes
         
         '''
         
+        if defer_indexes is None:
+            defer_indexes = self.defer_indexes
+        
         if not table_name in self.inspector.get_table_names():
-            t_meta, table = self.bundle.schema.get_table_meta(table_name) #@UnusedVariable
+            t_meta, table = self.bundle.schema.get_table_meta(table_name, #@UnusedVariable
+                                                              use_indexes = not defer_indexes) 
             t_meta.create_all(bind=self.engine)
             
             if not table_name in self.inspector.get_table_names():
                 raise Exception("Don't have table "+table_name)
+            
+            if defer_indexes:
+                self._deferred_indexes.setdefault(table_name, []).extend(
+                                        self.bundle.schema.index_sql(table_name))
+
+    def defer_table_indexes(self, table_name):
+        '''Drop the indexes of an existing table, to be re-created by 
+        build_indexes()'''
+        
+        self._deferred_indexes.setdefault(table_name, []).extend(self.drop_indexes([table_name]))
+        
+    def build_indexes(self, table_names=None):
+        '''Create the indexes that were deferred by create_table() or 
+        defer_table_indexes(), for the named tables, or all tables. Returns 
+        the number of indexes created. '''
+        import time
+        
+        if table_names is None:
+            table_names = self._deferred_indexes.keys()
+        
+        t_start = time.time()
+        n = 0
+        
+        for table_name in table_names:
+            for sql in self._deferred_indexes.pop(table_name, []):
+                self.connection.execute(sql)
+                n += 1
+                
+        if n:
+            self.bundle.log("Built {} indexes for {} in {:.1f}s"
+                            .format(n, ', '.join(table_names), time.time() - t_start))
+            
+        return n
                    
     def table(self, table_name): 
         '''Get table metadata from the database''' 
@@ -990,7 +1304,125 @@ class Database(DatabaseInterface):
         if where is not None:
             q = q + " " + where.format(**f)
     
-        self.connection.execute(q)
+        return self.connection.execute(q)
+
+    def merge_partitions(self, partitions, table=None, clean=True, batch_size=None):
+        '''Copy the rows of a list of partitions into tables in this database. 
+        
+        Each partition is copied to the table with the same name as the
+        partition's table, or all of them to table, as when merging fact
+        table partitions into one table. 
+        
+        The partitions are attached a batch at a time, within Sqlite's limit
+        on attached databases, and each batch is copied in one transaction. The
+        indexes on the destination tables, other than the unique ones, are 
+        dropped for the copy and re-created after it succeeds. If the copy 
+        fails, they are not re-created, and their SQL is logged. 
+        
+        Args:
+            clean. If True, delete the rows of the destination tables first
+            
+            batch_size. Number of partitions to attach at once. Defaults to 
+            as many as the attach limit allows
+            
+        Returns:
+            (rows, bytes), the number of rows copied and the total size of
+            the partition files
+        '''
+        import time
+        
+        if batch_size is None:
+            batch_size = self.MAX_ATTACHED - len(self._attachments)
+            
+        if batch_size < 1:
+            raise ValueError("No room to attach partitions; {} already attached"
+                             .format(len(self._attachments)))
+            
+        pairs = [ (p, table if table else p.table.name) for p in partitions ]
+        
+        table_names = []
+        for p, table_name in pairs:
+            if table_name not in table_names:
+                table_names.append(table_name)
+        
+        for table_name in table_names:
+            self.create_table(table_name)    
+            if clean:
+                self.clean_table(table_name)
+        
+        # Unique indexes are kept, so duplicates fail the batch that has them,
+        # rather than the index creation after all of the copies
+        indexes = self.drop_indexes(table_names, unique=False)
+        
+        synchronous = self.connection.execute("PRAGMA synchronous").scalar()
+        self.connection.execute("PRAGMA synchronous = OFF")
+        
+        t_start = time.time()
+        rows = 0
+        size = 0
+        
+        merged = False
+        try:
+            for i in range(0, len(pairs), batch_size):
+                batch = pairs[i:i+batch_size]
+                
+                names = [ self.attach(p) for p, table_name in batch ]
+                
+                try:
+                    trans = self.connection.begin()
+                    try:
+                        for name, (p, table_name) in zip(names, batch):
+                            r = self.copy_from_attached((p.table.name, table_name), name=name)
+                            rows += r.rowcount
+                            size += os.path.getsize(p.database.path)
+                        trans.commit()
+                    except:
+                        trans.rollback()
+                        raise
+                finally:
+                    for name in names:
+                        self.detach(name)
+
+                t = time.time() - t_start + .001
+                self.bundle.log("Merged {} of {} partitions: {} rows, {:.0f} rows/s, {:.1f} MB/s"
+                                .format(i + len(batch), len(pairs), rows, rows / t,  size / t / 1000000))
+                
+            merged = True
+        finally:
+            self.connection.execute("PRAGMA synchronous = {}".format(synchronous))
+            
+            if not merged:
+                self.bundle.error("Merge failed; not re-creating indexes: "+'; '.join(indexes))
+            
+        self.bundle.log("Re-creating {} indexes".format(len(indexes)))
+        for sql in indexes:
+            self.connection.execute(sql)
+        
+        return rows, size
+
+    def drop_indexes(self, table_names, unique=True):
+        '''Drop the indexes on the tables, except the ones Sqlite creates for
+        primary keys and unique constraints, and, if unique is False, the ones 
+        created with CREATE UNIQUE INDEX. Returns the SQL to re-create them. '''
+        import re
+
+        indexes = []
+        for table_name in table_names:
+            # Read all of the rows first; Sqlite won't drop an index while
+            # the query on sqlite_master is still open
+            rows = self.connection.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", 
+                    table_name).fetchall()
+            
+            for name, sql in rows:
+                
+                if not unique and re.match(r'\s*CREATE\s+UNIQUE\s', sql, re.IGNORECASE):
+                    continue
+                
+                indexes.append(sql)
+                self.connection.execute('DROP INDEX "{}"'.format(name))
+                
+        return indexes
   
 
     def characterize(self, table, column):
@@ -1020,12 +1452,16 @@ class PartitionDb(Database):
         return super(PartitionDb, self).inserter(table_or_name, **kwargs)
         
     
-    def create(self, copy_tables = True):
+    def create(self, copy_tables = True, defer_indexes=False):
         from databundles.orm import Dataset
         from databundles.orm import Table
         
         '''Like the create() for the bundle, but this one also copies
-        the dataset and makes and entry for the partition '''
+        the dataset and makes and entry for the partition. If defer_indexes
+        is True, tables are created without indexes, which are built when the 
+        loading inserter or the database is closed. '''
+        
+        self.defer_indexes = defer_indexes
         
         if super(PartitionDb, self).create():
         
@@ -1071,12 +1507,12 @@ class GeoDb(PartitionDb):
 
         self.add_post_create(load_spatialite)
    
-    def inserter(self,  table = None, dest_srs=4326, source_srs=None):
+    def inserter(self,  table = None, dest_srs=4326, source_srs=None, transaction_size=None):
         
         if table is None and self.partition.identity.table:
             table = self.partition.identity.table
         
-        return FeatureInserter(self.partition,  table, dest_srs, source_srs)
+        return FeatureInserter(self.partition,  table, dest_srs, source_srs, transaction_size)
    
 class HdfDb(Hdf5File, DatabaseInterface):
     
@@ -1108,9 +1544,10 @@ class HdfDb(Hdf5File, DatabaseInterface):
 class BundleDb(Database):
     
     '''Represents the database version of a bundle that is installed in a library'''
-    def __init__(self, path):
+    def __init__(self, path, read_only=False):
+
+        super(BundleDb, self).__init__(None, path, read_only=read_only)  
 
-        super(BundleDb, self).__init__(None, path)  
 def _pragma_on_connect(dbapi_con, con_record):
     '''ISSUE some Sqlite pragmas when the connection is created'''
 
@@ -1121,6 +1558,45 @@ def _pragma_on_connect(dbapi_con, con_record):
     dbapi_con.execute('PRAGMA journal_mode = OFF')
     #dbapi_con.execute('PRAGMA synchronous = OFF')
 
+# Limits for read-only databases. The memory map is shared between processes
+# through the OS page cache, so the private page cache can be much smaller 
+# than the 500,000 pages used for writing. 
+READ_ONLY_MMAP_MAX = 2*1024*1024*1024
+READ_ONLY_CACHE_MIN = 2*1024*1024
+READ_ONLY_CACHE_MAX = 64*1024*1024
+
+def _read_only_connect(path):
+    '''Return a read-only DB-API connection for an existing database file. Opens
+    with a mode=ro&immutable=1 URI where the sqlite3 module supports it, and sets 
+    mmap_size and cache_size from the size of the file. '''
+    import sqlite3
+    import urllib
+    
+    if not os.path.exists(path):
+        raise IOError("Can't open non-existent database read-only: {}".format(path))
+    
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro&immutable=1'.format(urllib.pathname2url(os.path.abspath(path))),
+                               uri=True, check_same_thread=False)
+    except TypeError:
+        # The Python 2 sqlite3 module doesn't accept URIs; query_only
+        # still protects the file. 
+        conn = sqlite3.connect(path, check_same_thread=False)
+        
+    _pragma_on_read_only_connect(conn, os.path.getsize(path))
+    
+    return conn
+
+def _pragma_on_read_only_connect(dbapi_con, size):
+    '''ISSUE Sqlite pragmas for a read-only connection to a database of size bytes'''
+    
+    cache_kb = min(max(size/10, READ_ONLY_CACHE_MIN), READ_ONLY_CACHE_MAX) / 1024
+    
+    dbapi_con.execute('PRAGMA query_only = ON')
+    dbapi_con.execute('PRAGMA temp_store = MEMORY')
+    dbapi_con.execute('PRAGMA mmap_size = {}'.format(min(size, READ_ONLY_MMAP_MAX)))
+    dbapi_con.execute('PRAGMA cache_size = -{}'.format(cache_kb)) # Negative means KiB
+
     
 def insert_or_ignore(table, columns):
     return  ("""INSERT OR IGNORE INTO {table} ({columns}) VALUES ({values})"""
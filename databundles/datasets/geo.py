@@ -6,8 +6,13 @@ Revised BSD License, included in this distribution as LICENSE.txt
 
 import yaml
 import sys
+from collections import OrderedDict
 from databundles.dbexceptions import ConfigurationError
 
+# Place masks, keyed by (code, scale, srid), most recently used last.
+MASK_CACHE_SIZE = 32
+_masks = OrderedDict()
+
 
 class US:
     """ Access to US states, regions, etc. """
@@ -201,15 +206,85 @@ class Place(object):
 
         return AnalysisArea(**d)
 
-    def mask(self, ar=None, nodata=0, scale=10):
+    def mask(self, ar=None, nodata=0, scale=10, cache=None):
+        """Return an numpy array with a hard mask to exclude areas outside of the place
+        
+        Masks are kept in memory, for the most recently used MASK_CACHE_SIZE places and 
+        scales. If cache is an HdfPartition, or other Hdf5File, masks are also stored
+        there, uncompressed, and memory mapped when they are loaded, so only the parts 
+        of a mask that are used are read. The mask arrays are shared, so they are 
+        read-only. 
+        """
+        import numpy.ma as ma
+        
+        key = (self.code, scale, self.row['srid'])
+        
+        mask = _masks.pop(key, None)
+        
+        if mask is None and cache is not None:
+            mask = self._load_mask(cache, key)
+        
+        if mask is None:
+            mask, aa = self._rasterize_mask(scale)
+            mask.flags.writeable = False
+            
+            if cache is not None:
+                self._save_mask(cache, key, mask, aa)
+                
+        _masks[key] = mask
+        
+        while len(_masks) > MASK_CACHE_SIZE:
+            _masks.popitem(last=False)
+        
+        if ar is not None:
+            # A copy, since the masked array can change its mask
+            return ma.masked_array(ar, mask=mask.copy(), nodata=nodata, hard=True)  
+        else:
+            return mask
+
+    @staticmethod
+    def _mask_name(key):
+        return 'mask-{}-{}-{}'.format(*key)
+
+    def _save_mask(self, cache, key, mask, aa):
+        import numpy as np
+        
+        hdf = getattr(cache, 'database', cache)
+        
+        # Uncompressed, so it can be memory mapped
+        hdf.put_geo(self._mask_name(key), mask.view(np.uint8), aa, compression=None)
+        hdf.flush()
+        
+    def _load_mask(self, cache, key):
+        import numpy as np
+        
+        hdf = getattr(cache, 'database', cache)
+        
+        name = self._mask_name(key)
+        
+        if not hdf.exists() or name not in hdf.list_geo():
+            return None
+        
+        a, aa = hdf.get_geo_mmap(name) #@UnusedVariable
+        
+        if len(a.shape) != 2 or a.dtype != np.uint8:
+            return None # Stored in an earlier format, so rasterize it again
+        
+        if not isinstance(a, np.ndarray):
+            a = a[:] # Not stored contiguously, so it couldn't be mapped
+        
+        mask = a.view(bool)
+        mask.flags.writeable = False
+        
+        return mask
+
+    def _rasterize_mask(self, scale):
+        """Rasterize the place into a new mask. Returns the mask and the analysis area"""
         import ogr
         import gdal
         from osgeo.gdalconst import GDT_Byte
         import numpy as np  
-        import numpy.ma as ma
 
-
-        """Return an numpy array with a hard mask to exclude areas outside of the place"""
         srs_in = ogr.osr.SpatialReference()
         srs_in.ImportFromEPSG(self.row['srid'])
         
@@ -234,9 +309,5 @@ class Place(object):
         
         mask = np.logical_not(np.flipud(np.array(image.GetRasterBand(1).ReadAsArray(), dtype=bool)))
         
-        if ar is not None:
-            return ma.masked_array(ar, mask=mask, nodata=nodata, hard=True)  
-        else:
-            return mask
+        return mask, aa
 
-    
\ No newline at end of file
@@ -138,6 +138,56 @@ class RegexLineView(petl.util.RowContainer):
         except Exception as e:
             raise Exception(e)
 
+def fromfixed(source, reader=None, table=None, convert=False, **kwargs):
+    """
+    Extract data from a fixed width file, using a FixedWidthReader, or the
+    reader for a Table, to unpack the lines. This is faster than fromregex() for
+    fixed width files.
+    E.g.::
+
+        >>> table1 = fromfixed('geo.txt', table=bundle.schema.table('geofile'))
+
+    or, with an explicit layout:
+
+        >>> from databundles.fixedwidth import FixedWidthReader
+        >>> table1 = fromfixed('example1.txt',
+        ...    reader=FixedWidthReader(['a','b','c'],[4,2,7]))
+
+    If convert is True, the fields are converted to the python types of
+    the reader.
+
+    """
+    source = petl.io._read_source_from_arg(source)
+    return FixedWidthView(source, reader=reader, table=table, convert=convert, **kwargs)
+
+class FixedWidthView(petl.util.RowContainer):
+
+    def __init__(self, source, reader=None, table=None, convert=False, **kwargs):
+        self.source = source
+        self.convert = convert
+        self.kwargs = kwargs
+
+        if reader is None and table is not None:
+            reader = table.get_fixed_reader()
+
+        if reader is None:
+            raise Exception('fromfixed() requires a reader or a table')
+
+        self.reader = reader
+
+    def __iter__(self):
+
+        yield tuple(self.reader.header)
+
+        with self.source.open_() as f:
+            for row in self.reader.rows(f, convert=self.convert):
+                yield row
+
+    def cachetag(self):
+        try:
+            return hash((self.source.checksum(), self.reader.unpack_str, self.convert))
+        except Exception as e:
+            raise Exception(e)
 
 
   
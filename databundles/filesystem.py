@@ -15,6 +15,7 @@ import urllib
 import databundles.util
 import logging
 from databundles.identity import Identity
+from contextlib import contextmanager
 
 logger = databundles.util.get_logger(__name__)
 #logger.setLevel(logging.DEBUG) 
@@ -44,6 +45,247 @@ zipfile.ZipFile.testzip = testzip
 class DownloadFailedError(Exception):
     pass
 
+def test_zip_file(f):
+    '''Return True if f is a readable zip file with good CRCs'''
+    if not os.path.exists(f):
+        raise Exception("Test zip file does not exist: {} ".format(f))
+    
+    try:
+        with zipfile.ZipFile(f) as zf:
+            return zf.testzip() is None
+    except zipfile.BadZipfile:
+        return False
+
+class DownloadManager(object):
+    '''Download files into a BundleFilesystem's downloads cache with a pool of
+    threads, so that files can be prefetched while earlier ones are being 
+    processed. 
+    
+    :param filesystem: The BundleFilesystem that owns the downloads cache
+    :param threads: The number of download threads
+    :param max_bytes: The limit on the total size of downloads in progress, based
+    on the Content-Length header. A single file larger than the limit is allowed
+    when nothing else is downloading. 
+    :param retries: The number of attempts for each url
+    :param backoff: Seconds to wait before the first retry. The wait doubles for 
+    each later retry. 
+    '''
+    
+    BACKOFF = 2.0
+    
+    def __init__(self, filesystem, threads=4, max_bytes=1024*1024*1024, retries=3, backoff=BACKOFF):
+        import threading
+        import Queue
+        
+        self.filesystem = filesystem
+        self.n_threads = threads
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._pid = None
+        
+        self._lock = threading.RLock() # For the cache and the request dict
+        self._bytes_cond = threading.Condition()
+        self._in_flight = 0
+        
+        self._requests = {}
+
+    def _start(self):
+        import threading
+        
+        # Threads don't survive a fork, so a child process, from the
+        # multiprocessing pool in the census bundles, needs its own. 
+        if self._pid == os.getpid():
+            return
+        
+        self._pid = os.getpid()
+        self._threads = []
+        
+        for i in range(self.n_threads):
+            t = threading.Thread(target=self._run, name="download-{}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        
+        while True:
+            url = self._queue.get()
+            
+            if url is None:
+                self._queue.task_done()
+                break
+            
+            req = self._requests[url]
+            
+            try:
+                req['path'] = self.fetch(url, req['test_f'])
+            except Exception as e:
+                req['error'] = e
+            finally:
+                req['event'].set()
+                self._queue.task_done()
+
+    def has(self, url):
+        '''Return True if the url has been submitted with prefetch()'''
+        with self._lock:
+            return url in self._requests and self._pid == os.getpid()
+
+    def prefetch(self, urls, test_f=None):
+        '''Queue urls for downloading in the background.'''
+        import threading
+        
+        if isinstance(urls, basestring):
+            urls = [urls]
+        
+        with self._lock:
+            self._start()
+            
+            for url in urls:
+                if url in self._requests:
+                    continue
+                
+                self._requests[url] = {'event': threading.Event(), 'test_f': test_f, 
+                                       'path': None, 'error': None}
+                self._queue.put(url)
+
+    def get(self, url, test_f=None):
+        '''Return the path to the downloaded file for a url, waiting for it
+        if it is still downloading. Urls that weren't prefetched are queued first. '''
+
+        self.prefetch([url], test_f)
+        
+        req = self._requests[url]
+        
+        # Wait with a timeout so KeyboardInterrupt is delivered. 
+        while not req['event'].wait(1):
+            pass
+
+        with self._lock:
+            del self._requests[url]
+        
+        if req['error']:
+            raise req['error']
+        
+        return req['path']
+
+    def close(self):
+        '''Stop the download threads after the queued downloads are done'''
+        
+        if self._pid != os.getpid():
+            return
+        
+        for t in self._threads:
+            self._queue.put(None)
+            
+        for t in self._threads:
+            t.join()
+            
+        self._threads = []
+        self._pid = None
+
+    def _acquire_bytes(self, size):
+        with self._bytes_cond:
+            while self._in_flight > 0 and self._in_flight + size > self.max_bytes:
+                self._bytes_cond.wait()
+            self._in_flight += size
+            
+    def _release_bytes(self, size):
+        with self._bytes_cond:
+            self._in_flight -= size
+            self._bytes_cond.notify_all()
+
+    def fetch(self, url, test_f=None):
+        '''Download a url into the downloads cache, in the calling thread, and
+        return the path to the cached file. The file is downloaded to a temporary file
+        and tested before it is moved into the cache. '''
+        import tempfile
+        import urllib2
+        import time
+        
+        fs = self.filesystem
+        
+        if test_f == 'zip':
+            test_f = test_zip_file
+        
+        with self._lock:
+            cache = fs.get_cache('downloads')
+        
+        file_path = fs.download_rel_path(url)
+        
+        excpt = None
+        for attempts in range(self.retries):
+
+            if attempts > 0:
+                fs.bundle.error("Retrying download of {}".format(url))
+                time.sleep(self.backoff * 2**(attempts-1))
+
+            download_path = None
+            excpt = None
+            
+            try:
+                with self._lock:
+                    cached_file = cache.get(file_path)
+                
+                if cached_file:
+                    if test_f and not test_f(cached_file):
+                        with self._lock:
+                            cache.remove(file_path, True)
+                        raise DownloadFailedError("Cached Download didn't pass test function "+url)
+                    
+                    return cached_file
+
+                fs.bundle.log("Downloading "+url)
+                fs.bundle.log("  --> "+file_path)
+                
+                resp = urllib2.urlopen(url)
+                
+                if resp.code != 200:
+                    raise DownloadFailedError("Failed to download {}: code: {}".format(url, resp.code))
+                
+                size = int(resp.headers.get('content-length') or 0)
+                
+                self._acquire_bytes(size)
+                try:
+                    fd, download_path = tempfile.mkstemp(suffix='.download')
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in iter(lambda: resp.read(1024*1024), b''):
+                            f.write(chunk)
+                finally:
+                    self._release_bytes(size)
+                    resp.close()
+                    
+                if size and os.path.getsize(download_path) != size:
+                    raise urllib.ContentTooShortError("Got {} bytes, expected {} "
+                                .format(os.path.getsize(download_path), size), None)
+                
+                if test_f and not test_f(download_path):
+                    raise DownloadFailedError("Download didn't pass test function "+url)
+                
+                with self._lock:
+                    return cache.put(download_path, file_path)
+
+            except DownloadFailedError as e:
+                fs.bundle.error("Failed:  "+str(e))
+                excpt = e
+            except urllib.ContentTooShortError as e:
+                fs.bundle.error("Content too short for "+url)
+                excpt = e
+            except IOError as e:
+                fs.bundle.error("Failed to download "+url+" to "+file_path+" : "+str(e))
+                excpt = e
+            except zipfile.BadZipfile as e:
+                fs.bundle.error("Got an invalid zip file for "+url)
+                excpt = e
+            finally:
+                if download_path and os.path.exists(download_path):
+                    os.remove(download_path)
+                    
+        raise excpt
+
 class FileRef(File):
     '''Extends the File orm class with awareness of the filsystem'''
     def __init__(self, bundle):
@@ -200,6 +442,8 @@ class BundleFilesystem(Filesystem):
         super(BundleFilesystem, self).__init__(bundle.config._run_config)
         
         self.bundle = bundle
+        self._download_manager = None
+        
         if root_directory:
             self.root_directory = root_directory
         else:
@@ -310,18 +554,53 @@ class BundleFilesystem(Filesystem):
  
 
 
-    def _get_unzip_file(self, cache, tmpdir, zf, path, name):
-        '''Look for a member of a zip file in the cache, and if it doesn next exist, 
-        extract and cache it. '''
+    # Memo of zip file md5s, keyed by (path, size, mtime), so the extract 
+    # cache key doesn't require re-reading large archives on every call. 
+    _zip_hashes = {}
+
+    # Archives with more than this many bytes of uncompressed members to 
+    # extract are extracted with multiple threads. 
+    PARALLEL_EXTRACT_SIZE = 50*1024*1024
+    EXTRACT_THREADS = 4
+
+    def zip_hash(self, path):
+        '''Return the md5 of a zip file, memoized on the file's size and 
+        modification time'''
+        
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        
+        try:
+            return self._zip_hashes[key]
+        except KeyError:
+            h = self.file_hash(path)
+            self._zip_hashes[key] = h
+            return h
+
+    def _unzip_rel_path(self, path, name):
+        '''Return the path in the extracts cache for a member of a zip file. The 
+        path is keyed on the md5 of the zip file, so a new version of an archive with 
+        the same name gets new extracts'''
+        
+        return (self.zip_hash(path)+'/'+
+                urllib.quote_plus(name.replace('/','_'),'_') )
+
+    @staticmethod
+    def _clean_member_name(name):
         name = name.replace('..','')
         
         if name[0] == '/':
             name = name[1:]
+            
+        return name
+
+    def _get_unzip_file(self, cache, tmpdir, zf, path, name):
+        '''Look for a member of a zip file in the cache, and if it doesn next exist, 
+        extract and cache it. '''
+        name = self._clean_member_name(name)
         
-        base = os.path.basename(path)
-        
-        rel_path = (urllib.quote_plus(base.replace('/','_'),'_')+'/'+
-                    urllib.quote_plus(name.replace('/','_'),'_') )
+        rel_path = self._unzip_rel_path(path, name)
      
         # Check if it is already in the cache
         cached_file = cache.get(rel_path)
@@ -335,7 +614,11 @@ class BundleFilesystem(Filesystem):
         if not os.path.exists(tmp_abs_path):
             zf.extract(name,tmpdir )
             
-        # Store it in the cache.           
+        return self._put_unzip_file(cache, tmp_abs_path, rel_path)
+        
+    def _put_unzip_file(self, cache, tmp_abs_path, rel_path):
+        '''Store an extracted file in the extracts cache'''
+        
         abs_path = cache.put(tmp_abs_path, rel_path)
         
         # There have been zip files that have been truncated, but I don't know
@@ -346,6 +629,25 @@ class BundleFilesystem(Filesystem):
 
         return abs_path
  
+    def _extract_parallel(self, path, tmpdir, names):
+        '''Extract a set of zip members into tmpdir, using a thread per
+        member, up to EXTRACT_THREADS. Each thread opens its own ZipFile, since
+        they can't share a file handle. '''
+        from multiprocessing.pool import ThreadPool
+        
+        def extract(name):
+            with zipfile.ZipFile(path) as zf:
+                zf.extract(name, tmpdir)
+            return name
+        
+        pool = ThreadPool(min(self.EXTRACT_THREADS, len(names)))
+        
+        try:
+            pool.map(extract, names)
+        finally:
+            pool.close()
+            pool.join()
+ 
     def unzip(self,path, regex=None):
         '''Context manager to extract a single file from a zip archive, and delete
         it when finished'''
@@ -376,8 +678,10 @@ class BundleFilesystem(Filesystem):
         return None
 
     def unzip_dir(self,path,   regex=None):
-        '''Context manager to extract a single file from a zip archive, and delete
-        it when finished'''
+        '''Generator that extracts all of the files in a zip archive that match the 
+        regex, or all files if no regex is given, and yields the path to each in the 
+        extracts cache. Files that are already in the cache aren't extracted again, and
+        large archives are extracted with multiple threads. '''
         import tempfile, uuid
         
         cache = self.get_cache('extracts')
@@ -386,11 +690,32 @@ class BundleFilesystem(Filesystem):
    
         try:
             with zipfile.ZipFile(path) as zf:
-                abs_path = None 
-                for name in zf.namelist():
-                    abs_path = self._get_unzip_file(cache, tmpdir, zf, path, name)  
-                    if regex and regex.match(name) or not regex:
-                        yield abs_path
+                
+                members = [ (self._clean_member_name(zi.filename), zi.file_size) 
+                            for zi in zf.infolist() 
+                            if not zi.filename.endswith('/') and 
+                                ( not regex or regex.match(zi.filename))]
+                
+                cached = {}
+                missing = []
+                for name, size in members:
+                    rel_path = self._unzip_rel_path(path, name)
+                    cached_file = cache.get(rel_path)
+                    if cached_file:
+                        cached[name] = cached_file
+                    else:
+                        missing.append((name, size))
+
+                if ( len(missing) > 1 and 
+                     sum([ size for _, size in missing ]) > self.PARALLEL_EXTRACT_SIZE):
+                    self._extract_parallel(path, tmpdir, [ name for name, _ in missing ])
+                
+                for name, _ in members:
+                    if name in cached:
+                        yield cached[name]
+                    else:
+                        yield self._get_unzip_file(cache, tmpdir, zf, path, name)  
+                        
         except:
             self.bundle.error("File '{}' can't be unzipped".format(path))
             raise
@@ -398,7 +723,53 @@ class BundleFilesystem(Filesystem):
             self.rm_rf(tmpdir)
             
         return
+
+    @contextmanager
+    def unzip_stream(self, path, regex=None):
+        '''Context manager that returns a file-like object that reads a member of 
+        a zip archive directly, without extracting it. If regex is None, the first
+        member is used. The object does not support seek(), so use unzip() when 
+        random access is required. '''
+        from databundles.dbexceptions import FilesystemError
+
+        with zipfile.ZipFile(path) as zf:
+            if regex is None:
+                name = iter(zf.namelist()).next()
+            else:
+                for name in zf.namelist():
+                    if regex.match(name):
+                        break
+                else:
+                    raise FilesystemError("No member of {} matches {}".format(path, regex.pattern))
+            
+            f = zf.open(name)
+            try:
+                yield f
+            finally:
+                f.close()
         
+    def download_rel_path(self, url):
+        '''Return the path in the downloads cache for a url'''
+        import urlparse
+        
+        parsed = urlparse.urlparse(url)
+        return parsed.netloc+'/'+urllib.quote_plus(parsed.path.replace('/','_'),'_')
+
+    @property
+    def download_manager(self):
+        '''A DownloadManager for prefetching files into the downloads cache'''
+        
+        if self._download_manager is None:
+            self._download_manager = DownloadManager(self)
+            
+        return self._download_manager
+    
+    def prefetch(self, urls, test_f=None):
+        '''Start downloading urls in background threads. Later calls to download() for
+        these urls will wait for the background download to finish, rather than start
+        a new one. '''
+        self.download_manager.prefetch(urls, test_f)
+
     def download(self,url, test_f=None):
         '''Context manager to download a file, return it for us, 
         and delete it when done.
@@ -408,28 +779,20 @@ class BundleFilesystem(Filesystem):
         '''
 
         import tempfile
-        import urlparse
         import urllib2
+        import time
+      
+        if self._download_manager is not None and self._download_manager.has(url):
+            return self._download_manager.get(url)
       
         cache = self.get_cache('downloads')
-        parsed = urlparse.urlparse(url)
-        file_path = parsed.netloc+'/'+urllib.quote_plus(parsed.path.replace('/','_'),'_')
+        file_path = self.download_rel_path(url)
 
         # We download to a temp file, then move it into place when 
         # done. This allows the code to detect and correct partial
         # downloads. 
         download_path = os.path.join(tempfile.gettempdir(),file_path+".download")
           
-        def test_zip_file(f):
-            if not os.path.exists(f):
-                raise Exception("Test zip file does not exist: {} ".format(f))
-            
-            try:
-                with zipfile.ZipFile(f) as zf:
-                    return zf.testzip() is None
-            except zipfile.BadZipfile:
-                return False
-          
         if test_f == 'zip':
             test_f = test_zip_file
           
@@ -437,6 +800,7 @@ class BundleFilesystem(Filesystem):
    
             if attempts > 0:
                 self.bundle.error("Retrying download of {}".format(url))
+                time.sleep(DownloadManager.BACKOFF * 2**(attempts-1))
 
             cached_file = None
             out_file = None
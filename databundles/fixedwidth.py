@@ -0,0 +1,217 @@
+"""Reading fixed width files, such as the Census geo files, using a single
+precompiled layout. Lines can be unpacked one at a time with a precompiled
+struct.Struct, or in large blocks with numpy.frombuffer and a structured dtype.
+
+Copyright (c) 2013 Clarinova. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import struct
+
+def _make_converter(type_):
+    '''Return a function that strips a field and converts it to type_. Blank
+    fields become None, and fields that fail conversion are returned stripped,
+    as with transform.coerce_int'''
+
+    if type_ is None or type_ is str:
+        return lambda v: v.strip()
+
+    def convert(v):
+        v = v.strip()
+        if not v:
+            return None
+        try:
+            return type_(v)
+        except ValueError:
+            return v
+
+    return convert
+
+class FixedWidthReader(object):
+    '''Parse lines of a fixed width file into tuples of fields.
+
+    :param header: The names of the fields
+    :param widths: The width, in characters, of each field
+    :param types: Optional list of python types, one per field, used by convert()
+    '''
+
+    def __init__(self, header, widths, types=None):
+
+        if len(header) != len(widths):
+            raise ValueError("Header and widths must be the same length")
+
+        self.header = list(header)
+        self.widths = list(widths)
+        self.length = sum(self.widths)
+        self.unpack_str = ''.join(["{}s".format(w) for w in self.widths])
+        self.struct = struct.Struct(self.unpack_str)
+
+        if types is None:
+            types = [None] * len(self.widths)
+
+        self.types = list(types)
+        self._converters = [ _make_converter(t) for t in self.types ]
+
+    @classmethod
+    def from_table(cls, table):
+        '''Construct a reader from the width values of the columns of
+        an orm.Table. Columns without a width are skipped. '''
+        header = []
+        widths = []
+        types = []
+        for col in table.columns:
+            if not col.width:
+                continue
+
+            header.append(col.name)
+            widths.append(col.width)
+
+            try:
+                types.append(col.python_type)
+            except KeyError:
+                types.append(None)
+
+        return cls(header, widths, types)
+
+    @property
+    def regex(self):
+        '''The regular expression string equivalent to the layout'''
+        return ''.join(["(.{{{}}})".format(w) for w in self.widths])
+
+    def dtype(self, record_length=None):
+        '''Return a numpy structured dtype for the layout. If record_length is
+        larger than the layout length, the extra bytes, usually the line ending,
+        are skipped. '''
+        import numpy as np
+
+        offsets = []
+        pos = 0
+        for w in self.widths:
+            offsets.append(pos)
+            pos += w
+
+        return np.dtype({'names': [ str(h) for h in self.header],
+                         'formats': ['S{}'.format(w) for w in self.widths],
+                         'offsets': offsets,
+                         'itemsize': record_length if record_length else self.length})
+
+    def unpack(self, line):
+        '''Split a line into a tuple of strings. The line ending is ignored.
+        Raises struct.error if the rest of the line is not the length of
+        the layout. '''
+
+        if len(line.rstrip('\r\n')) != self.length:
+            raise struct.error("Line length doesn't match layout: {} != {}"
+                               .format(len(line.rstrip('\r\n')), self.length))
+
+        return self.struct.unpack_from(line)
+
+    def convert(self, row):
+        '''Convert a tuple of field strings to the types of the fields'''
+        return tuple([ c(v) for c, v in zip(self._converters, row) ])
+
+    def rows(self, f, convert=True):
+        '''Generate tuples from each of the lines in a file object'''
+
+        unpack = self.unpack
+
+        if convert:
+            converters = self._converters
+            for line in f:
+                yield tuple([ c(v) for c, v in zip(converters, unpack(line)) ])
+        else:
+            for line in f:
+                yield unpack(line)
+
+    def blocks(self, f, block_rows=50000):
+        '''Generate numpy record arrays of up to block_rows lines from a file
+        object opened in binary mode.
+
+        The file is read in large chunks and mapped with numpy.frombuffer. If
+        a chunk has lines that are not all the same length, it is split
+        into lines and unpacked one at a time. Raises struct.error if a line
+        is not the length of the layout. '''
+        import numpy as np
+
+        first = f.readline()
+
+        if not first:
+            return
+
+        eol = len(first) - len(first.rstrip('\r\n'))
+        record_length = len(first) - eol
+
+        if record_length != self.length:
+            raise struct.error("Line length doesn't match layout: {} != {}"
+                               .format(record_length, self.length))
+
+        record_length += eol
+        dtype = self.dtype(record_length)
+        data = first + f.read(record_length * (block_rows - 1))
+
+        while data:
+
+            aligned = False
+            if len(data) % record_length == 0:
+                a = np.frombuffer(data, dtype=np.uint8).reshape(-1, record_length)
+                if eol == 0 or (a[:,-1] == ord('\n')).all():
+                    aligned = True
+
+            if aligned:
+                yield np.frombuffer(data, dtype=dtype)
+            else:
+                if not data.endswith('\n'):
+                    data += f.readline()
+
+                lines = data.splitlines()
+
+                yield np.array([ self.unpack(l) for l in lines ], dtype=self.dtype())
+
+            data = f.read(record_length * block_rows)
+
+    def convert_block(self, a):
+        '''Return a dict of lists of the field values of a block, converted
+        in the same way as convert(), but a column at a time. '''
+        import numpy as np
+
+        o = {}
+        for name, type_, c in zip(self.header, self.types, self._converters):
+            raw = a[str(name)]
+
+            if type_ is None or type_ is str:
+                o[name] = np.char.strip(raw).tolist()
+                continue
+
+            if type_ not in (int, long, float):
+                o[name] = [ c(v) for v in raw.tolist() ]
+                continue
+
+            col = np.char.strip(raw)
+            blank = col == ''
+
+            try:
+                values = np.where(blank, '0', col).astype(float if type_ is float else np.int64).tolist()
+            except ValueError:
+                # Some fields aren't numbers, so convert them one at a time
+                o[name] = [ c(v) for v in raw.tolist() ]
+                continue
+
+            if blank.any():
+                values = [ None if b else v for v, b in zip(values, blank.tolist()) ]
+
+            o[name] = values
+
+        return o
+
+    def insert(self, f, inserter, block_rows=50000):
+        '''Read a file in blocks and write the converted rows to a
+        ValueInserter, one executemany per block. Returns the number of rows
+        inserted. '''
+
+        n = 0
+        for block in self.blocks(f, block_rows):
+            cols = self.convert_block(block)
+            inserter.insert_rows(self.header, zip(*[ cols[name] for name in self.header ]))
+            n += len(block)
+
+        return n
@@ -13,6 +13,64 @@ from databundles.dbexceptions import ConfigurationError
 
 #ogr.UseExceptions()
 
+class Tile(object):
+    """A rectangular window on an analysis area array. The core, [y0:y1, x0:x1], is
+    the part of the array the tile is responsible for, and the halo window, 
+    [hy0:hy1, hx0:hx1], extends it by the halo width, clipped to the array. 
+    """
+    
+    def __init__(self, aa, y0, y1, x0, x1, halo=0):
+        self.y0, self.y1, self.x0, self.x1 = y0, y1, x0, x1
+        self.halo = halo
+        
+        self.hy0 = max(y0 - halo, 0)
+        self.hy1 = min(y1 + halo, int(aa.size_y))
+        self.hx0 = max(x0 - halo, 0)
+        self.hx1 = min(x1 + halo, int(aa.size_x))
+        
+        # Extents of the core in the analysis area's coordinates. Row 0 of the
+        # array is the southern edge. 
+        self.eastmin = aa.eastmin + x0 * aa.scale
+        self.eastmax = aa.eastmin + x1 * aa.scale
+        self.northmin = aa.northmin + y0 * aa.scale
+        self.northmax = aa.northmin + y1 * aa.scale
+        
+    @property
+    def core(self):
+        """Slices for the core of the tile in the full array"""
+        return (slice(self.y0, self.y1), slice(self.x0, self.x1))
+
+    @property
+    def shape(self):
+        return (self.y1 - self.y0, self.x1 - self.x0)
+
+    def __repr__(self):
+        return "<tile: y {}:{} x {}:{} halo {}>".format(self.y0, self.y1, self.x0, self.x1, self.halo)
+
+# The kernel and points for apply_kernel() workers, which inherit them
+# when the pool is forked. 
+_kernel_job = None
+
+def _kernel_tile(tile):
+    """Apply the kernel for the points near a tile, and return the core of the result"""
+    kernel, x, y = _kernel_job
+    return tile, _apply_kernel_tile(kernel, x, y, tile)
+
+def _apply_kernel_tile(kernel, x, y, tile):
+    
+    o = kernel.offset
+    
+    # A buffer with room for the full kernel around every point that can reach 
+    # the core of the tile
+    buf = zeros((tile.y1 - tile.y0 + 2*o, tile.x1 - tile.x0 + 2*o))
+    
+    near = (x >= tile.x0 - o) & (x < tile.x1 + o) & (y >= tile.y0 - o) & (y < tile.y1 + o)
+    
+    for px, py in zip(x[near] - tile.x0 + o, y[near] - tile.y0 + o):
+        kernel.apply_add(buf, Point(int(px), int(py)))
+            
+    return buf[o:o + tile.y1 - tile.y0, o:o + tile.x1 - tile.x0]
+
 
 def get_analysis_area(library, **kwargs):
     """Return an analysis area by name or GEOID
@@ -124,11 +182,72 @@ class AnalysisArea(object):
                             .format(self._scale,self.size_x, self.size_y, self.size_x * self.size_y / 1000000))
 
 
-    def new_array(self, dtype=float, mask=None):
+    def new_array(self, dtype=float, mask=None, path=None):
+        """Return a new array for the area. If path is specified, the array is a 
+        numpy memmap backed by that file, which can be larger than MAX_CELLS. 
+        Process large arrays a tile at a time, with tiles()"""
+
+        if path is not None:
+            return memmap(path, dtype=dtype, mode='w+', shape=(int(self.size_y), int(self.size_x)))
 
         self._too_big()
 
         return zeros((self.size_y, self.size_x), dtype = dtype)
+
+    def tiles(self, tile_size=2048, halo=0):
+        """Iterate over Tiles that cover the area, in rows from the southern edge. 
+        
+        :param tile_size: The width and height of the core of each tile, in cells
+        :param halo: Number of cells to extend each tile on all sides, for operations that 
+            need the values of neighboring cells.
+        """
+        size_x, size_y = int(self.size_x), int(self.size_y)
+        
+        for y0 in range(0, size_y, tile_size):
+            for x0 in range(0, size_x, tile_size):
+                yield Tile(self, y0, min(y0 + tile_size, size_y), 
+                                 x0, min(x0 + tile_size, size_x), halo)
+
+    def apply_kernel(self, a, kernel, x, y, tile_size=2048, processes=None):
+        """Add a kernel, centered at each of a set of points, onto an array, a tile at a time. 
+        
+        Each tile is computed in its own buffer, from the points within the kernel's
+        width of the tile, so the tiles are independent, and can be computed in a
+        process pool. Memory use is bounded by the tile size, so a can be a memmap 
+        from new_array(path=...), or another array-like, such as an HDF5 dataset. 
+        
+        :param a: The array to add to 
+        :param kernel: A Kernel
+        :param x: Numpy array of the x cell coordinates of the points
+        :param y: Numpy array of the y cell coordinates of the points
+        :param processes: If greater than 1, compute tiles in a pool of that many processes
+        """
+        global _kernel_job
+        
+        x = asarray(x)
+        y = asarray(y)
+        
+        tiles = list(self.tiles(tile_size, halo=kernel.offset))
+        
+        if processes and processes > 1 and len(tiles) > 1:
+            from multiprocessing import Pool
+            
+            _kernel_job = (kernel, x, y)
+            try:
+                pool = Pool(processes=processes)
+                try:
+                    for tile, core in pool.imap_unordered(_kernel_tile, tiles):
+                        a[tile.core] += core
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _kernel_job = None
+        else:
+            for tile in tiles:
+                a[tile.core] += _apply_kernel_tile(kernel, x, y, tile)
+        
+        return a
             
 
     @property
@@ -147,7 +266,7 @@ class AnalysisArea(object):
         self.size_x = (self.eastmax - self.eastmin) / self._scale
         self.size_y = (self.northmax - self.northmin) / self._scale        
 
-        self._too_big()
+        # Large areas are allowed, but in-memory arrays for them are not. See new_array()
         
     def new_masked_array(self, dtype=float, nodata=0, mask=None):
         
@@ -318,7 +437,7 @@ class AnalysisArea(object):
         from osgeo import gdal
     
         if driver in ('GTiff'):
-            options = [ 'COMPRESS=LZW' ]
+            options = [ 'COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER' ]
         else:
             options =  []
     
@@ -351,19 +470,28 @@ class AnalysisArea(object):
 
     
     
-    def write_geotiff(self, file_,  a, data_type=DEFAULT_D_TYPE, nodata=0):
+    def write_geotiff(self, file_,  a, data_type=DEFAULT_D_TYPE, nodata=0, tile_size=2048):
         """
         Args:
             file_: Name of file to write to
             aa: Analysis Area object
-            a: numpy array
+            a: numpy array, or a memmap or other array-like
+            tile_size: The array is written in blocks of this many cells on a side, 
+                so only one block has to be in memory. 
         """
         
 
         out = self.get_geotiff( file_,  data_type=data_type)
      
-        out.GetRasterBand(1).SetNoDataValue(nodata)
-        out.GetRasterBand(1).WriteArray(flipud(a))
+        band = out.GetRasterBand(1)
+        band.SetNoDataValue(nodata)
+        
+        # The rows of the image run from north to south, so the array is flipped,
+        # and the tile at rows y0:y1 goes at image rows size_y-y1:size_y-y0
+        for tile in self.tiles(tile_size):
+            band.WriteArray(flipud(asarray(a[tile.core])), tile.x0, int(self.size_y) - tile.y1)
+      
+        band.FlushCache()
       
         return file_
 
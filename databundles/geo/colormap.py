@@ -166,19 +166,166 @@ def exponential_breaks(n, avg):
 
     return o
 
+def stddev_breaks(n, avg, sd, min, max):
+    """Produce breaks one standard deviation apart, centered on the average,
+    and clipped to the range of the values"""
+    import numpy as np
+
+    breaks = [ avg + (i - n/2.0)*sd for i in range(n+1) ]
+
+    return np.clip(breaks, min, max).tolist()
+
+class ArrayHistogram(object):
+    """A histogram of the non-zero values of an array, built from blocks of
+    the array, so the whole array never has to be in memory. Also keeps the
+    exact count, min, max, mean and standard deviation.
+
+    The range of the bins starts as the range of the first block, and is
+    doubled, merging pairs of bins, whenever a block has values outside it.
+    """
+
+    # Number of cells read at once by add_array()
+    BLOCK_SIZE = 2**22
+
+    def __init__(self, bins=1024):
+        import numpy as np
+
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.origin = None
+        self.width = None
+
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self._m2 = 0.0 # Sum of squared deviations from the mean
+
+    @property
+    def edges(self):
+        import numpy as np
+        return self.origin + np.arange(self.bins + 1) * self.width
+
+    @property
+    def std(self):
+        import math
+        return math.sqrt(self._m2 / self.count) if self.count else 0.0
+
+    def add(self, block):
+        """Add the values of an array or masked array. Zero, masked and
+        non-finite values are skipped. """
+        import numpy as np
+        import numpy.ma as ma
+
+        if ma.isMaskedArray(block):
+            v = block.compressed()
+        else:
+            v = np.asarray(block).ravel()
+
+        v = v[(v != 0) & np.isfinite(v)].astype(float)
+
+        n = len(v)
+
+        if n == 0:
+            return
+
+        lo, hi = v.min(), v.max()
+
+        if self.origin is None:
+            self.origin = lo
+            self.width = (hi - lo) / self.bins if hi > lo else abs(lo) / self.bins
+
+        while lo < self.origin or hi > self.origin + self.bins * self.width:
+
+            pad = np.zeros(self.bins, dtype=self.counts.dtype)
+
+            if lo < self.origin:
+                self.counts = np.concatenate((pad, self.counts))
+                self.origin -= self.bins * self.width
+            else:
+                self.counts = np.concatenate((self.counts, pad))
+
+            self.counts = self.counts.reshape((self.bins, 2)).sum(axis=1)
+            self.width *= 2
+
+        idx = np.clip(((v - self.origin) / self.width).astype(int), 0, self.bins - 1)
+        self.counts += np.bincount(idx, minlength=self.bins)
+
+        # Merge the block's mean and squared deviations into the running ones
+        mean = v.mean()
+        m2 = np.square(v - mean).sum()
+        total = self.count + n
+        delta = mean - self.mean
+
+        self.mean += delta * n / total
+        self._m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    def add_array(self, a, block_size=None):
+        """Add an array in blocks of rows. Works with anything that can be
+        sliced on its first axis: ndarrays, memmaps and HDF5 datasets. Other
+        iterables, such as a generator of tiles, are taken to yield blocks. """
+
+        if not hasattr(a, 'shape'):
+            for block in a:
+                self.add(block)
+            return self
+
+        if len(a.shape) < 2:
+            self.add(a[:])
+            return self
+
+        row_size = 1
+        for d in a.shape[1:]:
+            row_size *= d
+
+        rows = max(1, (block_size if block_size else self.BLOCK_SIZE) / row_size)
+
+        for i in range(0, a.shape[0], rows):
+            self.add(a[i:i+rows])
+
+        return self
+
+    def jenks_breaks(self, n):
+        """Jenks natural breaks, computed from the bins. The first and last 
+        breaks are clamped to the minimum and maximum, since the edges of the
+        bins can extend past them. """
+        from databundles.geo.util import histogram_jenks_breaks
+        
+        breaks = list(histogram_jenks_breaks(self.counts, self.edges, n))
+        
+        if breaks:
+            breaks[0] = max(breaks[0], self.min)
+            breaks[-1] = min(breaks[-1], self.max)
+            
+        return breaks
+
 def write_colormap(file_name, a, map, break_scheme='even', min_val=None, max_val =None, ave_val=None):
-    """Write a QGIS colormap file"""
+    """Write a QGIS colormap file.
+
+    All of the break schemes are computed from a single pass over the array
+    that builds an ArrayHistogram, so a can be a memmap, an HDF5 dataset or an
+    iterable of tiles, as well as an array. It can also be an ArrayHistogram
+    that has already been built. """
     import numpy as np
-    import numpy.ma as ma
     import math
 
+    if isinstance(a, ArrayHistogram):
+        hist = a
+    else:
+        hist = ArrayHistogram().add_array(a)
+
+    if hist.count == 0:
+        raise ValueError("Can't write a colormap for an array with no non-zero values")
+
     header ="# QGIS Generated Color Map Export File\nINTERPOLATION:DISCRETE\n"
-    
-    masked = ma.masked_equal(a, 0)
-    
-    min_ = np.min(masked) if not min_val else min_val
-    max_ = np.max(a) if not max_val else max_val
-    ave_ = masked.mean() if not ave_val else ave_val
+
+    min_ = hist.min if not min_val else min_val
+    max_ = hist.max if not max_val else max_val
+    ave_ = hist.mean if not ave_val else ave_val
 
     if break_scheme == 'even':
         max_ = max_ * 1.001 # Be sure to get all values
@@ -186,8 +333,7 @@ def write_colormap(file_name, a, map, break_scheme='even', min_val=None, max_val
         delta = range*.001
         r = np.linspace(min_-delta, max_+delta, num=map['n_colors']+1)
     elif break_scheme == 'jenks':
-        from databundles.geo import jenks_breaks
-        r = jenks_breaks(a, map['n_colors'])
+        r = hist.jenks_breaks(map['n_colors'])
     elif break_scheme == 'geometric':
         r = geometric_breaks(map['n_colors'], min_, max_)
     elif break_scheme == 'logistic':
@@ -195,7 +341,7 @@ def write_colormap(file_name, a, map, break_scheme='even', min_val=None, max_val
     elif break_scheme == 'exponential':
         r = exponential_breaks(map['n_colors'], ave_)
     elif break_scheme == 'stddev':
-        sd = np.std(a)
+        r = stddev_breaks(map['n_colors'], ave_, hist.std, min_, max_)
     else:
         raise Exception("Unknown break scheme: {}".format(break_scheme))
     
@@ -220,7 +366,7 @@ def write_colormap(file_name, a, map, break_scheme='even', min_val=None, max_val
     
         # Prevents 'holes' where the value is higher than the max_val
         if max_val:
-            v = np.max(a)
+            v = hist.max
             f.write(','.join([str(v),str(last_me['R']), str(last_me['G']), str(last_me['B']), str(int(alpha)), last_me['letter'] ]))
             f.write('\n')
     
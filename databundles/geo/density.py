@@ -41,6 +41,85 @@ class DensityImage(object):
       
         self.a[y,x] += v
 
+    def add_counts(self, x_in, y_in, v=1):
+        """Add counts for arrays of coordinates, binned the same way as add_count(). 
+        
+        :param x_in: Array of x coordinates
+        :param y_in: Array of y coordinates
+        :param v: A value to add for each point, or an array of weights, one per point
+        :rtype: The number of points that fell inside the image. Points with
+            missing coordinates or weights, or outside the image, are skipped. 
+        """
+        
+        x_in = asarray(x_in, dtype=float)
+        y_in = asarray(y_in, dtype=float)
+        
+        ok = isfinite(x_in) & isfinite(y_in)
+        
+        if not isscalar(v):
+            v = asarray(v, dtype=float)
+            ok &= isfinite(v)
+        
+        # astype() truncates toward zero, like int()
+        x = (x_in[ok]*self.bin_scale).astype(int64) - self.x_offset_c - 1
+        y = (y_in[ok]*self.bin_scale).astype(int64) - self.y_offset_c 
+        
+        y_size, x_size = self.a.shape
+        
+        inside = (x >= 0) & (x < x_size) & (y >= 0) & (y < y_size)
+        
+        cells = y[inside] * x_size + x[inside]
+        
+        if len(cells) == 0:
+            return 0
+        
+        # Sum the points in each cell they touch, so the cost depends on the
+        # number of points, rather than the size of the image
+        touched, idx = unique(cells, return_inverse=True)
+        
+        if isscalar(v):
+            counts = bincount(idx) * v
+        else:
+            counts = bincount(idx, weights=v[ok][inside])
+        
+        self.a.flat[touched] += counts.astype(self.a.dtype)
+        
+        return len(cells)
+
+    def add_query(self, source, query, *args, **kwargs):
+        """Add counts for the rows of a query, streamed a chunk at a time. The first two
+        columns of the query are the x and y coordinates, and the optional third is 
+        a weight. 
+        
+        :param source: A partition, or database, to run the query on
+        :param query: SQL query. Additional positional args are query parameters
+        :param chunk_size: Number of rows to bin at a time. Defaults to 100,000. 
+        :rtype: The number of points that fell inside the image
+        """
+        
+        chunk_size = kwargs.get('chunk_size', 100000)
+        
+        db = getattr(source, 'database', source)
+        
+        r = db.connection.execute(query, *args)
+        
+        n = 0
+        while True:
+            rows = r.fetchmany(chunk_size)
+            
+            if not rows:
+                break
+            
+            # None becomes nan, which add_counts() skips. 
+            chunk = array(rows, dtype=float)
+            
+            if chunk.shape[1] > 2:
+                n += self.add_counts(chunk[:,0], chunk[:,1], chunk[:,2])
+            else:
+                n += self.add_counts(chunk[:,0], chunk[:,1])
+                
+        return n
+
     def mask(self):
         masked = ma.masked_equal(self.a,0)  
         self.a = masked
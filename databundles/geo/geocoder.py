@@ -7,30 +7,64 @@ class Geocoder(object):
 
     def __init__(self, library, **kwargs):
         """
-        
+
         Args:
             geocoder_ds: addresses dataset dependency name. Defaults to 'addresses'
+            index: Path to a GeocoderIndex. If it exists, the streets,
+                intersections and addresses are looked up in the index, and
+                the dependency is only resolved for queries the index can't
+                answer. When it is, it is checked against the database the
+                index was built from. If True, use the index next to the 
+                dependency's database, building it if it doesn't exist or
+                is out of date.
         """
-        
+        import os
         from databundles.geo.address import Parser
-        from databundles.dbexceptions import ConfigurationError
-        
+
         self.parser = Parser()
-        
-        addressesds = kwargs.get('geocoder_ds', 'geocoder')
-        
-        
-        try:
-            self.addresses = library.dep(addressesds).partition
-         
-        except ConfigurationError:
-            raise ConfigurationError(("MISSING DEPENDENCY: To get addresses or codes, the configuration  "+
-                "must specify a dependency with a set named '{0}', in build.dependencies.{0}"+
-                "See https://github.com/clarinova/databundles/wiki/Error-Messages#geogeocodergeocoder__init__")
-                .format(addressesds))
 
-        self.by_scode, self.by_name = self.jur_codes()
-         
+        self.library = library
+        self.addresses_ds = kwargs.get('geocoder_ds', 'geocoder')
+        self._addresses = None
+        self.index = None
+
+        index = kwargs.get('index', None)
+
+        if index is True:
+            self.index = GeocoderIndex.load(self.addresses, GeocoderIndex.default_path(self.addresses))
+        elif index and os.path.exists(index):
+            self.index = GeocoderIndex(index)
+        else:
+            self.index = None
+
+        if self.index:
+            self.by_scode, self.by_name = self.index.by_scode, self.index.by_name
+        else:
+            self.by_scode, self.by_name = self.jur_codes()
+
+    @property
+    def addresses(self):
+        """The geocoder partition, resolved from the library on first use"""
+        from databundles.dbexceptions import ConfigurationError
+
+        if self._addresses is None:
+            try:
+                self._addresses = self.library.dep(self.addresses_ds).partition
+
+            except ConfigurationError:
+                raise ConfigurationError(("MISSING DEPENDENCY: To get addresses or codes, the configuration  "+
+                    "must specify a dependency with a set named '{0}', in build.dependencies.{0}"+
+                    "See https://github.com/clarinova/databundles/wiki/Error-Messages#geogeocodergeocoder__init__")
+                    .format(self.addresses_ds))
+
+            if self.index and not self.index.is_current(self._addresses):
+                path = self._addresses.database.path
+                self._addresses = None
+                raise ValueError("Geocoder index {} was not built from the current {}; rebuild it"
+                                 .format(self.index.path, path))
+
+        return self._addresses
+
     def get_srs(self):
         return self.addresses.get_srs() 
         
@@ -76,10 +110,13 @@ class Geocoder(object):
 
         # Try to get a specific address within the segment. 
         if ps.number <= segment['hnumber'] and ps.number >= segment['lnumber']:
-           
-            address = self.addresses.query("""
-                SELECT * FROM addresses WHERE segment_source_id = ? 
-                ORDER BY ABS(number - ?) ASC LIMIT 1""", segment['segment_source_id'], ps.number).first()
+
+            if self.index:
+                address = self.index.nearest_address(segment['segment_source_id'], ps.number)
+            else:
+                address = self.addresses.query("""
+                    SELECT * FROM addresses WHERE segment_source_id = ?
+                    ORDER BY ABS(number - ?) ASC LIMIT 1""", segment['segment_source_id'], ps.number).first()
               
             if address:
                 if  abs( int(address['number']) - ps.number) < (segment['hnumber'] - segment['lnumber']) :
@@ -186,11 +223,16 @@ class Geocoder(object):
 
         max_score = 0
         winner = None
-       
-        for s in self.addresses.query(q, street):
-            
+
+        if self.index:
+            segments = self.index.segments(street)
+        else:
+            segments = self.addresses.query(q, street)
+
+        for s in segments:
+
             s= dict(s)
-             
+
             s['score']  = score = self.rank_street(s, number,  direction, street_type, in_city)
 
             if in_city == s['rcity']:
@@ -226,11 +268,14 @@ class Geocoder(object):
         if not ps1 or not ps2:
             return None
 
-        q = """SELECT  * FROM nodes 
+        q = """SELECT  * FROM nodes
         WHERE street_1 = ? and street_2 = ?
         OR street_1 = ? and street_2 = ? LIMIT 1""";
-      
-        intr = self.addresses.query(q, ps1.street_name, ps2.street_name, ps2.street_name, ps1.street_name).first()
+
+        if self.index:
+            intr = self.index.intersection(ps1.street_name, ps2.street_name)
+        else:
+            intr = self.addresses.query(q, ps1.street_name, ps2.street_name, ps2.street_name, ps1.street_name).first()
 
         if intr:
             winner = dict(intr)
@@ -240,18 +285,7 @@ class Geocoder(object):
             return None
         
     def jur_codes(self):
-        
-        by_scode = {}
-        by_name = {}
-        for place in self.addresses.query("SELECT code, scode, name FROM places WHERE type = 'city'"):
-            by_scode[place['scode']] = (place['code'], place['name'])
-            by_name[place['name']] = place['code']
-          
-        by_name['County Unincorporated'] = 'SndSDO'
-        by_name['Unincorporated'] = 'SndSDO'
-        by_name['NONE'] = 'SndSDO'
-          
-        return by_scode, by_name
+        return _jur_codes(self.addresses)
        
     def rank_street(self, row, number, direction, street_type, city ):
         """ Create a score for a street segment based on how well it matches the input"""
@@ -289,7 +323,6 @@ class Geocoder(object):
         for quality, query, args in queries:
 
             candidates = {}
-            print query, args
             for ar in self.addresses.query(query, *args  ):
                 ar = dict(ar)
                 
@@ -322,10 +355,15 @@ class Geocoder(object):
     def get_street_addresses(self, segment_source_id):
         
         addresses = {}
-        
-        for ar in self.addresses.query("SELECT * FROM addresses WHERE segment_source_id = ?", segment_source_id):
+
+        if self.index:
+            rows = self.index.addresses(segment_source_id)
+        else:
+            rows = self.addresses.query("SELECT * FROM addresses WHERE segment_source_id = ?", segment_source_id)
+
+        for ar in rows:
             addresses[ar['number']] = dict(ar)
-            
+
         return addresses
 
       
@@ -348,6 +386,9 @@ class Geocoder(object):
         city = city.title()
         street = street.title()
 
+        if self.index:
+            return self._semiblock_candidates(number, street, street_type, city)
+
         queries = [
             ("""SELECT 10 as gcquality, * FROM segments WHERE  (lcity = ?  or rcity = ? )
             AND street = ? AND street_type = ? AND ? BETWEEN lnumber AND hnumber
@@ -382,7 +423,42 @@ class Geocoder(object):
                 return candidates
 
         return {}
-    
+
+    def _semiblock_candidates(self, number, street, street_type, city):
+        """The same searches as the queries in geocode_semiblock(), on the
+        street's segments from the index"""
+
+        segments = [ s for s in self.index.segments(street)
+                     if s['lnumber'] is not None and s['hnumber'] is not None
+                     and s['lnumber'] <= number <= s['hnumber'] ]
+
+        segments.sort(key=lambda s: s['hnumber'])
+
+        in_city = lambda s: s['lcity'] == city or s['rcity'] == city
+        has_addresses = lambda s: s['has_addresses'] == 1
+
+        searches = [
+            (10, lambda s: in_city(s) and s['street_type'] == street_type and has_addresses(s)),
+            (9, lambda s: in_city(s) and has_addresses(s)),
+            (8, in_city),
+            (7, has_addresses)
+        ]
+
+        for quality, f in searches:
+
+            candidates = {}
+
+            for s in segments:
+                if f(s):
+                    ar = dict(s)
+                    ar['gcquality'] = quality
+                    candidates.setdefault(ar['segment_source_id'],[]).append(ar)
+
+            if len(candidates) > 0:
+                return candidates
+
+        return {}
+
     def _address_geocode_parts(self, number, street, street_type, city, state):
 
         if not number:
@@ -411,4 +487,312 @@ class Geocoder(object):
         return self._do_search(queries, number, street, street_type, city, state)
 
 
-    
\ No newline at end of file
+    
+def _jur_codes(partition):
+    '''Return dicts of the city codes and names, by scode, and the city codes by name'''
+
+    by_scode = {}
+    by_name = {}
+    for place in partition.query("SELECT code, scode, name FROM places WHERE type = 'city'"):
+        by_scode[place['scode']] = (place['code'], place['name'])
+        by_name[place['name']] = place['code']
+
+    by_name['County Unincorporated'] = 'SndSDO'
+    by_name['Unincorporated'] = 'SndSDO'
+    by_name['NONE'] = 'SndSDO'
+
+    return by_scode, by_name
+
+def _encode(v):
+    return v.encode('utf-8') if isinstance(v, unicode) else str(v)
+
+class _IndexTable(object):
+    '''The rows of a table, stored as one .npy file per column, sorted on one
+    or more columns, and memory mapped when loaded. Null values are recorded
+    in a separate mask file for the columns that have them. '''
+
+    def __init__(self, path, name, columns, nulls):
+        import numpy as np
+
+        self.name = name
+        self.columns = columns
+
+        self.arrays = { c: np.load(self._file(path, name, c), mmap_mode='r') for c in columns }
+        self.nulls = { c: np.load(self._file(path, name, c+'.null'), mmap_mode='r') for c in nulls }
+        self.text = set( c for c in columns if self.arrays[c].dtype.kind == 'S' )
+
+    @staticmethod
+    def _file(path, name, column):
+        import os
+        return os.path.join(path, '{}.{}.npy'.format(name, column))
+
+    @classmethod
+    def write(cls, path, name, columns, rows, sort_cols):
+        '''Write a list of row tuples, in the order of columns, sorted on 
+        sort_cols. Returns the names of the columns that have nulls. '''
+        import numpy as np
+
+        arrays = {}
+        nulls = {}
+
+        for i, c in enumerate(columns):
+            arrays[c], nulls[c] = cls._column_array([ row[i] for row in rows ])
+
+        order = np.arange(len(rows))
+        for c in reversed(sort_cols):
+            order = order[np.argsort(arrays[c][order], kind='mergesort')]
+
+        for c in columns:
+            np.save(cls._file(path, name, c), arrays[c][order])
+
+            if nulls[c] is not None:
+                np.save(cls._file(path, name, c+'.null'), nulls[c][order])
+
+        return [ c for c in columns if nulls[c] is not None ]
+
+    @staticmethod
+    def _column_array(values):
+        '''Convert a column to an integer, float or fixed width string array,
+        and a mask of the nulls, or None if there are none'''
+        import numpy as np
+
+        null = np.array([ v is None for v in values ], dtype=bool)
+        present = [ v for v in values if v is not None ]
+
+        if all( isinstance(v, (int, long)) for v in present ):
+            a = np.array([ 0 if v is None else v for v in values ], dtype=np.int64)
+        elif all( isinstance(v, (int, long, float)) for v in present ):
+            a = np.array([ np.nan if v is None else v for v in values ], dtype=float)
+        else:
+            a = np.array([ '' if v is None else _encode(v) for v in values ], dtype='S')
+
+        return a, (null if null.any() else None)
+
+    def __len__(self):
+        return len(self.arrays[self.columns[0]]) if self.columns else 0
+
+    def row(self, i):
+        d = {}
+        for c in self.columns:
+            if c in self.nulls and self.nulls[c][i]:
+                d[c] = None
+            elif c in self.text:
+                d[c] = self.arrays[c][i].decode('utf-8')
+            else:
+                d[c] = self.arrays[c][i].item()
+
+        return d
+
+    def rows(self, start, end):
+        return [ self.row(i) for i in range(start, end) ]
+
+    def find(self, column, value, start=0, end=None):
+        '''Return the range of rows, between start and end, where the sorted 
+        column is equal to value'''
+        import numpy as np
+
+        if end is None:
+            end = len(self)
+
+        if value is None or end <= start:
+            return start, start
+
+        a = self.arrays[column][start:end]
+
+        if column in self.text:
+            value = _encode(value)
+
+            # A longer value would be truncated to the width of the column
+            if len(value) > a.dtype.itemsize:
+                return start, start
+
+        lo = np.searchsorted(a, value, side='left')
+        hi = np.searchsorted(a, value, side='right')
+
+        return start + int(lo), start + int(hi)
+
+class GeocoderIndex(object):
+    '''A prebuilt index of a geocoder dataset: the normalized street names,
+    the street segments with their house number ranges, the intersection
+    nodes and the addresses of each segment. 
+
+    The index is a directory of .npy files, which are memory mapped when it
+    is loaded, so loading is fast, and processes that load the same index
+    share its pages. The meta file records the name, size and modification
+    time of the database it was built from, so a stale index can be 
+    detected. '''
+
+    VERSION = 1
+    META_FILE = 'meta.json'
+
+    # Tables, and the columns each is sorted on. The sorts are stable, so
+    # rows that tie are in the same order as in the database.
+    TABLES = (('segments', ('street',)),
+              ('nodes', ('street_1', 'street_2')),
+              ('addresses', ('segment_source_id',)))
+
+    def __init__(self, path):
+        import os
+        import json
+        import numpy as np
+
+        self.path = path
+
+        with open(os.path.join(path, self.META_FILE)) as f:
+            meta = json.load(f)
+
+        if meta.get('version') != self.VERSION:
+            raise ValueError("Geocoder index {} has version {}, expected {}"
+                             .format(path, meta.get('version'), self.VERSION))
+
+        self.tables = { name: _IndexTable(path, name, t['columns'], t['nulls'])
+                        for name, t in meta['tables'].items() }
+
+        self.street_names = np.load(os.path.join(path, 'streets.npy'), mmap_mode='r')
+        self.street_offsets = np.load(os.path.join(path, 'streets.offsets.npy'), mmap_mode='r')
+
+        self.by_scode = { scode: (code, name) for scode, code, name in meta['by_scode'] }
+        self.by_name = meta['by_name']
+        
+        self.source = meta.get('source')
+
+    @staticmethod
+    def default_path(partition):
+        '''The path of the index for a geocoder partition, next to its database'''
+        import os
+        return os.path.splitext(partition.database.path)[0] + '.gcindex'
+
+    @staticmethod
+    def source_of(partition):
+        '''Identify the database of a geocoder partition: its name, and the
+        size and modification time of its file'''
+        import os
+        
+        stat = os.stat(partition.database.path)
+        
+        return {'vname': partition.identity.vname, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def is_current(self, partition):
+        '''Return True if the index was built from the partition's database,
+        as it is now'''
+        return self.source == self.source_of(partition)
+
+    @classmethod
+    def load(cls, partition, path):
+        '''Return the index at path, building it first if it doesn't exist,
+        is from an earlier version, or is out of date for the partition'''
+        import os
+        
+        if os.path.exists(path):
+            try:
+                index = cls(path)
+                
+                if index.is_current(partition):
+                    return index
+            except (IOError, ValueError, KeyError):
+                pass # An earlier version, or an incomplete index
+            
+        return cls.build(partition, path)
+
+    @classmethod
+    def build(cls, partition, path):
+        '''Build the index from the places, segments, nodes and addresses
+        tables of a geocoder partition, and return it'''
+        import os
+        import json
+        import numpy as np
+        from databundles.util import rm_rf
+
+        tmp = path + '.tmp'
+
+        if os.path.exists(tmp):
+            rm_rf(tmp)
+
+        os.makedirs(tmp)
+
+        meta = {'version': cls.VERSION, 'tables': {}}
+
+        for name, sort_cols in cls.TABLES:
+            r = partition.query("SELECT * FROM {}".format(name))
+            columns = [ str(c) for c in r.keys() ]
+            rows = [ tuple(row) for row in r ]
+
+            nulls = _IndexTable.write(tmp, name, columns, rows, sort_cols)
+
+            meta['tables'][name] = {'columns': columns, 'nulls': nulls}
+
+        # The distinct street names, with the range of segments for each
+        streets = np.load(_IndexTable._file(tmp, 'segments', 'street'))
+        names, starts = np.unique(streets, return_index=True)
+
+        np.save(os.path.join(tmp, 'streets.npy'), names)
+        np.save(os.path.join(tmp, 'streets.offsets.npy'), np.append(starts, len(streets)).astype(np.int64))
+
+        by_scode, by_name = _jur_codes(partition)
+        meta['by_scode'] = [ (scode, code, name) for scode, (code, name) in by_scode.items() ]
+        meta['by_name'] = by_name
+        
+        # After reading, in case opening the database wrote to it
+        meta['source'] = cls.source_of(partition)
+
+        with open(os.path.join(tmp, cls.META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.exists(path):
+            rm_rf(path)
+
+        os.rename(tmp, path)
+
+        return cls(path)
+
+    def segments(self, street):
+        '''Return the segments of a street, as dicts'''
+        import numpy as np
+
+        if street is None:
+            return []
+
+        street = _encode(street)
+        names = self.street_names
+
+        if len(names) == 0 or len(street) > names.dtype.itemsize:
+            return []
+
+        k = int(np.searchsorted(names, street))
+
+        if k == len(names) or names[k] != street:
+            return []
+
+        return self.tables['segments'].rows(int(self.street_offsets[k]), int(self.street_offsets[k+1]))
+
+    def intersection(self, street1, street2):
+        '''Return the node where two streets intersect, or None'''
+        nodes = self.tables['nodes']
+
+        for s1, s2 in ((street1, street2), (street2, street1)):
+            start, end = nodes.find('street_1', s1)
+            start, end = nodes.find('street_2', s2, start, end)
+
+            if end > start:
+                return nodes.row(start)
+
+        return None
+
+    def addresses(self, segment_source_id):
+        '''Return the addresses of a segment, as dicts'''
+        t = self.tables['addresses']
+        return t.rows(*t.find('segment_source_id', segment_source_id))
+
+    def nearest_address(self, segment_source_id, number):
+        '''Return the address of a segment with the house number closest to
+        number, or None'''
+
+        def distance(address):
+            try:
+                return abs(float(address['number']) - number)
+            except (TypeError, ValueError):
+                return float('inf')
+
+        addresses = self.addresses(segment_source_id)
+
+        return min(addresses, key=distance) if addresses else None
@@ -22,6 +22,9 @@ ogr_type_map = {
 
 class TableShapefile(object):
 
+    # Number of features written in each OGR transaction by add_features()
+    TRANSACTION_SIZE = 10000
+
     def __init__(self, bundle, path, table, dest_srs=4326, source_srs=None, name = None):
 
         self.bundle = bundle
@@ -55,6 +58,8 @@ class TableShapefile(object):
         else:
             self.source_srs = None
 
+        self._source_srs_spec = source_srs
+
         if self.source_srs:
             self.transform = osr.CoordinateTransformation(self.source_srs, self.srs)
         else:
@@ -65,6 +70,7 @@ class TableShapefile(object):
         self.type, self.geo_col_names, self.geo_col_pos  = self.figure_feature_type()
 
         self.layer = None
+        self._fields = None
 
         if name:
             self.name = str(name)
@@ -181,60 +187,156 @@ class TableShapefile(object):
         else:
             raise Exception("Didn't find geometery column")
 
-        if geometry:
-            if not geometry.TransformTo(self.srs):
-                raise Exception("Failed to transform Geometry")
-        else:
-            
+        # The geometry has no SRS of its own; it is transformed with 
+        # self.transform, if there is a source SRS, when it is added. 
+        if not geometry:
             raise Exception("Didn't get a geometry object: x="+str(x)+" type="+str(self.type)+" gcn="+self.geo_col_names[0])
             
         return geometry
             
-    def add_feature(self, row, source_srs=None):
-        
-        geometry = self.get_geometry(row)
-        
-        if source_srs is not None and source_srs != self.source_srs:
-            self.source_srs = self._get_srs(source_srs)
-            self.transform = osr.CoordinateTransformation(self.source_srs, self.srs)
-            
+    def set_source_srs(self, source_srs):
+        """Set the SRS of the geometries that will be added. Does nothing if
+        it is None, or the same as the last one. """
+
+        if source_srs is None or source_srs == self._source_srs_spec:
+            return
+
+        self._source_srs_spec = source_srs
+        self.source_srs = self._get_srs(source_srs)
+        self.transform = osr.CoordinateTransformation(self.source_srs, self.srs)
+
+    def _get_layer(self, geometry):
+        """Return the layer, creating it for the type of the geometry if it
+        doesn't exist yet. """
+
         if self.layer is None:
-            type_ =  geometry.GetGeometryType() 
-            self.layer = self.ds.CreateLayer( self.name, self.srs, type_)
-            
+            self.layer = self.ds.CreateLayer( self.name, self.srs, geometry.GetGeometryType())
+
             if self.layer is None:
                 raise Exception("Failed to create layer {} ".format(self.name))
-            
+
             self.load_schema(self.layer)
 
-        
-        feature = ogr.Feature(self.layer.GetLayerDefn())
-
-        if isinstance(row, dict):
-            for i,c in enumerate(self.table.columns):
-                if i not in self.geo_col_pos or c.name in ['x','y','lat','lon']:
-                    v = row.get(c.name, False)
-                  
-                    if v is not False and  not isinstance(v, (int, float)):
-                        v = str(v)
-
-                    if v is not False:
-                        feature.SetField(str(c.name), v)
-                    elif c.default:
-                        feature.SetField(str(c.name), c.python_type(c.default))
-                      
-        else:
-            for i,v in enumerate(row):
-                if i not in self.geo_col_pos:
-                    feature.SetField(i, row.get(v, c.python_type(c.default) if c.default else None) )
-            
+            # The fields are created in the order of the columns, skipping
+            # the geometry, so the field indexes can be resolved once, rather
+            # than looking up each field by name for every feature.
+            self._fields = []
+            for pos, c in enumerate(self.table.columns):
+                if c.name.lower() in ('wkt','wkb','geometry'):
+                    continue
+
+                default = c.python_type(c.default) if c.default else None
+                self._fields.append((len(self._fields), pos, c.name, default))
+
+        return self.layer
+
+    def _set_fields(self, feature, row):
+        """Set the non-geometry fields of a feature from a dict, or from a
+        sequence in the order of the table columns"""
+
+        is_dict = isinstance(row, dict)
+
+        for idx, pos, name, default in self._fields:
+            v = row.get(name) if is_dict else row[pos]
+
+            if v is None:
+                v = default
+
+            if v is None:
+                continue
+
+            if not isinstance(v, (int, long, float)):
+                v = v.encode('utf-8') if isinstance(v, unicode) else str(v)
+
+            feature.SetField(idx, v)
+
+    def add_feature(self, row, source_srs=None):
+        """Add a single feature. add_features() is much faster for more
+        than a few rows. """
+
+        self.set_source_srs(source_srs)
+
+        geometry = self.get_geometry(row)
+
+        layer = self._get_layer(geometry)
+
+        feature = ogr.Feature(layer.GetLayerDefn())
+
+        self._set_fields(feature, row)
+
         if self.transform:
             geometry.Transform(self.transform)
-            
+
         feature.SetGeometryDirectly(geometry)
-        self.layer.CreateFeature(feature)
+        layer.CreateFeature(feature)
         feature.Destroy()
-        
+
+    def add_features(self, rows, source_srs=None, transaction_size=None):
+        """Add features for an iterable of rows, committing an OGR
+        transaction after every transaction_size features. For point layers,
+        the coordinates of each transaction are transformed in a single call.
+        Returns the number of features added. """
+        from itertools import islice
+
+        self.set_source_srs(source_srs)
+
+        if not transaction_size:
+            transaction_size = self.TRANSACTION_SIZE
+
+        rows = iter(rows)
+        count = 0
+
+        while True:
+            batch = list(islice(rows, transaction_size))
+
+            if not batch:
+                break
+
+            self._write_batch(batch)
+            count += len(batch)
+
+        return count
+
+    def _write_batch(self, rows):
+
+        if self.type == 'point':
+            xy = [ self.geo_vals(row) for row in rows ]
+
+            if self.transform:
+                xy = self.transform.TransformPoints(xy)
+
+            geometries = []
+            for p in xy:
+                geometry = ogr.Geometry(ogr.wkbPoint)
+                geometry.SetPoint_2D(0, p[0], p[1])
+                geometries.append(geometry)
+        else:
+            geometries = [ self.get_geometry(row) for row in rows ]
+
+            if self.transform:
+                for geometry in geometries:
+                    geometry.Transform(self.transform)
+
+        layer = self._get_layer(geometries[0])
+        defn = layer.GetLayerDefn()
+
+        layer.StartTransaction()
+
+        try:
+            for row, geometry in zip(rows, geometries):
+                feature = ogr.Feature(defn)
+                self._set_fields(feature, row)
+                feature.SetGeometryDirectly(geometry)
+
+                if layer.CreateFeature(feature) != 0:
+                    raise Exception("Failed to create feature in layer {}".format(self.name))
+
+                feature.Destroy()
+        except:
+            layer.RollbackTransaction()
+            raise
+
+        layer.CommitTransaction()
 
     def _get_srs(self, srs_spec=None, default=4326):
         
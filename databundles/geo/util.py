@@ -113,7 +113,72 @@ def jenks_breaks(dataList, numClass):
     
     return kclass 
  
-def getGVF( dataList, numClass ): 
+def histogram_jenks_breaks(counts, edges, numClass):
+    """Jenks natural breaks, computed from a histogram rather than from the
+    values. The values in each bin are treated as being at the center of the
+    bin, so the cost depends on the number of non-empty bins, not on the
+    number of values.
+
+    Returns numClass+1 breaks: the lower edge of the first non-empty bin, then
+    the upper edge of the last bin in each class. There are fewer classes if
+    there are fewer than numClass non-empty bins.
+    """
+    import numpy as np
+
+    counts = np.asarray(counts, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+
+    nz = counts > 0
+
+    w = counts[nz]
+    x = ((edges[:-1] + edges[1:]) / 2)[nz]
+    lower = edges[:-1][nz]
+    upper = edges[1:][nz]
+
+    m = len(w)
+
+    if m == 0:
+        raise ValueError("Can't compute breaks for an empty histogram")
+
+    numClass = min(numClass, m)
+
+    # With cumulative sums, the squared deviations of any run of bins
+    # is a difference of sums
+    cw = np.concatenate(([0], np.cumsum(w)))
+    cs = np.concatenate(([0], np.cumsum(w * x)))
+    css = np.concatenate(([0], np.cumsum(w * x * x)))
+
+    def ssd(i, l):
+        '''Squared deviations of bins i to l-1'''
+        s = cs[l] - cs[i]
+        return (css[l] - css[i]) - s * s / (cw[l] - cw[i])
+
+    # cost[j, l] is the least squared deviations of the first l bins in j+1
+    # classes, and start[j, l] is the first bin of the last of those classes
+    cost = np.ones((numClass, m + 1)) * np.inf
+    start = np.zeros((numClass, m + 1), dtype=int)
+
+    cost[0, 1:] = ssd(0, np.arange(1, m + 1))
+
+    for j in range(1, numClass):
+        for l in range(j + 1, m + 1):
+            i = np.arange(j, l)
+            c = cost[j - 1, i] + ssd(i, l)
+            k = np.argmin(c)
+            cost[j, l] = c[k]
+            start[j, l] = i[k]
+
+    breaks = [upper[m - 1]]
+    l = m
+    for j in range(numClass - 1, 0, -1):
+        l = start[j, l]
+        breaks.append(upper[l - 1])
+
+    breaks.append(lower[0])
+
+    return [ float(b) for b in reversed(breaks) ]
+
+def getGVF( dataList, numClass ):
     """ The Goodness of Variance Fit (GVF) is found by taking the 
     difference between the squared deviations from the array mean (SDAM) 
     and the squared deviations from the class means (SDCM), and dividing by the SDAM 
@@ -235,77 +300,144 @@ def create_bb( corners, srs):
 
       
 def combine_envelopes( geos, use_bb=True, use_distance=False):
-    """Find geometries that intersect"""
-    loops = 0   
-    while True: 
-        i, new_geos = _combine_envelopes(geos, use_bb, use_distance)
-        old = len(geos)
-        geos = None
-        geos = [g.Clone() for g in new_geos]
-        loops += 1
-        print "{}) {} reductions. {} old, {} new".format(loops, i, old, len(geos))
-        if old == len(geos):
-            break
-      
-    return geos
-      
-def _combine_envelopes(geometries, use_bb = True, use_distance=False):
-    """Inner support function for combine_envelopes"""
-    import databundles.geo as dg
-    reductions = 0
-    new_geometries = []
+    """Find geometries that intersect, and combine them. Returns a list with the union 
+    of each group of geometries that intersect, directly or through other geometries. 
     
-    accum = None
-    reduced = set()
-
-    for i1 in range(len(geometries)):
-        if i1 in reduced:
-            continue
-        g1 = geometries[i1]
-        for i2 in range(i1+1, len(geometries)):
-            if i2 in reduced:
+    :param use_bb: If True, geometries are grouped if their bounding boxes intersect, 
+    and groups are grouped if the bounding boxes of the groups intersect. 
+    
+    :param use_distance: If not False, also group geometries, or bounding boxes, that 
+    are closer than this distance. 
+    
+    Candidate pairs are found by sorting and sweeping the envelopes, and exact
+    OGR predicates are only evaluated for pairs whose envelopes are within use_distance.
+    """
+    import numpy as np
+    
+    n = len(geos)
+    
+    if n == 0:
+        return []
+    
+    pad = use_distance if use_distance else 0
+    
+    env = np.array([g.GetEnvelope() for g in geos], dtype=float)
+    
+    groups = np.arange(n)
+    
+    if use_bb:
+        # The bounding box of a group can intersect boxes that none of its members 
+        # intersect, so repeat with the group boxes until the groups don't change. 
+        # Only the envelope arrays are involved, not the geometries. 
+        while True:
+            labels, group_env = _group_envelopes(groups, env)
+            
+            parent = np.arange(len(group_env))
+            for i1, i2 in _envelope_pairs(group_env, pad):
+                d = _bb_distance(group_env[i1], group_env[i2])
+                if d == 0 or (use_distance and d < use_distance):
+                    _union(parent, i1, i2)
+            
+            roots = np.array([_find(parent, i) for i in range(len(parent))])
+            
+            if len(np.unique(roots)) == len(group_env):
+                break
+            
+            groups = roots[labels]
+    else:
+        parent = np.arange(n)
+        for i1, i2 in _envelope_pairs(env, pad):
+            
+            if _find(parent, i1) == _find(parent, i2):
                 continue
-
-            g2 = geometries[i2]
-
-
-            intersects = False
             
-            if (g1.Intersects(g2) or  g1.Contains(g2) or g2.Contains(g1) or g1.Touches(g2)):
-                intersects = True
-      
-            # If the final output is to onvert the reduced geometries to bounding boxes, it
-            # can have BBs that intersect that were not reduced, because the underlying geometries
-            # didn't intersect
-            if use_bb and not intersects:
-                bb1 =  dg.create_bb(g1.GetEnvelope(), g1.GetSpatialReference())
-                bb2 =  dg.create_bb(g2.GetEnvelope(), g2.GetSpatialReference())
-                if bb1.Intersects(bb2):  
-                    intersects = True
-                    
+            g1, g2 = geos[i1], geos[i2]
+            
+            intersects = (g1.Intersects(g2) or  g1.Contains(g2) or g2.Contains(g1) or g1.Touches(g2))
+            
             if use_distance and not intersects:
-                if use_bb:
-                    if bb1.Distance(bb2) < use_distance:
-                        intersects = True                        
-                else:
-                    if g1.Distance(g2) < use_distance:
-                        intersects = True         
-
+                intersects = g1.Distance(g2) < use_distance
+                
             if intersects:
-                reductions += 1
-                reduced.add(i2)
-                if not accum:
-                    accum = g1.Union(g2)
-                else:
-                    accum = accum.Union(g2)
-        
-        if accum is not None:
-            new_geometries.append(accum.Clone())
-            accum = None
+                _union(parent, i1, i2)
+        
+        groups = np.array([_find(parent, i) for i in range(n)])
+
+    # Union the members of each group, in the order of the first member
+    accums = {}
+    order = []
+    for i, group in enumerate(groups):
+        if group not in accums:
+            accums[group] = geos[i].Clone()
+            order.append(group)
         else:
-            new_geometries.append(g1.Clone())
+            accums[group] = accums[group].Union(geos[i])
 
-    return reductions, new_geometries
+    return [ accums[group] for group in order ]
+
+def _envelope_pairs(env, pad=0):
+    """Yield the pairs of indexes of envelopes that are within pad of each other 
+    in both dimensions, by sorting the envelopes on their minimum x, and sweeping
+    across them. The envelopes are rows of x_min, x_max, y_min, y_max, as from 
+    GetEnvelope() """
+    import numpy as np
+    
+    order = np.argsort(env[:,0], kind='mergesort')
+    s = env[order]
+    
+    # For each envelope, the end of the run of envelopes that start before it ends. 
+    ends = np.searchsorted(s[:,0], s[:,1] + pad, side='right')
+    
+    for i in range(len(s)):
+        j = np.arange(i+1, ends[i])
+        
+        if len(j) == 0:
+            continue
+        
+        j = j[(s[j,2] <= s[i,3] + pad) & (s[i,2] <= s[j,3] + pad)]
+        
+        for k in j:
+            yield order[i], order[k]
+
+def _bb_distance(e1, e2):
+    """Distance between two envelopes, or 0 if they intersect"""
+    import math
+    dx = max(0, e2[0] - e1[1], e1[0] - e2[1])
+    dy = max(0, e2[2] - e1[3], e1[2] - e2[3])
+    return math.hypot(dx, dy)
+
+def _group_envelopes(groups, env):
+    """Return the group number, from 0, for each envelope, and the envelopes of
+    the groups"""
+    import numpy as np
+    
+    unique, labels = np.unique(groups, return_inverse=True)
+    
+    group_env = np.empty((len(unique), 4))
+    group_env[:,0] = np.inf
+    group_env[:,1] = -np.inf
+    group_env[:,2] = np.inf
+    group_env[:,3] = -np.inf
+    
+    np.minimum.at(group_env[:,0], labels, env[:,0])
+    np.maximum.at(group_env[:,1], labels, env[:,1])
+    np.minimum.at(group_env[:,2], labels, env[:,2])
+    np.maximum.at(group_env[:,3], labels, env[:,3])
+    
+    return labels, group_env
+
+def _find(parent, i):
+    """Union-find root of i, with path halving"""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _union(parent, i1, i2):
+    r1, r2 = _find(parent, i1), _find(parent, i2)
+    if r1 != r2:
+        # Keep the lowest index as the root
+        parent[max(r1, r2)] = min(r1, r2)
             
 def bound_clusters_in_raster( a, aa, shape_file_dir, 
                                  contour_interval,contour_value, use_bb=True, use_distance=False):
@@ -498,6 +630,28 @@ def get_shapefile_geometry_types(shape_file):
     
         return types, type_
     
+def _transformed_areas(areas, places_query=None):
+    """Yield (area, geometry) for the rows of places_query, with the geometry
+    transformed to lon/lat"""
+    import osr
+  
+    dest_srs = ogr.osr.SpatialReference()
+    dest_srs.ImportFromEPSG(4326)
+
+    source_srs = areas.get_srs()
+
+    transform = osr.CoordinateTransformation(source_srs, dest_srs)
+    
+    if places_query is None:
+        places_query = "SELECT *, AsText(geometry) AS wkt FROM {} ORDER BY area ASC".format(areas.identity.table)
+    
+    for area in areas.query(places_query):
+     
+        g = ogr.CreateGeometryFromWkt(area['wkt'])
+        g.Transform(transform)
+        
+        yield dict(area), g
+
 def segment_points(areas,table_name=None,  query_template=None, places_query=None, bb_clause=None, bb_type='ll'):
     """A generator that yields information that can be used to classify
     points into areas
@@ -512,23 +666,13 @@ def segment_points(areas,table_name=None,  query_template=None, places_query=Non
     The 'wkt' field returned by the query is the Well Know Text representation of the area
     geometry
     
-    """
+    For classifying all of the points in a table at once, classify_points() is much faster.
     
-    import osr
-  
-    dest_srs = ogr.osr.SpatialReference()
-    dest_srs.ImportFromEPSG(4326)
-
-    source_srs = areas.get_srs()
-
-    transform = osr.CoordinateTransformation(source_srs, dest_srs)
+    """
     
     if query_template is None:
         query_template =  "SELECT * FROM {table_name} WHERE {bb_clause} AND ({target_col} IS NULL OR {target_col} = 'NONE') "
     
-    if places_query is None:
-        places_query = "SELECT *, AsText(geometry) AS wkt FROM {} ORDER BY area ASC".format(areas.identity.table)
-    
     if bb_clause is None:
         if bb_type == 'll':
             bb_clause = "lon BETWEEN {x1} AND {x2} AND lat BETWEEN {y1} and {y2}"
@@ -537,17 +681,14 @@ def segment_points(areas,table_name=None,  query_template=None, places_query=Non
         else:
             raise ValueError("Must use 'll' or 'xy' for bb_type. got: {}".format(bb_type))
     
-    for area in areas.query(places_query):
-     
-        g = ogr.CreateGeometryFromWkt(area['wkt'])
-        g.Transform(transform)
+    for area, g in _transformed_areas(areas, places_query):
         
         e = g.GetEnvelope()
 
         bb = bb_clause.format(x1=e[0], x2=e[1], y1=e[2], y2=e[3])
         query = query_template.format(bb_clause=bb, table_name = table_name, target_col=area['type'])      
         
-        def is_in(x, y):
+        def is_in(x, y, g=g):
             p = ogr.Geometry(ogr.wkbPoint)
             p.SetPoint_2D(0, x, y)
 
@@ -555,14 +696,254 @@ def segment_points(areas,table_name=None,  query_template=None, places_query=Non
                 return True
             else:
                 return False
-        
-        area = dict(area)
 
         yield area, query, is_in
 
+def geometry_rings(g):
+    """Return a list of the rings of a polygon or multipolygon geometry, each 
+    as an Nx2 numpy array of vertices"""
+    import numpy as np
+    
+    if g.GetGeometryName() == 'LINEARRING':
+        return [ np.array(g.GetPoints(), dtype=float)[:,:2] ]
+    
+    rings = []
+    for i in range(g.GetGeometryCount()):
+        rings.extend(geometry_rings(g.GetGeometryRef(i)))
+    
+    return rings
+
+def points_in_rings(x, y, rings):
+    """Return a boolean array that is True for the points inside the 
+    polygon described by rings, using the even-odd rule, so holes and the 
+    parts of multipolygons are handled by including all of their rings. 
+    
+    :param x: Numpy array of x values
+    :param y: Numpy array of y values
+    :param rings: list of Nx2 arrays of ring vertices, as from geometry_rings()
+    """
+    import numpy as np
+    
+    inside = np.zeros(len(x), dtype=bool)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for ring in rings:
+            x1, y1 = ring[:-1,0], ring[:-1,1]
+            x2, y2 = ring[1:,0], ring[1:,1]
+            
+            # One edge at a time, for all of the points
+            for k in range(len(x1)):
+                crosses = (y1[k] > y) != (y2[k] > y)
+                crosses &= x < (x2[k] - x1[k]) * (y - y1[k]) / (y2[k] - y1[k]) + x1[k]
+                inside ^= crosses
+            
+    return inside
+
+def classify_points(areas, points, table_name=None, places_query=None, 
+                    bb_type='ll', target_col=None, value_col='id', chunk_size=100000):
+    """Assign areas to all of the points in a table, and write the area 
+    values to the points table. 
+    
+    Each point is assigned the first area, in the order of the places query, 
+    that contains it, separately for each area type, for points that don't 
+    already have a value. This is the same as running the queries from 
+    segment_points() in order, but the points are read only once, and
+    classified in batches.
+    
+    The points are sorted on x, so the candidates for an area are found with
+    a binary search for its x range, and a vectorized test of its y range. The 
+    candidates are tested against the area's polygon rings with a vectorized
+    crossing test, chunk_size points at a time. 
+    
+    :param areas: A partition with the places. 
+    :param points: A partition with the points table
+    :param table_name: Name of the points table. Defaults to the partition's table
+    :param places_query: A Query to return places. Must return fields 'type', 'wkt' and value_col
+    :param bb_type: Either 'll' to use lon/lat columns for the points, or 'xy' to use x/y
+    :param target_col: Column to write the area values to. Defaults to the 
+        'type' field of each area. 
+    :param value_col: The field of the area to write to the target column. 
+    :rtype: A dict of the number of points assigned, for each target column. 
+    
+    """
+    import numpy as np
+    
+    if bb_type == 'll':
+        x_col, y_col = 'lon', 'lat'
+    elif bb_type == 'xy':
+        x_col, y_col = 'x', 'y'
+    else:
+        raise ValueError("Must use 'll' or 'xy' for bb_type. got: {}".format(bb_type))
+    
+    if table_name is None:
+        table_name = points.identity.table
+    
+    db = points.database
+    
+    area_list = []
+    for area, g in _transformed_areas(areas, places_query):
+        target = target_col if target_col else area['type']
+        area_list.append((area[value_col], target, g.GetEnvelope(), geometry_rings(g)))
+    
+    targets = sorted(set( a[1] for a in area_list ))
+    
+    pk = db.table(table_name).primary_key.columns.values()[0].name
+    
+    # Read the points, and the current values of the targets
+    r = db.connection.execute("SELECT {}, {}, {}, {} FROM {}".format(
+                               pk, x_col, y_col, ', '.join(targets), table_name))
+    
+    ids, xs, ys = [], [], []
+    unassigned = { t:[] for t in targets }
+    
+    while True:
+        rows = r.fetchmany(chunk_size)
+        if not rows:
+            break
+        
+        ids.append(np.array([ row[0] for row in rows ]))
+        xs.append(np.array([ row[1] for row in rows ], dtype=float))
+        ys.append(np.array([ row[2] for row in rows ], dtype=float))
+        
+        for i, t in enumerate(targets):
+            unassigned[t].append(np.array([ row[3+i] is None or row[3+i] == 'NONE' for row in rows ], dtype=bool))
+
+    if not ids:
+        return { t:0 for t in targets }
+
+    # Sort on x, for finding the candidates for each area with a binary search
+    ids, xs, ys = np.concatenate(ids), np.concatenate(xs), np.concatenate(ys)
+    
+    order = np.argsort(xs, kind='mergesort')
+    ids, xs, ys = ids[order], xs[order], ys[order]
+    
+    unassigned = { t: np.concatenate(a)[order] for t, a in unassigned.items() }
+    
+    # Points with no coordinates can't be in any area
+    valid = ~(np.isnan(xs) | np.isnan(ys))
+    
+    values = { t:{} for t in targets }
+    
+    for value, target, e, rings in area_list:
+        
+        start = np.searchsorted(xs, e[0], side='left')
+        end = np.searchsorted(xs, e[1], side='right')
+        
+        cand = np.arange(start, end)
+        cand = cand[ unassigned[target][cand] & valid[cand] & (ys[cand] >= e[2]) & (ys[cand] <= e[3]) ]
+        
+        for i in range(0, len(cand), chunk_size):
+            chunk = cand[i:i+chunk_size]
+            
+            chunk = chunk[points_in_rings(xs[chunk], ys[chunk], rings)]
+            
+            unassigned[target][chunk] = False
+            
+            for id_ in ids[chunk].tolist():
+                values[target][id_] = value
+
+    counts = {}
+    for target in targets:
+        with db.updater(table_name) as upd:
+            for id_, value in values[target].items():
+                upd.update({'_'+pk: id_, '_'+target: value})
+                
+        counts[target] = len(values[target])
+
+    return counts
+
+def transform_points(transform, x, y):
+    """Transform arrays of x and y coordinates with an OSR 
+    CoordinateTransformation, in a single call. Returns arrays of 
+    the transformed x and y"""
+    import numpy as np
+    
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    
+    if len(x) == 0:
+        return x, y
+    
+    t = np.array(transform.TransformPoints(np.column_stack((x, y)).tolist()))
     
+    return t[:,0], t[:,1]
+
+def fid_ranges(ds, layer_name, chunk_size):
+    """Split the FIDs of a layer in an OGR datasource into [start, end) 
+    ranges of chunk_size FIDs"""
+    
+    layer = ds.GetLayerByName(str(layer_name))
+    fid_col = layer.GetFIDColumn() or 'FID'
     
+    r = ds.ExecuteSQL('SELECT MIN({0}), MAX({0}) FROM "{1}"'.format(fid_col, layer_name))
     
+    try:
+        f = r.GetNextFeature()
+        lo, hi = f.GetField(0), f.GetField(1)
+    finally:
+        ds.ReleaseResultSet(r)
+        
+    if lo is None:
+        return []
     
+    lo, hi = int(lo), int(hi)
+    
+    return [ (start, min(start + chunk_size, hi + 1)) for start in range(lo, hi + 1, chunk_size) ]
+
+def reproject_features(path, layer_name, dest_wkt, fid_range=None, key=None):
+    """Read the features of a layer, or those with FIDs in the range 
+    [start, end), and transform them to the SRS in dest_wkt. 
     
-    
\ No newline at end of file
+    The coordinates of a point layer are transformed in a single call. Other
+    geometries are transformed one at a time. 
+    
+    :param key: Name of a field to return for each feature. Defaults to the FID. 
+    :rtype: A tuple of the keys, and either an Nx2 array of the coordinates, 
+        for a point layer, or a list of the WKB of the geometries
+    
+    """
+    import numpy as np
+    import osr
+    
+    ds = ogr.Open(path)
+    layer = ds.GetLayerByName(str(layer_name))
+    
+    if layer is None:
+        raise ValueError("Didn't find layer {} in {}".format(layer_name, path))
+    
+    dest = osr.SpatialReference()
+    dest.ImportFromWkt(dest_wkt)
+    transform = osr.CoordinateTransformation(layer.GetSpatialRef(), dest)
+    
+    if fid_range:
+        layer.SetAttributeFilter("{0} >= {1} AND {0} < {2}".format(
+                                 layer.GetFIDColumn() or 'FID', fid_range[0], fid_range[1]))
+    
+    is_point = ogr.GT_Flatten(layer.GetGeomType()) == ogr.wkbPoint
+    
+    keys, xs, ys, wkbs = [], [], [], []
+    
+    for f in layer:
+        g = f.GetGeometryRef()
+        
+        if g is None:
+            continue
+        
+        keys.append(f.GetField(key) if key else f.GetFID())
+        
+        if is_point:
+            xs.append(g.GetX())
+            ys.append(g.GetY())
+        else:
+            g.Transform(transform)
+            wkbs.append(g.ExportToWkb())
+            
+    if is_point:
+        x, y = transform_points(transform, xs, ys)
+        return keys, np.column_stack((x, y))
+    else:
+        return keys, wkbs
+
+def _reproject_chunk(args):
+    '''Run reproject_features in a pool worker'''
+    return reproject_features(*args)
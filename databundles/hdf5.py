@@ -11,6 +11,8 @@ from numpy import *
 
 class Hdf5File(h5py.File):
     
+    CHUNK_SHAPE = (256, 256) # Default chunks for geo arrays
+    
     def __init__(self, path):
 
         self._path = path
@@ -31,8 +33,22 @@ class Hdf5File(h5py.File):
     def path(self):
         return self._path
 
-    def put_geo(self,name, a, aa):
-        '''Store an array along with an Analysis Area'''
+    def put_geo(self,name, a, aa, compression='lzf', chunks=None, shuffle=True):
+        '''Store an array along with an Analysis Area. Returns the dataset. 
+        
+        :param compression: 'lzf', 'gzip', a gzip level, or None. LZF is much 
+            faster to write than gzip, with somewhat larger files. 
+        :param chunks: Chunk shape. Defaults to CHUNK_SHAPE, clipped to the array, 
+            which divides the default AnalysisArea tile size, so tile reads only 
+            touch the chunks in the tile. 
+        :param shuffle: Apply the shuffle filter before compressing, which helps
+            with arrays of floats. 
+        
+        With compression=None and no chunks, the dataset is stored contiguously, 
+        so it can be memory mapped by get_geo_mmap(). 
+        
+        The array is written a block of rows at a time, so it can be a memmap larger
+        than memory. '''
         import json
 
         group = self.require_group("geo")
@@ -40,7 +56,18 @@ class Hdf5File(h5py.File):
         if name in group:
             del group[name]
         
-        ds = group.create_dataset(name, data=a, compression=9)
+        if compression is None:
+            shuffle = False
+        elif chunks is None:
+            chunks = tuple( min(c, s) for c, s in zip(self.CHUNK_SHAPE, a.shape) ) + tuple(a.shape[2:])
+
+        ds = group.create_dataset(name, shape=a.shape, dtype=a.dtype, chunks=chunks, 
+                                  compression=compression, shuffle=shuffle)
+        
+        rows = chunks[0] * 16 if chunks else self.CHUNK_SHAPE[0] * 16
+        
+        for r in range(0, a.shape[0], rows):
+            ds[r:r+rows] = ma.getdata(a[r:r+rows])
         
         ds.attrs['analysis-area'] = json.dumps(aa.__dict__)
      
@@ -49,6 +76,36 @@ class Hdf5File(h5py.File):
                 ds.attrs['nodata'] = a.fill_value
         except:
             pass
+        
+        return ds
+
+    def get_geo_window(self, name, window):
+        """Read part of a geo array, without reading the rest of it. 
+        
+        :param window: A databundles.geo.analysisarea.Tile, or an envelope of 
+            (eastmin, eastmax, northmin, northmax) in the analysis area's coordinates. 
+            The envelope is expanded to whole cells, and clipped to the array. 
+        :rtype: The numpy array for the window, with row 0 at the southern edge. 
+        """
+        import math
+        
+        ds, aa = self.get_geo(name)
+        
+        try:
+            y0, y1, x0, x1 = window.y0, window.y1, window.x0, window.x1
+        except AttributeError:
+            eastmin, eastmax, northmin, northmax = window
+            x0 = int(math.floor((eastmin - aa.eastmin) / float(aa.scale)))
+            x1 = int(math.ceil((eastmax - aa.eastmin) / float(aa.scale)))
+            y0 = int(math.floor((northmin - aa.northmin) / float(aa.scale)))
+            y1 = int(math.ceil((northmax - aa.northmin) / float(aa.scale)))
+        
+        y_size, x_size = ds.shape[0], ds.shape[1]
+        
+        y0, y1 = max(y0, 0), min(y1, y_size)
+        x0, x1 = max(x0, 0), min(x1, x_size)
+        
+        return ds[y0:y1, x0:x1]
 
     def get_geo(self, name):
         """Return an array an an associated analysis area"""
@@ -68,6 +125,22 @@ class Hdf5File(h5py.File):
         
         return ds,aa
 
+    def get_geo_mmap(self, name):
+        """Return a read-only memory map of a dataset stored by put_geo() 
+        without compression, and its analysis area. Returns the dataset itself
+        if it isn't stored contiguously. """
+        
+        ds, aa = self.get_geo(name)
+        
+        offset = ds.id.get_offset()
+        
+        if offset is None:
+            return ds, aa
+
+        self.flush()
+
+        return memmap(self.path, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape), aa
+
     def list_geo(self):
 
         return self.require_group("geo").keys()
@@ -515,7 +515,72 @@ class LibraryDb(object):
                 raise e
 
         s.commit()
-        
+
+    def install_bundles(self, bundles, batch_size=50):
+        '''Install a list of bundles, like install_bundle(), but merging the
+        records for batch_size bundles at a time before committing. If a batch
+        fails, its bundles are installed one at a time, so the error is reported
+        for the bundle that caused it. '''
+        from databundles.orm import Dataset
+
+        s = self.session
+
+        for i in range(0, len(bundles), batch_size):
+            batch = bundles[i:i+batch_size]
+
+            try:
+                for bundle in batch:
+                    dataset = bundle.database.session.query(Dataset).one()
+
+                    old = s.query(Dataset).filter(Dataset.id_ == dataset.id_).first()
+                    if old:
+                        s.delete(old)
+                        s.flush()
+
+                    s.merge(dataset)
+
+                    for table in dataset.tables:
+                        s.merge(table)
+                        for column in table.columns:
+                            s.merge(column)
+
+                    for partition in dataset.partitions:
+                        s.merge(partition)
+
+                s.commit()
+            except IntegrityError as e:
+                s.rollback()
+                self.logger.error("Failed to install batch, retrying one bundle at a time: "+str(e))
+                for bundle in batch:
+                    self.install_bundle(bundle)
+
+        self._mark_update()
+
+    @property
+    def rebuild_manifest(self):
+        '''Return a dict, keyed by path, of the bundle files that were scanned
+        in the last rebuild, with the size, mtime, type and dataset id of each'''
+        from databundles.orm import Config as SAConfig
+
+        s = self.session
+
+        return { c.key: c.value for c in s.query(SAConfig).filter(SAConfig.group == 'rebuild',
+                                                                  SAConfig.d_id == 'none') }
+
+    def set_rebuild_manifest(self, manifest):
+        '''Replace the rebuild manifest'''
+        from databundles.orm import Config as SAConfig
+
+        s = self.session
+
+        s.query(SAConfig).filter(SAConfig.group == 'rebuild',
+                                 SAConfig.d_id == 'none').delete()
+
+        for path, entry in manifest.items():
+            s.add(SAConfig(group='rebuild', key=path, d_id='none', value=entry))
+
+        s.commit()
+
     def remove_bundle(self, bundle):
         '''remove a bundle from the database'''
         
@@ -1222,8 +1287,9 @@ class Library(object):
     
         return p_abs_path, p
             
-    def get(self,bp_id):
-        '''Get a bundle, given an id string or a name '''
+    def get(self,bp_id, read_only=True):
+        '''Get a bundle, given an id string or a name. The bundle and partition
+        databases are opened read-only unless read_only is False '''
 
         # Get a reference to the dataset, partition and relative path
         # from the local database. 
@@ -1231,11 +1297,11 @@ class Library(object):
         dataset, partition = self.get_ref(bp_id)
 
         if partition:
-            return self._get_partition(dataset, partition)
+            return self._get_partition(dataset, partition, read_only)
         elif dataset:
-            return self._get_dataset(dataset)  
+            return self._get_dataset(dataset, read_only)  
 
-    def _get_dataset(self, dataset):
+    def _get_dataset(self, dataset, read_only=True):
 
         # Try to get the file from the cache. 
         abs_path = self.cache.get(dataset.cache_key)
@@ -1251,7 +1317,7 @@ class Library(object):
         if not abs_path or not os.path.exists(abs_path):
             return False
        
-        bundle = DbBundle(abs_path)
+        bundle = DbBundle(abs_path, read_only=read_only)
             
         bundle.library = self
 
@@ -1264,10 +1330,10 @@ class Library(object):
             
         return bundle
     
-    def _get_partition(self,  dataset, partition):
+    def _get_partition(self,  dataset, partition, read_only=True):
         from databundles.dbexceptions import NotFoundError
         
-        r = self._get_dataset(dataset)
+        r = self._get_dataset(dataset, read_only)
         
         if not r:
             return False
@@ -1519,57 +1585,192 @@ class Library(object):
 
         return backup_file        
 
-    def remote_rebuild(self):
+    def remote_rebuild(self, threads=4):
         '''Rebuild the library from the contents of the remote'''
+        from multiprocessing.pool import ThreadPool
+        import time
+
+        t_start = time.time()
 
         self.clean()
-        for rel_path in self.remote.list():
-            path = self.cache.get(rel_path) # The cache and the remote must be connected!
-     
-            bundle = DbBundle(path)
-            identity = bundle.identity
-     
-            self.database.add_file(path, self.cache.repo_id, identity.id_,  'pushed')
 
-            self.database.install_bundle_file(identity, path)
-            
+        # The cache and the remote must be connected! The fetches are
+        # mostly waiting on the network, so run them in threads.
+        pool = ThreadPool(threads)
+        try:
+            paths = pool.map(self.cache.get, self.remote.list())
+        finally:
+            pool.close()
+            pool.join()
+
+        t_fetch = time.time()
 
+        entries = scan_bundle_files([ p for p in paths if p ])
+
+        for entry in entries.values():
+            if entry['error']:
+                self.logger.error('Failed to process {} : {} '.format(entry['path'], entry['error']))
+            else:
+                self.database.add_file(entry['path'], self.cache.repo_id, entry['d_id'],  'pushed')
 
-    def rebuild(self):
+        bundles = self._install_scanned(entries.values())
+
+        self._log_rebuild('Remote rebuild', len(paths), 0, len(bundles),
+                          t_start, t_fetch, time.time())
+
+        return bundles
+
+    def rebuild(self, force=False, processes=None):
         '''Rebuild the database from the bundles that are already installed
-        in the repositry cache'''
-  
-        from databundles.bundle import DbBundle
-   
-        bundles = []
+        in the repositry cache
+
+        The bundle files are classified in parallel, with a lightweight read
+        of the database file, by scan_bundle_files(). Files with the same size
+        and modification time as in the last rebuild are skipped, unless
+        force is True or the library database has been cleaned since. '''
+        import time
+
+        t_start = time.time()
+
+        paths = []
         for r,d,f in os.walk(self.cache.cache_dir): #@UnusedVariable
             for file_ in f:
-                
                 if file_.endswith(".db"):
-                    try:
-                        b = DbBundle(os.path.join(r,file_))
-                        # This is a fragile hack -- there should be a flag in the database
-                        # that diferentiates a partition from a bundle. 
-                        f = os.path.splitext(file_)[0]
-    
-                        if b.db_config.get_value('info','type') == 'bundle':
-                            self.logger.info("Queing: {} from {}".format(b.identity.name, file_))
-                            bundles.append(b)
-                            
-                    except Exception as e:
-                        self.logger.error('Failed to process {} : {} '.format(file_, e))
+                    paths.append(os.path.join(r,file_))
 
-        self.database.clean()
-        
-        for bundle in bundles:
-            self.logger.info('Installing: {} '.format(bundle.identity.name))
-            self.database.install_bundle(bundle)
-            
-    
-        
+        manifest = {} if force else self.database.rebuild_manifest
+
+        if not manifest:
+            self.database.clean()
+
+        new_manifest = {}
+        changed = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = manifest.get(path)
+
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                new_manifest[path] = entry
+            else:
+                changed.append(path)
+
+        entries = scan_bundle_files(changed, processes)
+
+        t_scan = time.time()
+
+        # Remove the bundles for files that have changed or are gone
+        for path, entry in manifest.items():
+            if path not in new_manifest and entry.get('type') == 'bundle':
+                self.database.remove_bundle(entry['d_id'])
+
+        for path, entry in entries.items():
+            if entry['error']:
+                self.logger.error('Failed to process {} : {} '.format(path, entry['error']))
+            else:
+                new_manifest[path] = { k: entry[k] for k in ('size', 'mtime', 'type', 'd_id') }
+
+        bundles = self._install_scanned(entries.values())
+
+        self.database.set_rebuild_manifest(new_manifest)
         self.database.commit()
+
+        self._log_rebuild('Rebuild', len(paths), len(paths) - len(changed), len(bundles),
+                          t_start, t_scan, time.time())
+
         return bundles
 
+    def _install_scanned(self, entries):
+        '''Install the bundle files from a list of scan_bundle_files() entries.
+        Returns the list of installed bundles, with their databases closed '''
+        from databundles.bundle import DbBundle
+
+        bundles = []
+        for entry in entries:
+            if not entry['error'] and entry['type'] == 'bundle':
+                self.logger.info("Queing: {} from {}".format(entry['name'], entry['path']))
+                bundles.append(DbBundle(entry['path'], read_only=True))
+
+        self.database.install_bundles(bundles)
+
+        for bundle in bundles:
+            bundle.database.close()
+
+        return bundles
+
+    def _log_rebuild(self, what, n_files, n_skipped, n_installed, t_start, t_scan, t_end):
+        '''Report the time and peak memory of a rebuild'''
+        import resource
+
+        # ru_maxrss is in kilobytes on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+        self.logger.info(("{}: {} files, {} unchanged, {} bundles installed. "
+                         "Scan {:.2f}s, install {:.2f}s, total {:.2f}s. "
+                         "Max RSS {}MB, workers {}MB")
+                         .format(what, n_files, n_skipped, n_installed,
+                                 t_scan - t_start, t_end - t_scan, t_end - t_start,
+                                 rss, child_rss))
+
+
+def _scan_bundle_file(path):
+    '''Read the type and dataset of a bundle or partition database file, with
+    a plain sqlite3 connection rather than opening it as a DbBundle. Runs in
+    a worker process for scan_bundle_files() '''
+    import sqlite3
+    import json
+
+    entry = {'path': path, 'size': None, 'mtime': None, 'type': None,
+             'd_id': None, 'name': None, 'error': None}
+
+    try:
+        stat = os.stat(path)
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('PRAGMA query_only = ON')
+
+            row = conn.execute("SELECT co_value FROM config "
+                               "WHERE co_group = 'info' AND co_key = 'type'").fetchone()
+            if row:
+                try:
+                    entry['type'] = json.loads(row[0])
+                except (TypeError, ValueError):
+                    entry['type'] = row[0]
+
+            row = conn.execute("SELECT d_id, d_name FROM datasets").fetchone()
+            if row:
+                entry['d_id'], entry['name'] = row
+        finally:
+            conn.close()
+
+    except Exception as e:
+        entry['error'] = str(e)
+
+    return entry
+
+def scan_bundle_files(paths, processes=None, pool_min=20):
+    '''Classify a list of bundle and partition database files, in a pool of
+    worker processes. Returns a dict of the entries from _scan_bundle_file(),
+    keyed by path. Short lists are scanned in this process, since
+    starting the pool would take longer than the scan. '''
+
+    if len(paths) < pool_min:
+        entries = [ _scan_bundle_file(path) for path in paths ]
+    else:
+        from multiprocessing import Pool
+
+        pool = Pool(processes=processes)
+        try:
+            entries = pool.map(_scan_bundle_file, paths, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    return { e['path']: e for e in entries }
+
 
 def _pragma_on_connect(dbapi_con, con_record):
     '''ISSUE some Sqlite pragmas when the connection is created'''
@@ -19,9 +19,27 @@ from databundles.identity import  DatasetNumber, ColumnNumber
 from databundles.identity import TableNumber, PartitionNumber, ObjectNumber
 
 import json
+import weakref
 
 Base = declarative_base()
 
+# The number of changes to tables and columns made in each session, so caches
+# of the schema, such as schema.SchemaCatalog, can tell that they are stale. 
+# Keyed by session, so changes in partition databases don't affect the
+# caches for the bundle database. 
+_schema_revisions = weakref.WeakKeyDictionary()
+
+def schema_revision(session):
+    '''Return the number of changes to tables and columns in a session'''
+    return _schema_revisions.get(session, 0)
+
+def _schema_changed(session):
+    if session is not None:
+        _schema_revisions[session] = _schema_revisions.get(session, 0) + 1
+
+def _schema_object_changed(mapper, connection, target):
+    _schema_changed(orm.object_session(target))
+
 class JSONEncodedObj(TypeDecorator):
     "Represents an immutable structure as a json-encoded string."
 
@@ -518,6 +536,8 @@ class Table(Base):
                     setattr(row, key, value)
       
         s.add(row)
+        
+        _schema_changed(s)
      
         if kwargs.get('commit', True):
             s.commit()
@@ -549,47 +569,29 @@ class Table(Base):
                 return c
         return None
     
+    def get_fixed_reader(self):
+            '''Return a FixedWidthReader for the columns of the table that have
+            a width, for parsing fixed width files.'''
+            from databundles.fixedwidth import FixedWidthReader
+            
+            return FixedWidthReader.from_table(self)
+
     def get_fixed_regex(self):
             '''Using the size values for the columsn for the table, construct a
             regular expression to  parsing a fixed width file.'''
             import re
 
-            pos = 0;
-            regex = ''
-            header = []
-            
-            for col in  self.columns:
-                
-                if not col.width:
-                    continue
-                
-                pos += col.width
-            
-                regex += "(.{{{}}})".format(col.width)
-                header.append(col.name)
+            reader = self.get_fixed_reader()
            
-            return header, re.compile(regex) , regex 
+            return reader.header, re.compile(reader.regex) , reader.regex 
 
     def get_fixed_unpack(self):
             '''Using the size values for the columns for the table, construct a
-            regular expression to  parsing a fixed width file.'''
+            struct format string for parsing a fixed width file.'''
         
-            unpack_str = ''
-            header = []
-            length = 0
-            
-            for col in  self.columns:
-                
-                if not col.width:
-                    continue
-                
-                length += col.width
-            
-                unpack_str += "{}s".format(col.width)
-                
-                header.append(col.name)
+            reader = self.get_fixed_reader()
            
-            return header, unpack_str, length
+            return reader.header, reader.unpack_str, reader.length
 
     @property
     def null_row(self):
@@ -603,39 +605,61 @@ class Table(Base):
             
         return self._null_row
 
+    def _get_validator_checks(self):
+        '''Return a list of (index, name, value, str_value) tuples, one for each 
+        mandatory column. value is the column default converted to the column's python 
+        type, and str_value is the default as it is stored in the schema, so rows
+        that hold either form are treated as holding the default. '''
+        
+        checks = []
+        for i,col in  enumerate(self.columns):
+            if col.data.get('mandatory', False):
+                
+                try:
+                    value = col.python_type(col.default) if col.default is not None else None
+                except (ValueError, TypeError, KeyError):
+                    value = col.default
+               
+                checks.append((i, str(col.name), value, str(col.default)))
+                
+        return checks
+
     def _get_validator(self, and_join=True):
-        '''Return a lambda function that, when given a row to this table, 
-        returns true or false to indicate the validitity of the row
+        '''Return a function that, when given a row to this table, 
+        returns true or false to indicate the validitity of the row. The 
+        column defaults are computed once, so the returned function only does
+        a flat loop of comparisons. 
         
         :param and_join: If true, join multiple column validators with AND, other
         wise, OR
         :type and_join: Bool
         
-        :rtype: a `LibraryDb` object
+        :rtype: a function
     
-            
         '''
 
-        f = prior = lambda row : True
-        first = True
-        for i,col in  enumerate(self.columns):
+        checks = tuple( (index, value, str_value) for index, _, value, str_value 
+                        in self._get_validator_checks())
 
-            if col.data.get('mandatory', False):
-                default_value = col.default
-                index = i
-                
-                if and_join:
-                    f = lambda row, default_value=default_value, index=index, prior=prior: prior(row) and str(row[index]) != str(default_value)
-                elif first:
-                    # OR joins would either need the initial F to be 'false', or just don't use it
-                    f = lambda row, default_value=default_value, index=index:  str(row[index]) != str(default_value)  
-                else:
-                    f = lambda row, default_value=default_value, index=index, prior=prior: prior(row) or str(row[index]) != str(default_value)
+        if not checks:
+            return lambda row : True
+
+        if and_join:
+            def validator(row):
+                for index, value, str_value in checks:
+                    v = row[index]
+                    if v == value or v == str_value:
+                        return False
+                return True
+        else:
+            def validator(row):
+                for index, value, str_value in checks:
+                    v = row[index]
+                    if v != value and v != str_value:
+                        return True
+                return False
                             
-                prior = f
-                first = False
-            
-        return f
+        return validator
     
     def validate_or(self, values):
 
@@ -651,6 +675,55 @@ class Table(Base):
         
         return self._and_validator(values)
     
+    def validate_block(self, block, and_join=True):
+        '''Validate a block of rows at once, returning a numpy boolean array
+        with one entry per row. 
+        
+        :param block: A 2D numpy array with one column per table column, a numpy
+        record array with fields named for the columns, or a list of rows. 
+        :param and_join: If true, join multiple column validators with AND, other
+        wise, OR
+        :type and_join: Bool
+        
+        :rtype: numpy array of bool
+        '''
+        import numpy as np
+        
+        if not hasattr(block, 'dtype'):
+            block = np.array(block, dtype=object)
+            
+        n_rows = block.shape[0]
+        
+        if and_join:
+            mask = np.ones(n_rows, dtype=bool)
+        else:
+            mask = np.zeros(n_rows, dtype=bool)
+
+        checks = self._get_validator_checks()
+
+        if not checks:
+            mask[:] = True
+            return mask
+
+        for index, name, value, str_value in checks:
+            
+            if block.dtype.names:
+                col = block[name]
+            else:
+                col = block[:,index]
+                
+            if col.dtype.kind in ('O','S','U'):
+                valid = np.logical_and(col != value, col != str_value)
+            else:
+                valid = col != value
+
+            if and_join:
+                mask &= valid
+            else:
+                mask |= valid
+
+        return mask
+    
     def _get_hasher(self):
         '''Return a  function to generate a hash for the row'''
         import hashlib
@@ -687,6 +760,10 @@ class Table(Base):
 event.listen(Table, 'before_insert', Table.before_insert)
 event.listen(Table, 'before_update', Table.before_update)
 
+for _cls in (Table, Column):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_cls, _event, _schema_object_changed)
+
 class Config(Base):
     __tablename__ = 'config'
 
@@ -67,7 +67,8 @@ class Partition(object):
             
             source,  name_parts, partition_path = self._path_parts() #@UnusedVariable
 
-            self._database = self._db_class(self.bundle, self, base_path=self.path)
+            self._database = self._db_class(self.bundle, self, base_path=self.path, 
+                                            read_only=self.bundle.database.read_only)
             
             def add_type(database):
                 from databundles.bundle import BundleDbConfig
@@ -125,7 +126,7 @@ class Partition(object):
         
         return self.bundle.schema.table(table_spec)
         
-    def create_with_tables(self, tables=None, clean=False):
+    def create_with_tables(self, tables=None, clean=False, defer_indexes=False):
         '''Create, or re-create,  the partition, possibly copying tables
         from the main bundle
         
@@ -134,6 +135,10 @@ class Partition(object):
             copy from the main bundle. 
             
             clean. If True, delete the database first. Defaults to true. 
+            
+            defer_indexes. If True, create the tables without indexes, for bulk
+            loading. The indexes are built when the inserter that loads the 
+            table is closed, or when the database is closed. 
         
         '''
 
@@ -146,16 +151,14 @@ class Partition(object):
         if clean:
             self.database.delete()
 
-        self.database.create(copy_tables = False)
+        self.database.create(copy_tables = False, defer_indexes=defer_indexes)
 
         self.add_tables(tables)
 
     def add_tables(self,tables):
 
         for t in tables:
-            if not t in self.database.inspector.get_table_names():
-                t_meta, table = self.bundle.schema.get_table_meta(t) #@UnusedVariable
-                t_meta.create_all(bind=self.database.engine)       
+            self.database.create_table(t)
 
     def create(self):
 
@@ -250,6 +253,89 @@ class GeoPartition(Partition):
 
         return transform
 
+    def reproject(self, dest_srs, x_col=None, y_col=None, wkb_col=None,
+                  processes=None, chunk_size=50000):
+        """Transform the geometries of the partition's table to another SRS, 
+        and write the results to columns of the same table: the coordinates 
+        to x_col and y_col for a point layer, or the WKB to wkb_col for other
+        layers. The destination columns must be given, since they are 
+        overwritten. 
+        
+        The features are read in ranges of chunk_size FIDs, and the 
+        coordinates of the points in each range are transformed in a single
+        call. If processes is greater than 1, the ranges are read and 
+        transformed in a pool of processes. Each range is written when it
+        is returned, by this process, so only the ranges being transformed
+        are held in memory. 
+        
+        Returns the number of features written. 
+        """
+        import time
+        import ogr
+        from multiprocessing import Pool
+        from databundles.geo.util import fid_ranges, reproject_features, _reproject_chunk
+        
+        table_name = self.identity.table
+        path = self.database.path
+        
+        pk = self.database.table(table_name).primary_key.columns.values()[0].name
+        
+        srs2 = ogr.osr.SpatialReference()
+        srs2.ImportFromEPSG(dest_srs) 
+        dest_wkt = srs2.ExportToWkt()
+        
+        ds = ogr.Open(path)
+        layer = ds.GetLayerByName(str(table_name))
+        
+        if layer is None:
+            raise ValueError("Didn't find layer {} in {}".format(table_name, path))
+        
+        is_point = ogr.GT_Flatten(layer.GetGeomType()) == ogr.wkbPoint
+        
+        if is_point and not (x_col and y_col):
+            raise ValueError("Must specify x_col and y_col to reproject a point layer")
+        elif not is_point and not wkb_col:
+            raise ValueError("Must specify wkb_col to reproject a layer that isn't points")
+        
+        ranges = fid_ranges(ds, table_name, chunk_size)
+        
+        ds = None
+        
+        jobs = [ (path, table_name, dest_wkt, r, pk) for r in ranges ]
+        
+        t0 = time.time()
+        
+        pool = None
+        if processes and processes > 1 and len(jobs) > 1:
+            pool = Pool(processes=processes)
+            results = pool.imap_unordered(_reproject_chunk, jobs)
+        else:
+            results = ( reproject_features(*job) for job in jobs )
+        
+        count = 0
+        try:
+            with self.database.updater(table_name) as upd:
+                for keys, geometries in results:
+                    if is_point:
+                        for key, (x, y) in zip(keys, geometries.tolist()):
+                            upd.update({'_'+pk: key, '_'+x_col: x, '_'+y_col: y})
+                    else:
+                        for key, wkb in zip(keys, geometries):
+                            upd.update({'_'+pk: key, '_'+wkb_col: wkb})
+                            
+                    count += len(keys)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        
+        t = time.time() - t0 + .001
+        
+        self.bundle.log("Reprojected {} features of {}: {:.1f}s, {:.0f} features/s"
+                        .format(count, table_name, t, count / t))
+        
+        return count
+
     def create(self, dest_srs=4326, source_srs=None):
 
         from databundles.geo.sfschema import TableShapefile
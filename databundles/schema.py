@@ -27,6 +27,160 @@ def _clean_int(i):
         return None
         raise ValueError("Input must be convertable to an int. got:  ".str(i)) 
 
+class CatalogColumn(object):
+    '''A read-only copy of the values of an orm.Column, for code that makes many
+    lookups and shouldn't trigger ORM refreshes'''
+    
+    __slots__ = ('id_', 'name', 'sequence_id', 'datatype', 'width', 'size', 
+                 'default', 'is_primary_key', 'data')
+
+    def __init__(self, column):
+        self.id_ = column.id_
+        self.name = column.name
+        self.sequence_id = column.sequence_id
+        self.datatype = column.datatype
+        self.width = column.width
+        self.size = column.size
+        self.default = column.default
+        self.is_primary_key = column.is_primary_key
+        self.data = dict(column.data) if column.data else {}
+
+    @property
+    def python_type(self):
+        return Column.types[self.datatype][1]
+
+    def __repr__(self):
+        return "<CatalogColumn: {}>".format(self.name)
+
+class CatalogTable(object):
+    '''A read-only copy of the values of an orm.Table and its columns'''
+    
+    __slots__ = ('id_', 'd_id', 'name', 'sequence_id', 'data', 'columns', '_column_index')
+
+    def __init__(self, table):
+        self.id_ = table.id_
+        self.d_id = table.d_id
+        self.name = table.name
+        self.sequence_id = table.sequence_id
+        self.data = dict(table.data) if table.data else {}
+        self.columns = tuple([ CatalogColumn(c) for c in table.columns ])
+        self._column_index = dict([ (c.name, i) for i, c in enumerate(self.columns) ])
+        
+    def column_index(self, name):
+        '''Return the position of a column in the table, or None'''
+        return self._column_index.get(name)
+        
+    def column(self, name_or_id):
+        i = self._column_index.get(name_or_id)
+        
+        if i is not None:
+            return self.columns[i]
+        
+        for c in self.columns:
+            if c.id_ == name_or_id:
+                return c
+            
+        return None
+
+    def __repr__(self):
+        return "<CatalogTable: {}>".format(self.name)
+
+class SchemaCatalog(object):
+    '''All of the tables and columns of a bundle database, loaded with one query
+    and indexed by id and name. The catalog also caches the SqlAlchemy table metadata
+    generated by Schema.get_table_meta. 
+    
+    The catalog holds ORM objects from a single session, so the Schema 
+    discards it when the database session changes, and when tables or columns are
+    changed in that session, which is tracked by orm.schema_revision(). 
+    '''
+    
+    def __init__(self, session):
+        from databundles import orm
+        from databundles.orm import Table
+        from sqlalchemy.orm import joinedload
+        
+        self.session = session
+        
+        self._tables = session.query(Table).options(joinedload(Table.columns)).all()
+        
+        self._by_id = {}
+        self._by_name = {}
+        
+        for t in self._tables:
+            self._by_id[t.id_] = t
+            self._by_name.setdefault(t.name, []).append(t)
+            
+        self._entries = {}
+        self._meta = {}
+        
+        # After the query, which may have flushed changes
+        self.revision = orm.schema_revision(session)
+
+    def table(self, name_or_id, d_id=None):
+        '''Return an orm.Table by id or name. When there are tables with the
+        same name in different datasets, the one for d_id is preferred.'''
+
+        t = self._by_id.get(name_or_id)
+        
+        if t is not None:
+            return t
+        
+        if not isinstance(name_or_id, basestring):
+            return None
+        
+        tables = self._by_name.get(name_or_id.lower()) or self._by_name.get(name_or_id)
+        
+        if not tables:
+            return None
+        
+        if d_id is not None:
+            for t in tables:
+                if t.d_id == d_id:
+                    return t
+        
+        return tables[0]
+
+    def tables(self, d_id=None):
+        '''Return the orm.Tables for a dataset, or all tables if d_id is None'''
+        if d_id is None:
+            return list(self._tables)
+        
+        return [ t for t in self._tables if t.d_id == d_id ]
+
+    @property
+    def columns(self):
+        return [ c for t in self._tables for c in t.columns ]
+
+    def entry(self, name_or_id, d_id=None):
+        '''Return a CatalogTable for a table, or None'''
+        
+        t = self.table(name_or_id, d_id)
+        
+        if t is None:
+            return None
+        
+        try:
+            return self._entries[t.id_]
+        except KeyError:
+            e = CatalogTable(t)
+            self._entries[t.id_] = e
+            return e
+
+    def meta(self, table, f, variant=None):
+        '''Return the cached (metadata, table) pair for an orm.Table, calling 
+        f(table) to generate it if it isn't cached. Variant distinguishes 
+        different kinds of metadata for the same table. '''
+
+        key = (table.id_, variant)
+
+        try:
+            return self._meta[key]
+        except KeyError:
+            m = f(table)
+            self._meta[key] = m
+            return m
+
 class Schema(object):
     """Represents the table and column definitions for a bundle
     """
@@ -44,6 +198,7 @@ class Schema(object):
         if not self.d_id:
             raise ValueError("self.bundle.identity.oid not set")
         self._seen_tables = {}
+        self._catalog = None
       
         self.table_sequence = len(self.tables)+1
         self.col_sequence = 1 
@@ -55,15 +210,33 @@ class Schema(object):
         s.query(Partition).delete()        
         s.query(Column).delete() 
         s.query(Table).delete()       
+        self.invalidate()
+        
+    @property
+    def catalog(self):
+        '''Return the SchemaCatalog for the bundle database, loading it if it
+        hasn't been loaded for the current session, or the tables or columns 
+        have changed since it was loaded'''
+        from databundles import orm
+        
+        session = self.bundle.database.session
+        
+        if (self._catalog is None or self._catalog.session is not session 
+            or self._catalog.revision != orm.schema_revision(session)):
+            self._catalog = SchemaCatalog(session)
+            
+        return self._catalog
+    
+    def invalidate(self):
+        '''Discard the catalog, so it is reloaded on the next access. Changes
+        made through the ORM are detected; call after changing tables or columns 
+        with SQL. '''
+        self._catalog = None
         
     @property
     def tables(self):
         '''Return a list of tables for this bundle'''
-        from databundles.orm import Table
-        q = (self.bundle.database.session.query(Table)
-                .filter(Table.d_id==self.d_id))
-
-        return q.all()
+        return self.catalog.tables(self.d_id)
     
     @classmethod
     def get_table_from_database(cls, db, name_or_id):
@@ -82,7 +255,12 @@ class Schema(object):
     
     def table(self, name_or_id):
         '''Return an orm.Table object, from either the id or name'''
-        return Schema.get_table_from_database(self.bundle.database, name_or_id)
+        return self.catalog.table(name_or_id)
+    
+    def table_entry(self, name_or_id):
+        '''Return a CatalogTable, a read-only copy of the table and its columns
+        that is faster to access than the orm.Table'''
+        return self.catalog.entry(name_or_id, self.d_id)
 
     def add_table(self, name, **kwargs):
         '''Add a table to the schema'''
@@ -105,6 +283,7 @@ class Schema(object):
                     data=data)
      
         self.bundle.database.session.add(row)
+        self.invalidate()
 
         for key, value in kwargs.items():
             if not key:
@@ -131,18 +310,55 @@ class Schema(object):
         c =  table.add_column(name, **kwargs)
         
         self.col_sequence += 1
+        self.invalidate()
         
         return c
         
     @property
     def columns(self):
-        '''Return a list of tables for this bundle'''
-        from databundles.orm import Column
-        return (self.bundle.database.session.query(Column).all())
+        '''Return a list of columns for this bundle'''
+        return self.catalog.columns
+        
+    def get_table_meta(self, name_or_id, use_indexes=True):
+        '''Return a tuple of a SqlAlchemy MetaData and Table for a table in 
+        the schema. The result is cached in the catalog, so don't alter it. 
+        
+        If use_indexes is False, the table has no indexes or unique constraints, 
+        for bulk loading. Create them afterward with the SQL from index_sql()'''
+        
+        table = self.catalog.table(name_or_id, self.d_id)
+        
+        if table is None:
+            raise ValueError("No table found for name {}".format(name_or_id))
+        
+        if use_indexes:
+            return self.catalog.meta(table, self._make_table_meta)
+        else:
+            return self.catalog.meta(table, 
+                        lambda t: self._make_table_meta(t, use_indexes=False), 
+                        variant='no_indexes')
+    
+    def index_sql(self, name_or_id):
+        '''Return CREATE INDEX statements for the indexes, unique indexes and
+        unique constraints of a table, which get_table_meta() leaves 
+        out when use_indexes is False. '''
+        from sqlalchemy.schema import CreateIndex
+        from sqlalchemy import UniqueConstraint
+        from sqlalchemy.dialects import sqlite
+        
+        metadata, at = self.get_table_meta(name_or_id)
         
-    def get_table_meta(self, name_or_id):
-        s = self.bundle.database.session
-        from databundles.orm import Table, Column
+        sql = [ str(CreateIndex(index).compile(dialect=sqlite.dialect())) for index in at.indexes ]
+        
+        for cons in at.constraints:
+            if isinstance(cons, UniqueConstraint):
+                sql.append("CREATE UNIQUE INDEX {}_{} ON {} ({})".format(
+                            at.name, cons.name, at.name, ','.join(c.name for c in cons.columns)))
+
+        return sql
+    
+    def _make_table_meta(self, table, use_indexes=True):
+        from databundles.orm import Column
         
         import sqlalchemy
         from sqlalchemy import MetaData, UniqueConstraint, ForeignKeyConstraint,  Index, text
@@ -158,21 +374,6 @@ class Schema(object):
         
         metadata = MetaData()
         
-        try :
-            q =  (s.query(Table)
-                       .filter(Table.name==name_or_id)
-                       .filter(Table.d_id==self.d_id))
-          
-            table = q.one()
-        except:
-            # Try it with just the name
-            q =  (s.query(Table).filter(Table.name==name_or_id))
-             
-            try:
-                table = q.one()
-            except sqlalchemy.orm.exc.NoResultFound: #@UndefinedVariable
-                raise ValueError("No table found for name {}".format(name_or_id))
-        
         at = SATable(table.name, metadata)
  
         indexes = {}
@@ -231,6 +432,9 @@ class Schema(object):
                     constraints[cons.strip()].append(column.name)
             
 
+        if not use_indexes:
+            return metadata, at
+
         # Append constraints. 
         for constraint, columns in constraints.items():
             at.append_constraint(UniqueConstraint(name=constraint,*columns))
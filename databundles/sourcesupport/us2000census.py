@@ -76,7 +76,8 @@ class Us2000CensusDimBundle(UsCensusDimBundle):
         import zipfile
 
         table = self.schema.table('geofile')
-        header, unpack_str, length = table.get_fixed_unpack() #@UnusedVariable    
+        reader = table.get_fixed_reader()
+        header = reader.header
 
         rows = 0;
 
@@ -103,7 +104,7 @@ class Us2000CensusDimBundle(UsCensusDimBundle):
                 break
 
             try:
-                geo = struct.unpack(unpack_str, line[:-1])
+                geo = reader.unpack(line)
             except struct.error as e:
                 self.error("Struct error for state={}, file={}, line_len={}, row={}, \nline={}"
                            .format(state,grf,len(line),rows, line))
@@ -286,7 +287,8 @@ class Us2000CensusFactBundle(UsCensusFactBundle):
         import struct
 
         table = self.schema.table('geofile')
-        header, unpack_str, length = table.get_fixed_unpack() #@UnusedVariable
+        reader = table.get_fixed_reader()
+        header = reader.header
          
         geo_source = self.urls['geos'][state]
       
@@ -317,7 +319,7 @@ class Us2000CensusFactBundle(UsCensusFactBundle):
                 break
 
             try:
-                geo = struct.unpack(unpack_str, line[:-1])
+                geo = reader.unpack(line)
             except struct.error as e:
                 self.error("Struct error for state={}, file={}, line_len={}, row={}, \nline={}"
                            .format(state,grf,len(line),rows, line))
@@ -5,6 +5,113 @@ Created on Aug 19, 2012
 '''
 from  databundles.sourcesupport.uscensus import UsCensusBundle
 
+class SegmentMergeReader(object):
+    '''Read the segment files for a state in step with the geo file, a block
+    of logical records at a time, rather than one row per generator call.
+    
+    Each segment file is a CSV file with one row per logical record, in the 
+    same order as the geo file, but some, like the PCT tables, have no rows
+    for some records. 
+    
+    :param segment_files: dict of segment number to segment file path
+    :param logrecno_col: index of the logrecno field in the segment rows
+    '''
+
+    def __init__(self, segment_files, logrecno_col=4):
+        self.segment_files = segment_files
+        self.logrecno_col = logrecno_col
+        
+        self._files = {}
+        self._readers = {}
+        self._buffers = {}
+        
+    def __enter__(self):
+        import csv
+        
+        for seg_number, path in self.segment_files.items():
+            f = open(path, 'rbU', buffering=1*1024*1024)
+            self._files[seg_number] = f
+            self._readers[seg_number] = csv.reader(f)
+            self._buffers[seg_number] = []
+            
+        return self
+    
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+    
+    def close(self):
+        for f in self._files.values():
+            f.close()
+            
+        self._files = {}
+        self._readers = {}
+        
+    def block(self, logrecnos):
+        '''Return the segment rows for a list of logrecnos from the geo file, 
+        as a dict of segment number to a tuple of (indexes, columns). indexes
+        are the positions in logrecnos that the segment has rows for, and 
+        columns is a list of tuples, one per field of the segment rows. 
+        The value is None if the segment has no rows in the block. '''
+        from itertools import islice
+        
+        col = self.logrecno_col
+        positions = None
+        
+        o = {}
+        for seg_number, reader in self._readers.items():
+            buf = self._buffers[seg_number]
+            
+            if len(buf) < len(logrecnos):
+                buf.extend(islice(reader, len(logrecnos) - len(buf)))
+         
+            if [ row[col] for row in buf ] == logrecnos:
+                # The usual case, a row for every logrecno
+                indexes = range(len(logrecnos))
+                rows = buf
+                self._buffers[seg_number] = []
+            else:
+                if positions is None:
+                    positions = { logrecno:i for i, logrecno in enumerate(logrecnos) }
+                
+                # Each row must match a logrecno of the block that is after the
+                # one the previous row matched. A row that matches none of them
+                # must be for a later block. 
+                indexes = []
+                last = -1
+                for row in buf:
+                    i = positions.get(row[col])
+                    if i is None:
+                        if int(row[col]) <= int(logrecnos[-1]):
+                            raise Exception("Logrecno mismatch for seg {} : {} is not in the geo file"
+                                            .format(seg_number, row[col]))
+                        break
+                    
+                    if i <= last:
+                        raise Exception("Logrecno mismatch for seg {} : {} is out of order, after {}"
+                                        .format(seg_number, row[col], logrecnos[last]))
+                        
+                    indexes.append(i)
+                    last = i
+                    
+                rows = buf[:len(indexes)]
+                self._buffers[seg_number] = buf[len(indexes):]
+
+            o[seg_number] = (indexes, zip(*rows)) if rows else None
+            
+        return o
+    
+    def left_over(self):
+        '''Return the number of segment rows that were not matched to a 
+        logrecno'''
+        n = 0
+        for seg_number, reader in self._readers.items():
+            n += len(self._buffers[seg_number])
+            for row in reader: #@UnusedVariable
+                n += 1
+                
+        return n
+
 class Us2010CensusBundle(UsCensusBundle):
     '''
     Bundle code for US 2000 Census, Summary File 1
@@ -182,15 +289,15 @@ class Us2010CensusBundle(UsCensusBundle):
             
         return str(o)
     
-    def build_generate_row(self, first, gens, geodim_gen,  geo_file_path, gln, unpack_str, line, last_line):
-        
-        import struct 
+    def unpack_geo_line(self, geo_file_path, gln, reader, line, last_line):
+        '''Unpack a line of the geo file, and return the fields and the line. 
+        The line is patched from last_line if it is too short.'''
         
         try:
-            geo = struct.unpack(unpack_str, line[:-1])
+            geo = reader.unpack(line)
         except Exception as e:
             self.error("Failed to unpack geo line from line {} of {}".format(gln, geo_file_path))
-            self.error("Unpack_str: "+unpack_str)
+            self.error("Unpack_str: "+reader.unpack_str)
             self.error("Line: "+line[:-1])
             self.error("Line Length "+str(len(line[:-1])))
             
@@ -205,12 +312,16 @@ class Us2010CensusBundle(UsCensusBundle):
             # to make the line the right length
             line = self.merge_strings(last_line, line)
             
-            geo = struct.unpack(unpack_str, line[:-1])
-        
-        last_line = line
+            geo = reader.unpack(line)
         
         if not geo:
             raise ValueError("Failed to match regex on line: "+line) 
+        
+        return geo, line
+    
+    def build_generate_row(self, first, gens, geodim_gen,  geo_file_path, gln, reader, line, last_line):
+        
+        geo, line = self.unpack_geo_line(geo_file_path, gln, reader, line, last_line)
     
         segments = {}
        
@@ -248,7 +359,8 @@ class Us2010CensusBundle(UsCensusBundle):
         import re
         
         table = self.schema.table('sf1geo2010')
-        header, unpack_str, length = table.get_fixed_unpack() #@UnusedVariable
+        reader = table.get_fixed_reader()
+        header = reader.header
          
         source_url = self.urls['geos'][state]
         
@@ -279,7 +391,7 @@ class Us2010CensusBundle(UsCensusBundle):
                         gln += 1
 
                         logrecno, geo, segments, geodim =  self.build_generate_row(
-                            first, gens, geodim_gen,  geo_file_path, gln, unpack_str, line, last_line)
+                            first, gens, geodim_gen,  geo_file_path, gln, reader, line, last_line)
 
                         yield state, logrecno, dict(zip(header,geo)), segments, geodim
                     
@@ -295,4 +407,83 @@ class Us2010CensusBundle(UsCensusBundle):
                         raise Exception("Should not hae extra items left. got {} ".format(str(lines_left)))
 
 
-            
\ No newline at end of file
+            
+
+    def build_generate_blocks(self, state, geodim=False, block_size=10000):
+        '''Like build_generate_rows(), but yields blocks of logical records, 
+        reading the segment files with a SegmentMergeReader. Yields tuples of:
+        
+            state, 
+            list of logrecnos, 
+            list of geo tuples, in the order of the sf1geo2010 columns,
+            dict of segment number to (indexes, columns), from SegmentMergeReader.block()
+            list of geodim rows, or None
+        '''
+        import re
+        from itertools import islice
+        
+        table = self.schema.table('sf1geo2010')
+        reader = table.get_fixed_reader()
+        
+        source_url = self.urls['geos'][state]
+        
+        geodim_gen = self.build_generate_geodim_rows(state) if geodim else None
+        
+        state_file = self.filesystem.download(source_url)
+    
+        segment_files = {}
+        geo_file_path = None
+        for f in self.filesystem.unzip_dir(state_file):
+            g1 = re.match(r'.*/(\w\w)(\d+)2010.sf1', str(f))
+            g2 = re.match(r'.*/(\w\w)geo2010.sf1', str(f))
+            if g1:
+                segment_files[int(g1.group(2))] = f
+            elif g2:
+                geo_file_path = f
+        
+        with open(geo_file_path, 'rbU') as geofile, SegmentMergeReader(segment_files) as smr:
+            gln = 0
+            last_line = None
+            while True:
+                lines = list(islice(geofile, block_size))
+                
+                if not lines:
+                    break
+                
+                geos = []
+                for line in lines:
+                    gln += 1
+                    geo, last_line = self.unpack_geo_line(geo_file_path, gln, reader, line, last_line)
+                    geos.append(geo)
+                    
+                logrecnos = [ geo[6] for geo in geos ]
+                
+                segments = smr.block(logrecnos)
+                
+                # The logrecno must match up across all files, except
+                # when ( in PCT tables ) there is no entry
+                for seg_number, seg in segments.items():
+                    if seg is None:
+                        continue
+                    
+                    indexes, columns = seg
+                    for i, seg_logrecno in zip(indexes, columns[smr.logrecno_col]):
+                        if seg_logrecno != logrecnos[i]:
+                            raise Exception("Logrecno mismatch for seg {} : {} != {}"
+                                            .format(seg_number, seg_logrecno, logrecnos[i]))
+                    
+                if geodim_gen is not None:
+                    geodims = list(islice(geodim_gen, len(geos)))
+                    for geodim, logrecno in zip(geodims, logrecnos):
+                        if geodim[0] != logrecno:
+                            raise Exception("Logrecno mismatch for geodim : {} != {}"
+                                            .format(geodim[0],logrecno))
+                else:
+                    geodims = None
+                
+                yield state, logrecnos, geos, segments, geodims
+    
+            # Check that there are no extra lines. 
+            lines_left = smr.left_over()
+            if lines_left > 0:
+                raise Exception("Should not hae extra items left. got {} ".format(str(lines_left)))
@@ -24,7 +24,6 @@ class UsCensusBundle(BuildBundle):
         
         try:
             self.segmap_file =  self.filesystem.path(bg.segMapFile)
-            self.rangemap_file =  self.filesystem.path(bg.rangeMapFile)
         except:
             pass
         
@@ -38,8 +37,6 @@ class UsCensusBundle(BuildBundle):
         except: self.log("Missing urls file config entry ")
 
 
-        self._table_id_cache = {}
-
         self._urls_cache = None
     
         self._geo_tables = None
@@ -82,13 +79,7 @@ class UsCensusBundle(BuildBundle):
        
     def get_table_by_table_id(self,table_id):  
         '''Get the table definition from the schema'''
-        t = self._table_id_cache.get(table_id, False)
-        
-        if not t:
-            t = self.schema.table(table_id)
-            self._table_id_cache[table_id] = t
-
-        return t
+        return self.schema.table(table_id)
     
     @property
     def urls(self):
@@ -105,6 +96,48 @@ class UsCensusBundle(BuildBundle):
  
         return self._urls_cache
       
+    def prefetch_geos(self):
+        '''Start background downloads of the geo files for all of the states, 
+        so later states are downloaded while earlier ones are processed'''
+        self.filesystem.prefetch([ self.urls['geos'][state] for state in self.states ], 'zip')
+
+    def build_generate_blocks(self, state, geodim=False, block_size=10000):
+        '''Group the records from build_generate_rows() into blocks, yielding
+        tuples of:
+        
+            state, 
+            list of logrecnos, 
+            list of geo records, 
+            dict of segment number to (indexes, columns), where indexes are 
+                the positions in the block that the segment has rows for, and
+                columns is a list of tuples, one per field of the segment rows
+            list of geodim rows, or None
+        
+        Bundles that can read the segment files in blocks directly override
+        this. '''
+        from itertools import islice
+        
+        records = self.build_generate_rows(state, geodim=geodim)
+        
+        while True:
+            block = list(islice(records, block_size))
+            
+            if not block:
+                break
+            
+            rows = {}
+            for i, (state, logrecno, geo, segments, geo_keys) in enumerate(block): #@UnusedVariable
+                for seg_number, row in segments.items():
+                    if row:
+                        indexes, seg_rows = rows.setdefault(seg_number, ([], []))
+                        indexes.append(i)
+                        seg_rows.append(row)
+            
+            yield (state, 
+                   [ r[1] for r in block ], 
+                   [ r[2] for r in block ],
+                   { n: (indexes, zip(*seg_rows)) for n, (indexes, seg_rows) in rows.items() },
+                   [ r[4] for r in block ] if geodim else None)
 
     def make_geoid(self,  release_id, state, sumlev, geocomp, chariter, cifsn):
         """ The LRID -- Logical Record Id -- is a unique id for a logical record
@@ -229,71 +262,99 @@ class UsCensusDimBundle(UsCensusBundle):
     # Build 
     #############################################
     
-    def build(self, run_load_geo_dim_f = None, run_geo_dim_f=None, run_state_tables_f=None,run_fact_db_f=None):
+    def build(self):
         '''Create data  partitions. 
         First, creates all of the state segments, one partition per segment per 
-        state. Then creates a partition for each of the geo files. '''
-        from multiprocessing import Pool
+        state. Then creates a partition for each of the geo files. 
+        
+        The phases run as tasks in self.tasks, grouped by subphase name, and
+        tasks that completed in an earlier run are skipped. With --multi, the
+        tasks that don't depend on each other run in a process pool. '''
 
         if self.run_args.subphase in ['test']:
             print self.states
             print self.states_dict
+            return True
          
-        # Special process to run the sf1geo partition
-        if self.run_args.subphase in ['all-geo']:
-            self.run_sf1_geo()
-         
-        # Split up the state geo files into .csv files, and 
-        # create the build/geodim files that will link logrecnos to
-        # geo split table records. 
-        if self.run_args.subphase in ['all','geo-dim']:
-    
-            if self.run_args.multi and run_geo_dim_f:
-                
-                pool = Pool(processes=int(self.run_args.multi))
-          
-                result = pool.map_async(run_geo_dim_f, enumerate(self.urls['geos'].keys()))
-                print result.get()
-            else:
-                for state in self.states:
-                    self.run_geo_dim(state)
+        tasks = self.build_tasks()
         
-        # Now we have all of the geo data broken down into seperate .csv files, 
-        # one per geo table and state. 
-     
-        if self.run_args.subphase in ['all','load-geo-dim']:   
-            
-            if self.run_args.multi and run_load_geo_dim_f:
-                
-                pool = Pool(processes=int(self.run_args.multi))
-
-                ids = [p.identity.id_ for p in self.dim_partitions]
-
-                result = pool.map_async(run_load_geo_dim_f,ids)
-                print result.get()
-            else:
-                for partition in self.dim_partitions:
-                    self.load_geo_dim(partition)
+        if self.run_args.subphase == 'all':
+            subphases = ['geo-dim', 'load-geo-dim', 'reindex-record-code', 'join-partitions']
+        else:
+            subphases = [self.run_args.subphase]
 
-        if self.run_args.subphase in ['rebuild-hash-translations']:  
-            self.rebuild_hash_translations()
-            
-        if self.run_args.subphase in ['all','reindex-record-code']:  
-            self.reindex_record_code()
+        names = [ name for subphase in subphases for name in tasks.group(subphase) ]
 
-        if self.run_args.subphase in ['all','join-partitions']:  
-            self.join_partitions()
+        if not self.run_args.multi and 'geo-dim' in subphases:
+            self.prefetch_geos()
+        
+        tasks.run(names, processes=self.run_args.multi)
+        
+        tasks.report()
 
         return True
 
-        # Join all of the seperate partitions into a single partition
+    def build_tasks(self):
+        '''Add the tasks for the build phases to the task graph.'''
+        
+        tasks = self.tasks
+        
+        if tasks.tasks:
+            return tasks
+        
+        geo_partitions = self.geo_partition_map() 
+        dim_partitions = geo_partitions.values()+[self.get_record_code_partition(geo_partitions)]
+        
+        # Split up the state geo files into .csv files, and 
+        # create the build/geodim files that will link logrecnos to
+        # geo split table records. 
+        for state in self.states:
+            tasks.add('geo-dim-'+state, self.run_geo_dim, (state,),
+                      outputs=[ p.tempfile(suffix=state).path for p in dim_partitions ],
+                      group='geo-dim')
+        
+        # Then load the .csv files for all of the states into one partition
+        # per geo table
+        for partition in dim_partitions:
+            outputs = [ partition.database.path ]
+            
+            if partition.table.name != 'record_code':
+                outputs.append(partition.database.hash_index(partition.table).path)
+            
+            tasks.add('load-geo-dim-'+partition.table.name, self.load_geo_dim_id, 
+                      (partition.identity.id_,),
+                      inputs=[ partition.tempfile(suffix=state).path for state in self.states ],
+                      outputs=outputs,
+                      depends=tasks.group('geo-dim'),
+                      group='load-geo-dim')
+            
+        load_geo_dim = tasks.group('load-geo-dim')
+         
+        tasks.add('reindex-record-code', self.reindex_record_code, 
+                  depends=load_geo_dim, group='reindex-record-code')
+        
+        tasks.add('join-partitions', self.join_partitions, 
+                  depends=['reindex-record-code'], group='join-partitions')
+        
+        # Only run when requested with a subphase. Reads the geo split tables,
+        # but not the record_code table
+        tasks.add('rebuild-hash-translations', self.rebuild_hash_translations, 
+                  depends=[ 'load-geo-dim-'+p.table.name for p in geo_partitions.values() ], 
+                  group='rebuild-hash-translations')
+        
+        # Special process to run the sf1geo partition
+        tasks.add('all-geo', self.run_sf1_geo, group='all-geo')
 
+        markers = {}
+        for state in self.states:
+            markers['geo-dim-'+state] = self.filesystem.build_path('markers',"run_geo_dim_"+state)
+            
+        for partition in dim_partitions:
+            markers['load-geo-dim-'+partition.table.name] = self.filesystem.build_path('markers',"join_geo_dim_"+partition.table.name)
 
-        if self.run_args.subphase in ['all','load-sql']:  
-            self.post_create_file =  self.filesystem.path(self.config.build.postCreateSql)
-            self.database.load_sql(self.post_create_file)
+        tasks.import_markers(markers)
 
-        return True
+        return tasks
 
     def run_sf1_geo(self):
         """Build the SF1Geo table, which is a direct import of the
@@ -339,12 +400,13 @@ class UsCensusDimBundle(UsCensusBundle):
         partition.database.load_sql(self.filesystem.path(self.config.build.sf1IndexSql))
 
 
-    def run_geo_dim(self, state):
+    def run_geo_dim(self, state, block_size=10000):
         '''Break up a state geo file into seperate geo dim split tables, as CSV files. 
         This will aso create a CSV file for the record_code table for the state, which 
         holds the hash values of the split table entries. '''
         
         import time, copy
+        from itertools import islice
      
         # Create the record_code partition, since it doesn't get created with the other
         # geo tables. 
@@ -361,13 +423,7 @@ class UsCensusDimBundle(UsCensusBundle):
      
         row_i = 0
         
-        marker_f = self.filesystem.build_path('markers',"run_geo_dim_"+state)
-        
-        if os.path.exists(marker_f):
-            self.log("Geo dim exists for {}, skipping".format(state))
-            return
-        else:
-            self.log("Building geo dim for {}".format(state))
+        self.log("Building geo dim for {}".format(state))
        
         # Find the record_code partition temp files and clear them out. 
         # This is where we will put the hash values for geo dim table records. 
@@ -397,66 +453,75 @@ class UsCensusDimBundle(UsCensusBundle):
                 pass
 
 
-        # Iterate over all of the geo rows for this state. 
-        for geo in self.build_generate_rows(state): #@UnusedVariable
-         
+        # Iterate over all of the geo rows for this state, a block at a time, so
+        # each geo dim table can validate a whole block with one call. 
+        rows = self.build_generate_rows(state)
+        
+        while True:
+            
+            geos = list(islice(rows, block_size))
+            
+            if not geos:
+                break
+            
             if row_i == 0: # HEre b/c opening the files in build_generate_rows is slow. 
                 self.log("Starting loop for state: "+state+' ')
                 t_start = time.time()
-            row_i += 1
+            row_i += len(geos)
             
-            if row_i % 10000 == 0:
-                # Prints the processing rate in 1,000 records per sec.
-                self.log("GEO "+state+" "+str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
+            # Prints the processing rate in 1,000 records per sec.
+            self.log("GEO "+state+" "+str(int( row_i/(time.time()-t_start+.001)))+'/s '+str(row_i/1000)+"K ")
 
-            geo['abbrev'] = state
+            for geo in geos:
+                geo['abbrev'] = state
 
-            # Iterate over all of the geo dimension tables, taking part of this
+            # Iterate over all of the geo dimension tables, taking part of each
             # geo row and putting it into the temp file for that geo dim table. 
       
-            hash_keys = []
+            hash_keys = [ [] for geo in geos ]
             for table_id, cp in geo_processors.items():
 
                 table,  columns, processors = cp #@UnusedVariable
             
                 partition = geo_partitions[table_id]
-
-                # Extract a subset form the geo row for this geo dim table. 
-                values = [ f(geo) for f in processors ]
-                         
-                # If the row does not have all of the required fields, 
-                # map it to the empyt row
-                if not table.validate_or(values):
-                    # Substitute the empty row
-                    values = copy.copy( table.null_row)
-
-
-
-                row_hash = table.row_hash(values)
                 th = row_hash_map[table.id_]
-             
-                # The local row_hash check reduces the number of calls to writerow, but
-                # since we are operating on states independently, it does not
-                # guarantee uniqueness across states. 
-                if row_hash not in th:  
-                    th.add(row_hash)
-                    
-                    values[-1] = row_hash
-                    
-                    tf = partition.tempfile( suffix=state)
+                tf = partition.tempfile( suffix=state)
 
-                    tf.writer.writerow(values)
+                # Extract a subset form the geo rows for this geo dim table. 
+                block = [ [ f(geo) for f in processors ] for geo in geos ]
+                
+                # Rows that do not have any of the required fields get
+                # mapped to the empty row
+                valid = table.validate_block(block, and_join=False)
 
-                hash_keys.append(row_hash)
+                for i, values in enumerate(block):
+                
+                    if not valid[i]:
+                        # Substitute the empty row
+                        values = copy.copy( table.null_row)
+
+                    row_hash = table.row_hash(values)
+                 
+                    # The local row_hash check reduces the number of calls to writerow, but
+                    # since we are operating on states independently, it does not
+                    # guarantee uniqueness across states. 
+                    if row_hash not in th:  
+                        th.add(row_hash)
+                        
+                        values[-1] = row_hash
+    
+                        tf.writer.writerow(values)
+    
+                    hash_keys[i].append(row_hash)
 
             # The first None is for the primary id, the last is for the 
             # row_hash, which was added automatically to geo_dim tables.           
             # The fileid comes from the bundle.yaml configuration b/c it is the same for all records
             # in the bundle. 
-         
-            values = [None, int(geo['logrecno']),int(geo['sumlev']),int(geo['geocomp'])]  + hash_keys
             tf = record_code_partition.tempfile(suffix=state)
-            tf.writer.writerow(values)
+            for geo, keys in zip(geos, hash_keys):
+                values = [None, int(geo['logrecno']),int(geo['sumlev']),int(geo['geocomp'])]  + keys
+                tf.writer.writerow(values)
 
         # Close all of the tempfiles. 
         for table_id, cp in geo_processors.items():
@@ -464,37 +529,40 @@ class UsCensusDimBundle(UsCensusBundle):
             partition.database.tempfile(partition.table, suffix=state).close()
  
         record_code_partition.database.tempfile(record_code_partition.table, suffix=state).close()  
-            
-        with open(marker_f, 'w') as f:
-            f.write(str(time.time()))
 
     def rebuild_hash_translations(self):
-        '''Rebuild the DBM files that link the hash values to primary keys
+        '''Rebuild the hash indexes that link the hash values to primary keys
         '''
         import time
-        import struct
+        import numpy as np
         t_start = time.time()
         row_i = 0;
         for partition in  self.geo_partition_map().values(): 
             
-            # Get a handle on the dmb database that translated hash values to 
-            # primary keeys
-            partition.database.dbm(partition.table).delete()
-            dbm = partition.database.dbm(partition.table).writer
+            table_name = partition.table.name
+            
+            r = partition.database.connection.execute(
+                    "SELECT {}, hash FROM {} WHERE hash IS NOT NULL AND hash != ''"
+                    .format(partition.table.columns[0].name, table_name))
             
-            for row in partition.database.session.execute("SELECT * FROM {}".format(partition.table.name)):
-                row_i += 1
+            keys = []
+            hashes = []
+            while True:
+                rows = r.fetchmany(100000)
+                if not rows:
+                    break
+                
+                block = np.array(rows, dtype=np.int64)
+                keys.append(block[:,0])
+                hashes.append(block[:,1])
+                
+                row_i += len(rows)
+                self.log("Rehash "+table_name+" "+
+                         str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
 
-                if not row['hash']:
-                    print partition.table.name, row
-                    continue;
-          
-                dbm[str(row['hash'])] = str(row[0])
-                if row_i % 1000 == 0:
-                    self.log("Rehash "+partition.table.name+" "+
-                             str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
-                    
-            dbm.close()
+            empty = np.array([], dtype=np.int64)
+            partition.database.hash_index(partition.table).write(np.concatenate(hashes or [empty]), 
+                                                                 np.concatenate(keys or [empty]))
 
     def reindex_record_code(self):
         '''Translate the hash values in the foreign keys point to the geo dim tables
@@ -503,6 +571,7 @@ class UsCensusDimBundle(UsCensusBundle):
         After translating the rows, inserts the row into the main database. 
         '''
         import time
+        import numpy as np
         rcp = self.get_record_code_partition();
 
         translators = []
@@ -514,14 +583,14 @@ class UsCensusDimBundle(UsCensusBundle):
                 self.error("MISSING PARTITION! for table: "+name)
                 continue
 
-            # Get a handle on the dmb database that translated hash values to 
-            # primary keeys
+            # Get a handle on the index that translates hash values to 
+            # primary keys
+            hash_index = partition.database.hash_index(partition.table)
          
-            try:
-                dbm = partition.database.dbm(partition.table).reader      
-                translators.append(dbm)
-            except: 
-                self.error("Failed to get DBM file for partition {}".format(partition.identity.name))
+            if hash_index.exists:
+                translators.append(hash_index)
+            else: 
+                self.error("Failed to get hash index for partition {}".format(partition.identity.name))
 
         row_i = 0
      
@@ -534,21 +603,30 @@ class UsCensusDimBundle(UsCensusBundle):
         with self.database.inserter(rcp.table) as ins:
             try:
                 self.log("Getting record_code rows from "+rcp.database.path)
-                for row in rcp.database.session.execute("SELECT * FROM record_code"):
+                r = rcp.database.connection.execute("SELECT * FROM record_code")
+                
+                # Translate the hashes a block of rows at a time. 
+                while True:
+                    rows = r.fetchmany(100000)
+                    
+                    if not rows:
+                        break
                     
                     if row_i == 0:
                         t_start = time.time() # Here b/c query take a long time, so low reported rate at start. 
                     
-                    row_i += 1
-                
-                    new_row = list(row[0:4]) + [ int(translators[i][str(v)]) for i,v in enumerate(row[4: ])]
+                    block = np.array(rows, dtype=np.int64)
+                    
+                    for i, translator in enumerate(translators):
+                        block[:,i+4] = translator.lookup(block[:,i+4])
         
-                    ins.insert(new_row)
+                    for new_row in block.tolist():
+                        ins.insert(new_row)
         
-                    if row_i % 10000 == 0:
+                    row_i += len(rows)
                            
-                            self.log("Reindex record_code "+
-                                     str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
+                    self.log("Reindex record_code "+
+                             str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
             except Exception as e:
                 self.error("Reindex error for table {} : {} ".format(rcp.table.name, str(e)))
              
@@ -558,25 +636,22 @@ class UsCensusDimBundle(UsCensusBundle):
         '''Copy all of the seperate partitions into the main database. '''
         
         # record-code partition hasn't been created yet. 
+        
+        partitions = self.geo_partition_map().values()
 
-        for partition in self.geo_partition_map().values():
-
-            self.log("Join partition {}".format(partition.identity.name))
-            
+        for partition in partitions:
             if not partition.database.exists():
                 self.log("   Creating partition {}".format(partition.identity.name))
                 partition.create_with_tables(partition.table.name)
             
-            table_name = partition.table.name
-            
-            self.database.create_table(table_name)    
-            self.database.clean_table(table_name)
-            
-            attach_name = self.database.attach(partition, table_name)
-            
-            self.database.copy_from_attached(table_name, name=attach_name)
+        rows, size = self.database.merge_partitions(partitions)
+        
+        self.log("Joined {} partitions, {} rows".format(len(partitions), rows))
 
-            self.database.detach(attach_name)
+    def load_geo_dim_id(self, p_id):
+        '''Run load_geo_dim() for a partition, referenced by id, so the task
+        arguments don't change between runs'''
+        return self.load_geo_dim(self.partitions.get(p_id))
 
     def load_geo_dim(self, partition):
         """Assemble the partition into the database partition, 
@@ -584,21 +659,21 @@ class UsCensusDimBundle(UsCensusBundle):
         recno.
         
         The output is one database partition for each of the geodim table, and
-        one dbm file for each geodim that maps hash to primary key. 
+        one hash index for each geodim that maps hash to primary key. 
+        
+        The hash column of the state tempfiles is read first, into NumPy arrays, 
+        to find the first row for each distinct hash and number them. Then the 
+        tempfiles are read again to insert those rows. 
         """
         import time
+        import numpy as np
+        from databundles.database import dedup_hashes
 
         t_start = time.time()
 
         table_name = partition.table.name
         
-        marker_f = self.filesystem.build_path('markers',"join_geo_dim_"+table_name)
-
-        if os.path.exists(marker_f):
-            self.log("Geo database marker exists for {}, skipping".format(partition.table.name))
-            return partition.identity.name
-        else:
-            self.log("load geo dim for {}".format(partition.table.name))
+        self.log("load geo dim for {}".format(partition.table.name))
 
         if table_name == 'record_code':
             force = True # Write all rows, not just hash unique ones. 
@@ -609,66 +684,68 @@ class UsCensusDimBundle(UsCensusBundle):
         else:
             force = False
 
-        hash_set = set()
+        def state_rows(state):
+            tf = partition.database.tempfile(partition.table, suffix=state)
+            reader = tf.linereader
+            reader.next() # skip the header. 
+            for row in reader:
+                yield row
+            tf.close()
+
+        hash_index = partition.database.hash_index(partition.table)
+        hash_index.delete()
+
+        if not force:
+            hashes = np.concatenate([np.fromiter((int(row[-1]) for row in state_rows(state)), dtype=np.int64) 
+                                     for state in self.states] or [np.array([], dtype=np.int64)])
+            
+            first, unique, keys = dedup_hashes(hashes)
+            
+            del hashes
+            
+            # Map the hash to the pkey, to update record_code later. 
+            hash_index.write(unique, keys)
+            
+            n_unique = len(unique)
+
+            self.log("Dedup "+table_name+" "+str(len(first))+" rows to "+str(n_unique)+" in "+
+                     str(int(time.time()-t_start))+'s')
+
         row_i = 0;
         primary_key = 0;
         
-        partition.database.dbm(partition.table).delete()
-        dbm = partition.database.dbm(partition.table).writer
-        
-        with partition.database.inserter(partition.table) as ins:
+        # The indexes are dropped for the load and built in one pass at the end
+        with partition.database.inserter(partition.table, defer_indexes=True) as ins:
             try:
                 for state in self.states:
-                    tf = partition.database.tempfile(partition.table, suffix=state)
-                   
-                    reader = tf.linereader
-                    reader.next() # skip the header. 
-                    line_no = 0
-                  
-                    for row in reader:
+                    for row in state_rows(state):
                         row_i += 1
-                        line_no += 1
         
                         if row_i % 100000 == 0:
                             self.log("Join "+table_name+" "+state+" "+
                                  str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
                             
-                        # The record_code tables doesn't use the hash for a primary lkey
-                        if not row[0]: row[0] = row_i
-    
-                        if force: # For the record_code partition, write all rows. 
-                            primary_key += 1     
-                            row[0] = primary_key
-                            
-                            ins.insert(row) # Insert into the partition database. 
-                            
-                        elif row[-1] not in hash_set:
-                            # Set the primary key for the row. 
+                        # For the record_code partition, write all rows. Otherwise, 
+                        # only the first row for each hash
+                        if force or first[row_i-1]: 
+                            # Set the primary key for the row. Keys are numbered in
+                            # the order of first occurrence, same as the hash index
                             primary_key += 1     
                             row[0] = primary_key
                             
                             ins.insert(row) # Insert into the partition database. 
-                       
-                            hash_set.add(row[-1])
-                            dbm[row[-1]] = primary_key # Map the hash to the pkey, to update record_code later. 
                             
-                    tf.close()     
             except Exception as e:
                 self.error("Error: "+str(e))
                 raise
 
-            dbm.close()
-
         self.log("Hash "+table_name+" "+str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
                     
-        if row_i != len(hash_set):
+        if not force and row_i != n_unique:
             self.error("{}: hash map doesn't match number of input rows: {} != {}"
-                       .format(partition.table.name, len(hash_set), row_i))
-
-        with open(marker_f, 'w') as f:
-            f.write(str(time.time()))
+                       .format(partition.table.name, n_unique, row_i))
 
-        self.log("Joined geo dim table: {} len = {}".format(partition.table.name,len(hash_set)))
+        self.log("Joined geo dim table: {} len = {}".format(partition.table.name, primary_key))
         
         return partition.identity.name
 
@@ -843,6 +920,10 @@ class UsCensusDimBundle(UsCensusBundle):
 
 class UsCensusFactBundle(UsCensusBundle):
     
+    RANGE_MAP_CACHE = 'range_map.pickle'
+    
+    _range_map = None
+    
     #####################################
     # Peparation
     #####################################
@@ -855,7 +936,13 @@ class UsCensusFactBundle(UsCensusBundle):
 
         self.create_fact_table_schema()
       
-        self.make_range_map()
+        self._range_map = self.make_range_map()
+
+        # First install the bundle main database into the library
+        # so all of the tables will be there for installing the
+        # partitions. 
+        self.log("Install bundle")
+        self.library.put(self)
 
         self.generate_partitions()
  
@@ -969,51 +1056,106 @@ class UsCensusFactBundle(UsCensusBundle):
     # Build 
     #############################################
     
-    def build(self,  run_state_tables_f=None,run_fact_db_f=None):
+    def build(self):
         '''Create data  partitions. 
         First, creates all of the state segments, one partition per segment per 
-        state. Then creates a partition for each of the geo files. '''
-        from multiprocessing import Pool
+        state. Then creates a partition for each of the geo files. 
+        
+        As for UsCensusDimBundle, the phases run as tasks in self.tasks. '''
 
         if self.run_args.subphase in ['test']:
             print self.states
             print self.states_dict
+            return True
          
- 
+        tasks = self.build_tasks()
+        
+        if self.run_args.subphase == 'all':
+            subphases = ['fact', 'load-fact']
+        else:
+            subphases = [self.run_args.subphase]
+
+        names = [ name for subphase in subphases for name in tasks.group(subphase) ]
+
+        if not self.run_args.multi and 'fact' in subphases:
+            self.prefetch_geos()
+        
+        tasks.run(names, processes=self.run_args.multi)
+        
+        tasks.report()
+              
+        return True
+
+    def build_tasks(self):
+        '''Add the tasks for the build phases to the task graph.'''
+        
+        tasks = self.tasks
+        
+        if tasks.tasks:
+            return tasks
+        
         # Combine the geodim tables with the  state population tables, and
         # produce .csv files for each of the tables. 
-        if self.run_args.subphase in ['all','fact']:   
-            if self.run_args.multi and run_state_tables_f:
-                
-                pool = Pool(processes=int(self.run_args.multi))
-          
-                result = pool.map_async(run_state_tables_f, enumerate(self.urls['geos'].keys()))
-                print result.get()
-            else:
-                for state in self.states:
-                    self.log("Building fact tables for {}".format(state))
-                    self.build_run_state_tables(state)
-      
-      
+        for state in self.states:
+            tasks.add('fact-'+state, self.build_run_state_tables, (state,),
+                      inputs=[self.filesystem.meta_path(self.RANGE_MAP_CACHE)],
+                      outputs=[self.state_tables_marker(state)],
+                      group='fact')
+            
         # Load all of the fact table tempfiles into the fact table databases
         # and store the databases in the library. 
-        if self.run_args.subphase in ['all','load-fact']:  
-            if self.run_args.multi and run_fact_db_f:
-                pool = Pool(processes=int(self.run_args.multi))
-                
-                result = pool.map_async(run_fact_db_f, [ (n,table.id_) for n, table in enumerate(self.fact_tables())])
-                print result.get()
-            else:
-                for table in self.fact_tables():
-                    self.run_fact_db(table.id_)
-              
-        return True
+        for table in self.fact_tables():
+            tasks.add('load-fact-'+table.name, self.run_fact_db, (table.id_,),
+                      depends=tasks.group('fact'),
+                      group='load-fact')
+            
+        tasks.import_markers({ 'fact-'+state: self.state_tables_marker(state) for state in self.states })
+            
+        return tasks
+
+    @property
+    def range_map(self):
+        '''The map of segment numbers to the column ranges of the tables in 
+        each segment. Loaded once per process. Reading it only computes the
+        map and writes its cache; prepare() installs the bundle. '''
+        
+        if self._range_map is None:
+            self._range_map = self.make_range_map()
+            
+        return self._range_map
+
+    def schema_hash(self):
+        '''Return an MD5 of the table and column records of the schema. The
+        data fields are hashed as they are stored, without decoding them. '''
+        import hashlib
+        
+        m = hashlib.md5()
+        conn = self.database.connection
+        
+        for row in conn.execute("SELECT t_id, t_name, t_data FROM tables ORDER BY t_id"):
+            m.update(repr(tuple(row)))
+            
+        for row in conn.execute("SELECT c_id, c_t_id, c_data FROM columns ORDER BY c_id"):
+            m.update(repr(tuple(row)))
+            
+        return m.hexdigest()
 
     def make_range_map(self):
+        '''Return the range map, from the pickle cache if it was made for the 
+        current schema, or by computing it from the schema and writing the 
+        cache. The cache is in the meta directory, so it survives clean(). '''
+        import cPickle
         
-        if os.path.exists(self.rangemap_file):
-            self.log("Re-using range map")
-            return
+        cache_file = self.filesystem.meta_path(self.RANGE_MAP_CACHE)
+        schema_hash = self.schema_hash()
+        
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                cached_hash, range_map = cPickle.load(f)
+                
+            if cached_hash == schema_hash:
+                self.log("Re-using range map")
+                return range_map
 
         self.log("Making range map")
 
@@ -1023,16 +1165,19 @@ class UsCensusFactBundle(UsCensusBundle):
        
         for table in self.schema.tables:
             
-            if table.data.get("split_table", False) or table.name == 'geofile':
+            data = table.data
+            
+            if data.get("split_table", False) or table.name == 'geofile':
                 # Don't look at geo dim tables
                 continue;
    
-            if segment != int(table.data['segment']):
+            if segment != int(data['segment']):
                 last_col = 4
-                segment = int(table.data['segment'])
+                segment = int(data['segment'])
             
-            col_start = min(int(c.data['source_col']) for c in table.columns if c.data.get('source_col', False))
-            col_end = max(int(c.data['source_col']) for c in table.columns if c.data.get('source_col', False))
+            source_cols = [ int(c.data['source_col']) for c in table.columns if c.data.get('source_col', False) ]
+            col_start = min(source_cols)
+            col_end = max(source_cols)
         
             if segment not in range_map:
                 range_map[segment] = {}
@@ -1042,12 +1187,6 @@ class UsCensusFactBundle(UsCensusBundle):
                                 'end':last_col + col_end+ 1, 
                                 'length': col_end-col_start + 1,
                                 'table' : table.name.encode('ascii', 'ignore')}
-            
-                         
-            #print "{:5s} {:4d} {:4d} {:4d} {:4d}".format(table.name,  int(segment), col_end-col_start + 1, 
-            #                                        last_col + col_start, last_col + col_end  )
-
-            #print range_map[segment][table.id_.encode('ascii', 'ignore')]
          
             last_col += col_end
             
@@ -1056,17 +1195,18 @@ class UsCensusFactBundle(UsCensusBundle):
     
         self.ptick('\n')
 
-        with open(self.rangemap_file, 'w')as f:
-            yaml.dump(range_map, f,indent=4, default_flow_style=False)  
-
-
-        # First install the bundle main database into the library
-        # so all of the tables will be there for installing the
-        # partitions. 
-        self.log("Install bundle")
-        self.library.put(self)
+        with open(cache_file+'.tmp', 'wb') as f:
+            cPickle.dump((schema_hash, range_map), f, cPickle.HIGHEST_PROTOCOL)
+            
+        os.rename(cache_file+'.tmp', cache_file)
        
+        return range_map
 
+    def state_tables_marker(self, state):
+        '''Path of the file written when the fact tempfiles for a state are
+        complete. It is the output of the state's task, rather than the 
+        tempfiles, because run_fact_db() deletes those when it loads them. '''
+        return self.filesystem.build_path('markers',"run_state_stable_"+state)
 
     def build_run_state_tables(self, state):
         '''Split up the segment files into seperate tables, and link in the
@@ -1075,81 +1215,158 @@ class UsCensusFactBundle(UsCensusBundle):
 
         fact_partitions = self.fact_partition_map()
        
-        with open(self.rangemap_file, 'r') as f:
-            range_map = yaml.load(f) 
+        range_map = self.range_map
         
-        # Marker to note when the file is done. 
-        marker_f = self.filesystem.build_path('markers',"run_state_stable_"+state)
+        self.log("Building fact tables for {}".format(state))
+
+        marker_f = self.state_tables_marker(state)
         
         if os.path.exists(marker_f):
-            self.log("state table complete for {}, skipping ".format(state))
-            return
-        else:
-            # If it isn't done, remove it if it exists. 
-            for partition in fact_partitions.values():
-                tf = partition.database.tempfile(partition.table, suffix=state)
-                tf.delete()
+            os.remove(marker_f)
+
+        # Remove the tempfiles from an earlier, incomplete run
+        for partition in fact_partitions.values():
+            tf = partition.database.tempfile(partition.table, suffix=state)
+            tf.delete()
+  
+        def tempfile_f(table_id):
+            table = self.get_table_by_table_id(table_id)
+            return fact_partitions[table_id].database.tempfile(table, suffix=state)
   
+        rows = self.write_fact_tables(self.build_generate_blocks(state, geodim=True ), 
+                                      range_map, tempfile_f, state)
+
+        for table_id in fact_partitions.keys():
+            tempfile_f(table_id).close()
+
+        with open(marker_f, 'w') as f:
+            f.write(str(time.time()))
+
+        return rows
+
+    def compile_fact_plan(self, range_map, tempfile_f, n_keys):
+        '''Resolve the tempfile writers and column ranges for the tables of each
+        segment, so they are looked up once per state, rather than for every 
+        record. Returns a dict of segment number to a list of 
+        (writer, start, end) tuples. 
+        
+        :param tempfile_f: function that returns the TempFile for a table id
+        :param n_keys: number of geo key columns that are written before the 
+            segment columns 
+        '''
+        
+        plan = {}
+        for seg_number, tables in range_map.items():
+            plan[seg_number] = []
+            for table_id, range in tables.iteritems(): #@ReservedAssignment
+                
+                if range['end'] <= range['start']:
+                    self.log("Seg {}, table {}  is empty".format(seg_number, table_id))
+                    continue
+                
+                tf = tempfile_f(table_id)
+                
+                if n_keys + range['end'] - range['start'] != len(tf.header):
+                    self.error("Fact Table write error. Value not same length as header")
+                    print "Header : ",len(tf.header), tf.header
+                    print "Values : ",n_keys + range['end'] - range['start']
+                    print "Range  : ",seg_number, range
+                
+                plan[seg_number].append((tf.writer, range['start'], range['end']))
+                
+        return plan
+
+    def write_fact_tables(self, blocks, range_map, tempfile_f, state):
+        '''Write the segment columns in the blocks from build_generate_blocks() to
+        the fact table tempfiles, following a plan from compile_fact_plan(). 
+        Returns the number of records '''
+        import time
+        
         row_i = 0
+        plan = None
+        t_start = time.time()
 
-        for state, logrecno, geo, segments, geo_keys in self.build_generate_rows(state, geodim=True ): #@UnusedVariable
- 
-            if row_i == 0:
-                t_start = time.time()
+        for state, logrecnos, geos, segments, geodims in blocks: #@UnusedVariable
       
-            row_i += 1
+            row_i += len(logrecnos)
             
-            if row_i % 10000 == 0:
-                # Prints a number representing the processing rate, 
-                # in 1,000 records per sec.
-                self.log("Fact "+state+" "+str(int( row_i/(time.time()-t_start)))+'/s '+str(row_i/1000)+"K ")
+            # Prints a number representing the processing rate, 
+            # in 1,000 records per sec.
+            self.log("Fact "+state+" "+str(int( row_i/(time.time()-t_start+.001)))+'/s '+str(row_i/1000)+"K ")
        
-            for seg_number, segment in segments.items():
-                for table_id, range in range_map[seg_number].iteritems(): #@ReservedAssignment
-                    
-                    table = self.get_table_by_table_id(table_id)
-
-                    if not segment:
-                        #Some segments have fewer lines than others. 
-                        #self.error("Failed to get segment data for {}".format(seg_number))
-                        continue
-                    
-                    seg = segment[range['start']:range['end']]
-                    
-                    if seg and len(seg) > 0:    
-                        # The values can be null for the PCT tables, which don't 
-                        # exist for some summary levels.       
-                        values =  (geo_keys[0],) + geo_keys[3:-1] + tuple(seg) # Remove the state, logrec  and hash from the geo_key  
-                        partition = fact_partitions[table_id]
-                        tf = partition.database.tempfile(table, suffix=state)
-
-                        if len(values) != len(tf.header):
-                            self.error("Fact Table write error. Value not same length as header")
-                            print "Segment: ", segment, state, logrecno
-                            print "Header : ",len(tf.header), table.name, tf.header
-                            print "Values : ",len(values), values
-                            print "Range  : ",seg_number, range
-                        
-                        tf.writer.writerow(values)
-                    
-                    else:
-                        self.log("{} {} Seg {}, table {}  is empty".format(state, logrecno,  seg_number, table_id))
-
-        #
-        # Write the values to tempfiles. 
-        # 
-
-        for table_id, partition in fact_partitions.items():
+            # The geo key columns, without the state, logrec  and hash
+            geo_columns = zip(*geodims)
+            key_columns = [geo_columns[0]] + geo_columns[3:-1]
             
-            table = self.get_table_by_table_id(table_id)
-            tf = partition.database.tempfile(table, suffix=state)
-                            
-            tf.close()
+            if plan is None:
+                plan = self.compile_fact_plan(range_map, tempfile_f, len(key_columns))
+       
+            for seg_number, block in segments.items():
+                
+                if not block:
+                    #Some segments have fewer lines than others. 
+                    continue
+                
+                indexes, columns = block
+                
+                # The PCT tables don't have rows for some summary levels, 
+                # so select the keys for the rows that the segment has. 
+                if len(indexes) == len(logrecnos):
+                    keys = key_columns
+                else:
+                    keys = [ [ c[i] for i in indexes ] for c in key_columns ]
+                
+                for writer, start, end in plan[seg_number]:
+                    writer.writerows(zip(*(keys + columns[start:end])))
 
-        with open(marker_f, 'w') as f:
-            f.write(str(time.time()))
+        return row_i
 
-    
+    def benchmark_fact_tables(self, state=None):
+        '''Report the records per second for building the fact tables for one
+        state, for reading the blocks alone and for reading and running the
+        write plan, with the tempfile writes discarded. Run on the first of 
+        the selected states with: 
+        
+            python bundle.py -S CA run benchmark_fact_tables
+        '''
+        import time
+        
+        if state is None:
+            state = self.states[0]
+        
+        range_map = self.range_map
+
+        class NullWriter(object):
+            def writerows(self, rows):
+                for row in rows: #@UnusedVariable
+                    pass
+                
+        class NullTempFile(object):
+            writer = NullWriter()
+            def __init__(self, table):
+                self.header = [ c.name for c in table.columns ]
+                
+        tempfiles = {}
+        def tempfile_f(table_id):
+            if table_id not in tempfiles:
+                tempfiles[table_id] = NullTempFile(self.get_table_by_table_id(table_id))
+            return tempfiles[table_id]
+        
+        t_start = time.time()
+        rows = 0
+        for block in self.build_generate_blocks(state, geodim=True):
+            rows += len(block[1])
+        t_read = time.time() - t_start + .001
+        
+        t_start = time.time()
+        rows = self.write_fact_tables(self.build_generate_blocks(state, geodim=True), 
+                                      range_map, tempfile_f, state)
+        t_write = time.time() - t_start + .001
+        
+        self.log("Benchmark {}: {} records. Read {:.0f} records/s; read and plan {:.0f} records/s"
+                 .format(state, rows, rows / t_read, rows / t_write))
+        
+        return rows / t_read, rows / t_write
 
     def run_fact_db(self, table_id):
         '''Load the fact table for a single table into a database and
@@ -0,0 +1,365 @@
+"""A graph of named build tasks, with declared inputs, outputs and dependencies.
+
+Completed tasks are recorded in a journal in the build directory, along with the
+content hashes of their inputs and their run times. A task is skipped when its
+journal record is still current, so an interrupted build resumes where it
+stopped. Tasks that don't depend on each other can run in a process pool.
+
+Copyright (c) 2013 Clarinova. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import os
+import json
+import time
+
+class Task(object):
+    '''A named unit of work: a call of f with args.
+
+    :param inputs: Paths of files the task reads. The task is re-run if their
+        content changes.
+    :param outputs: Paths of files the task writes. The task is re-run if any
+        of them is missing.
+    :param depends: Names of tasks that must run before this one.
+    :param group: Name of the phase the task belongs to, for selecting
+        tasks and reporting times.
+    '''
+
+    def __init__(self, name, f, args=(), inputs=None, outputs=None, depends=None, group=None):
+        self.name = name
+        self.f = f
+        self.args = tuple(args)
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.depends = set(depends or [])
+        self.group = group
+
+    def __call__(self):
+        return self.f(*self.args)
+
+    def __repr__(self):
+        return "<task: {}; {}>".format(self.name, self.group)
+
+# The graph that is running tasks in a pool. The pool workers inherit it
+# when they are forked, so the tasks, which are usually bound methods of
+# the bundle, don't have to be pickled.
+_running_graph = None
+
+def _run_task(name):
+    '''Run a task in a pool worker and return its journal record'''
+    return _running_graph._execute(_running_graph.tasks[name])
+
+class TaskGraph(object):
+    '''Run tasks in dependency order, skipping those that are up to date'''
+
+    JOURNAL_FILE = 'tasks.journal'
+
+    def __init__(self, bundle, journal=None):
+        from collections import OrderedDict
+
+        self.bundle = bundle
+        self.journal_path = journal if journal else bundle.filesystem.build_path(self.JOURNAL_FILE)
+        self.tasks = OrderedDict()
+
+        self._journal = None
+        self._hashes = {}
+
+    def add(self, name, f, args=(), inputs=None, outputs=None, depends=None, group=None):
+        '''Add a task to the graph. See Task for the arguments. '''
+
+        if name in self.tasks:
+            raise ValueError("Task {} is already defined".format(name))
+
+        task = Task(name, f, args, inputs, outputs, depends, group)
+        self.tasks[name] = task
+
+        return task
+
+    def group(self, group):
+        '''Return the names of the tasks in a group'''
+        return [ t.name for t in self.tasks.values() if t.group == group ]
+
+    @property
+    def journal(self):
+        '''A dict of the latest journal record for each task, keyed by name'''
+
+        if self._journal is None:
+            self._journal = {}
+
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue # A partial line from an interrupted write
+
+                        self._journal[record['name']] = record
+
+        return self._journal
+
+    def _write_journal(self, record):
+
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(record)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.journal[record['name']] = record
+
+    def invalidate(self, names=None):
+        '''Mark tasks, or all tasks, as out of date, so they are run again'''
+
+        if names is None:
+            names = self.tasks.keys()
+
+        for name in names:
+            self._write_journal({'name': name, 'status': 'invalid', 'end': time.time()})
+
+    def file_hash(self, path):
+        '''Return the MD5 of the contents of a file. Cached on the size
+        and modification time of the file. '''
+        import hashlib
+
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+
+        if key not in self._hashes:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), ''):
+                    md5.update(chunk)
+
+            self._hashes[key] = md5.hexdigest()
+
+        return self._hashes[key]
+
+    def _args_hash(self, task):
+        import hashlib
+        return hashlib.md5(repr(task.args)).hexdigest()
+
+    def is_current(self, task):
+        '''Return True if the task has completed, and nothing it depends on
+        has changed since'''
+
+        record = self.journal.get(task.name)
+
+        if not record or record['status'] != 'done':
+            return False
+
+        if record['args'] != self._args_hash(task):
+            return False
+
+        # A dependency that has run again since this task ran
+        for name in task.depends:
+            dep = self.journal.get(name)
+            if not dep or record['depends'].get(name) != dep['end']:
+                return False
+
+        for path in task.outputs:
+            if not os.path.exists(path):
+                return False
+
+        inputs = record['inputs']
+
+        if set(inputs.keys()) != set(task.inputs):
+            return False
+
+        for path in task.inputs:
+            if not os.path.exists(path):
+                return False
+
+            size, mtime, md5 = inputs[path]
+            stat = os.stat(path)
+
+            # Only re-hash files that look different
+            if (stat.st_size, stat.st_mtime) != (size, mtime) and self.file_hash(path) != md5:
+                return False
+
+        return True
+
+    def _record(self, task, start):
+        '''Return a journal record for a task, with the current state of its
+        inputs and dependencies'''
+
+        inputs = {}
+        for path in task.inputs:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                inputs[path] = [stat.st_size, stat.st_mtime, self.file_hash(path)]
+
+        record = {'name': task.name,
+                  'group': task.group,
+                  'args': self._args_hash(task),
+                  'inputs': inputs,
+                  'depends': { name: self.journal[name]['end']
+                              for name in task.depends if name in self.journal },
+                  'start': start,
+                  'pid': os.getpid()}
+
+        return record
+
+    def _execute(self, task):
+        '''Run a task and return its journal record. Exceptions are recorded
+        in the record, rather than raised. '''
+
+        start = time.time()
+
+        record = self._record(task, start)
+
+        try:
+            task()
+            record['status'] = 'done'
+        except Exception as e:
+            self.bundle.error("Task {} failed: {}".format(task.name, e))
+            record['status'] = 'failed'
+            record['error'] = str(e)
+
+        record['end'] = time.time()
+        record['time'] = record['end'] - start
+
+        return record
+
+    def import_markers(self, markers):
+        '''Record tasks as done for the marker files written by builds
+        that ran before there was a journal, so those builds resume rather
+        than start over. markers is a dict of task names to marker paths.
+
+        Only done when the journal doesn't exist yet. Returns the names of
+        the tasks that were recorded. '''
+        from databundles.util import toposort
+
+        if os.path.exists(self.journal_path):
+            return []
+
+        names = set( name for name, path in markers.items()
+                     if name in self.tasks and os.path.exists(path) )
+
+        # Record dependencies first, so their end times are in the records
+        # of the tasks that depend on them.
+        graph = { name: self.tasks[name].depends & names for name in names }
+
+        imported = []
+        for wave in toposort(graph):
+            for name in sorted(wave):
+                now = time.time()
+                record = self._record(self.tasks[name], now)
+                record.update({'status': 'done', 'end': now, 'time': 0.0, 'imported': True})
+                self._write_journal(record)
+                imported.append(name)
+
+                self.bundle.log("Task {} was done by an earlier build".format(name))
+
+        return imported
+
+    def _closure(self, names):
+        '''Return the named tasks and all of their dependencies'''
+        needed = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            if name in needed:
+                continue
+
+            if name not in self.tasks:
+                raise ValueError("Unknown task: {}".format(name))
+
+            needed.add(name)
+            stack.extend(self.tasks[name].depends)
+
+        return needed
+
+    def run(self, names=None, processes=None, force=False):
+        '''Run the named tasks, or all of the tasks, along with any of their
+        dependencies that are not up to date.
+
+        Each set of tasks that don't depend on each other is run in a pool of
+        processes, if processes is greater than 1. The pool is forked from
+        this process, and the bundle database is closed first, so the workers
+        open their own connections.
+
+        Returns the names of the tasks that ran. Raises ProcessError if any of
+        them failed. '''
+        from databundles.util import toposort
+        from databundles.dbexceptions import ProcessError
+        global _running_graph
+
+        if names is None:
+            names = self.tasks.keys()
+
+        needed = self._closure(names)
+
+        if not needed:
+            return []
+
+        graph = { name: set(self.tasks[name].depends) for name in needed }
+
+        ran = []
+        for wave in toposort(graph):
+
+            todo = [ n for n in self.tasks.keys() if n in wave and (force or not self.is_current(self.tasks[n])) ]
+
+            for name in wave:
+                if name not in todo:
+                    self.bundle.log("Task {} is up to date, skipping".format(name))
+
+            if not todo:
+                continue
+
+            if processes and processes > 1 and len(todo) > 1:
+                from multiprocessing import Pool
+
+                self.bundle.database.close()
+
+                _running_graph = self
+                try:
+                    pool = Pool(processes=processes)
+                    try:
+                        records = pool.map(_run_task, todo, chunksize=1)
+                    finally:
+                        pool.close()
+                        pool.join()
+                finally:
+                    _running_graph = None
+            else:
+                records = []
+                for name in todo:
+                    self.bundle.log("Running task {}".format(name))
+                    records.append(self._execute(self.tasks[name]))
+
+            for record in records:
+                self._write_journal(record)
+
+            ran.extend(todo)
+
+            failed = [ r for r in records if r['status'] != 'done' ]
+
+            if failed:
+                raise ProcessError("Tasks failed: "+ ", ".join(
+                                   "{} ({})".format(r['name'], r.get('error')) for r in failed))
+
+        return ran
+
+    def timings(self):
+        '''Return (name, group, seconds) for each completed task in the
+        journal, slowest first'''
+
+        t = [ (r['name'], r.get('group'), r['time'])
+              for r in self.journal.values() if r['status'] == 'done' ]
+
+        return sorted(t, key=lambda x: x[2], reverse=True)
+
+    def report(self):
+        '''Log the total run time of the tasks in each group, and the
+        slowest tasks'''
+
+        groups = {}
+        for name, group, t in self.timings():
+            n, total = groups.get(group, (0, 0.0))
+            groups[group] = (n + 1, total + t)
+
+        for group, (n, total) in sorted(groups.items(), key=lambda x: x[1][1], reverse=True):
+            self.bundle.log("{}: {} tasks, {:.1f}s".format(group, n, total))
+
+        for name, group, t in self.timings()[:10]:
+            self.bundle.log("    {}: {:.1f}s".format(name, t))
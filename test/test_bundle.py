@@ -143,6 +143,52 @@ class Test(TestBase):
         self.assertEqual("source-dataset-subset-variation-ca0d-r1", dbb.identity.vname)
         self.assertEqual("source-dataset-subset-variation-ca0d", dbb.config.identity.name)
 
+        dbb = DbBundle(db_path, read_only=True)
+
+        self.assertTrue(dbb.database.read_only)
+        self.assertEqual("source-dataset-subset-variation-ca0d", dbb.identity.name)
+
+        for p in dbb.partitions:
+            self.assertTrue(p.database.read_only)
+
+        with self.assertRaises(Exception):
+            dbb.database.connection.execute("CREATE TABLE read_only_test (a INTEGER)")
+
+    def test_db_config(self):
+
+        from databundles.bundle import DbBundle
+
+        b = self.bundle
+
+        dbc = b.db_config
+        self.assertIs(dbc, b.db_config)
+        self.assertEqual('bundle', dbc.info.type)
+
+        # set_value writes through to the cached values
+        values = dbc._get_values()
+        dbc.set_value('test', 'key', 'value1')
+        self.assertIs(values, dbc._get_values())
+        self.assertEqual('value1', dbc.get_value('test', 'key'))
+
+        with self.assertRaises(ValueError):
+            dbc.set_value('identity', 'name', 'foo')
+
+        # Other instances see the change when they load
+        dbb = DbBundle(b.database.path)
+        self.assertEqual('value1', dbb.db_config.get_value('test', 'key'))
+
+        dbc.invalidate()
+        self.assertIsNot(values, dbc._get_values())
+        self.assertEqual('value1', dbc.get_value('test', 'key'))
+
+        # Partitions.get() closes the session, which detaches the objects
+        # loaded from it
+        b.partitions.get(b.partitions.all[0].identity.id_)
+        self.assertIs(dbc, b.db_config)
+        dbc.set_value('test', 'key', 'value2')
+        self.assertEqual('value2', dbc.get_value('test', 'key'))
+        self.assertEqual(b.identity.id_, dbc.dict['identity']['id'])
+
     def test_paths(self):
         
         from databundles.bundle import BuildBundle, DbBundle
@@ -161,7 +207,97 @@ class Test(TestBase):
         for p in zip(b.partitions, db.partitions):
             self.assertEqual(p[0].path, p[1].path)
             self.assertTrue(p[0].path)
-                
+
+    def test_unzip(self):
+        import zipfile, re
+
+        fs = self.bundle.filesystem
+        zip_path = fs.build_path('test_unzip.zip')
+
+        contents = dict( ('file{}.txt'.format(i), 'contents {}\n'.format(i)*1000) for i in range(4))
+
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, data in contents.items():
+                zf.writestr(name, data)
+
+        zip_hash = fs.zip_hash(zip_path)
+
+        # Force the threaded extraction
+        fs.PARALLEL_EXTRACT_SIZE = 0
+
+        paths = list(fs.unzip_dir(zip_path))
+        self.assertEquals(4, len(paths))
+
+        for p in paths:
+            self.assertIn(zip_hash, p)
+            with open(p) as f:
+                self.assertEquals(contents[os.path.basename(p)], f.read())
+
+        # Second time, the files come from the cache
+        self.assertEquals(paths, list(fs.unzip_dir(zip_path)))
+
+        self.assertEquals(1, len(list(fs.unzip_dir(zip_path, re.compile(r'file2')))))
+
+        with fs.unzip_stream(zip_path, re.compile(r'file3')) as f:
+            self.assertEquals(contents['file3.txt'], f.read())
+
+    def test_download(self):
+        import zipfile, threading, uuid
+        import SimpleHTTPServer, SocketServer
+        from databundles.filesystem import DownloadFailedError
+
+        fs = self.bundle.filesystem
+
+        # Serve a directory of zip files from a local server
+        serve_dir = fs.build_path('test_download')
+        if not os.path.exists(serve_dir):
+            os.makedirs(serve_dir)
+
+        names = []
+        for i in range(3):
+            name = 'f{}-{}.zip'.format(i, uuid.uuid4())
+            with zipfile.ZipFile(os.path.join(serve_dir, name), 'w') as zf:
+                zf.writestr('data.txt', 'data {}\n'.format(i)*1000)
+            names.append(name)
+
+        with open(os.path.join(serve_dir, 'bad.zip'), 'w') as f:
+            f.write('not a zip file')
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(serve_dir, os.path.basename(path))
+            def log_message(self, *args):
+                pass
+
+        server = SocketServer.TCPServer(('localhost', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+
+        try:
+            base = 'http://localhost:{}/'.format(server.server_address[1])
+            urls = [ base+name for name in names ]
+
+            fs.download_manager.backoff = 0
+            fs.download_manager.max_bytes = 1 # Force downloads to run one at a time
+            fs.prefetch(urls, 'zip')
+
+            for url in urls:
+                path = fs.download(url)
+                self.assertTrue(zipfile.is_zipfile(path))
+                self.assertFalse(fs.download_manager.has(url))
+
+            # Now they come from the cache
+            self.assertEquals(path, fs.download(urls[-1], 'zip'))
+
+            fs.prefetch([base+'bad.zip'], 'zip')
+            with self.assertRaises(DownloadFailedError):
+                fs.download(base+'bad.zip')
+
+            fs.download_manager.close()
+        finally:
+            server.shutdown()
+
     def test_schema_direct(self):
         '''Test adding tables directly to the schema'''
         
@@ -190,7 +326,50 @@ class Test(TestBase):
         self.assertIn('d1DxuZ0a01', [c.id_ for c in t.columns])
         self.assertIn('d1DxuZ0a02', [c.id_ for c in t.columns])
         self.assertIn('d1DxuZ0a03', [c.id_ for c in t.columns])
-        
+
+    def test_schema_catalog(self):
+        '''Test the cached tables and metadata of the schema catalog'''
+        from databundles import orm
+        from databundles.orm import Column
+
+        s = self.bundle.schema
+
+        table = s.table('tone')
+        self.assertIs(table, s.table(table.id_))
+        self.assertIsNone(s.table('not_a_table'))
+
+        catalog = s.catalog
+        self.assertIs(catalog, s.catalog)
+
+        # Metadata is generated once
+        self.assertIs(s.get_table_meta('tone'), s.get_table_meta(table.id_))
+
+        entry = s.table_entry('tone')
+        self.assertEquals([c.name for c in table.columns], [c.name for c in entry.columns])
+        self.assertEquals(1, entry.column_index('text'))
+        self.assertEquals('DEFAULT', entry.column('text').default)
+
+        # Adding a table invalidates the catalog
+        t = s.add_table('catalog test')
+        self.assertIsNot(catalog, s.catalog)
+        self.assertIs(t, s.table('catalog_test'))
+
+        catalog = s.catalog
+        s.add_column(t,'col 1', datatype=Column.DATATYPE_INTEGER)
+        self.assertIsNot(catalog, s.catalog)
+        self.assertEquals(['col_1'], [c.name for c in s.table_entry('catalog_test').columns])
+
+        # So does adding a column directly to the table
+        meta = s.get_table_meta('catalog_test')
+        t.add_column('col 2', datatype=Column.DATATYPE_INTEGER)
+        self.assertIsNot(meta, s.get_table_meta('catalog_test'))
+        self.assertEquals(['col_1', 'col_2'], [c.name for c in s.table_entry('catalog_test').columns])
+
+        # But changes in other databases, like partitions, don't
+        catalog = s.catalog
+        orm._schema_changed(self.bundle.partitions.all[0].database.session)
+        self.assertIs(catalog, s.catalog)
+
     def test_generate_schema(self):
         '''Uses the generateSchema method in the bundle'''
         from databundles.orm import  Column
@@ -319,7 +498,15 @@ class Test(TestBase):
             else:
                 self.assertFalse(vd(row), "Test {} not 'false' for table '{}': {}".format(i+1, table_name,row))
 
-        
+        # The block validator should agree with the row validator
+        for and_join in (True, False):
+            for table_name in ('tone','ttwo','tthree','all'):
+                table =  self.bundle.schema.table(table_name);
+                rows = [ row for tn, _, row in tests if tn == table_name ]
+                vd =table._get_validator(and_join=and_join)
+                mask = table.validate_block(rows, and_join=and_join)
+                self.assertEquals([ vd(row) for row in rows ], mask.tolist())
+
         # Test the hash functions. This test depends on the d_test values in geoschema.csv
         tests =[
         ( 'tone','A|1|', (None,'A',1,2) ), 
@@ -424,6 +611,125 @@ class Test(TestBase):
             self.assertIn(pid.name, [p.name for p in parts])
 
         
+    def test_merge_partitions(self):
+
+        db = self.bundle.database
+
+        partitions = [ p for p in self.bundle.partitions.all
+                       if p.table and p.table.name in ('tone','ttwo','tthree') ]
+
+        self.assertEquals(3, len(partitions))
+
+        counts = {}
+        for p in partitions:
+            counts[p.table.name] = p.database.connection.execute(
+                        "SELECT count(*) FROM {}".format(p.table.name)).scalar()
+
+        # A batch size of 2 needs two batches of attachments
+        rows, size = db.merge_partitions(partitions, batch_size=2)
+
+        self.assertEquals(sum(counts.values()), rows)
+        self.assertTrue(size > 0)
+
+        for table_name, count in counts.items():
+            self.assertEquals(count, db.connection.execute(
+                        "SELECT count(*) FROM {}".format(table_name)).scalar())
+
+        self.assertEquals(0, len(db._attachments))
+
+        def index_sql():
+            return set( row[0] for row in db.connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('tone','ttwo','tthree') AND sql IS NOT NULL") )
+
+        indexes = index_sql()
+
+        # Without cleaning, the rows conflict with the ones already there. The
+        # conflict is the error raised, and the indexes are not re-created
+        # over a failed copy
+        with self.assertRaises(Exception) as cm:
+            db.merge_partitions(partitions, clean=False)
+
+        self.assertIn('UNIQUE', str(cm.exception).upper())
+        self.assertEquals(0, len(db._attachments))
+
+        for table_name, count in counts.items():
+            self.assertEquals(count, db.connection.execute(
+                        "SELECT count(*) FROM {}".format(table_name)).scalar())
+
+        unique = set( sql for sql in indexes if 'UNIQUE' in sql.upper() )
+        self.assertEquals(unique, index_sql())
+
+        for sql in indexes - unique:
+            db.connection.execute(sql)
+
+    def test_deferred_indexes(self):
+        import re
+        import random
+        from databundles.partition import PartitionIdentity
+
+        def index_names():
+            return set( row[0] for row in p.database.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'tone' AND sql IS NOT NULL") )
+
+        expected = set( re.search(r'INDEX "?(\w+)"? ON', sql).group(1) 
+                        for sql in self.bundle.schema.index_sql('tone') )
+        self.assertTrue(len(expected) > 0)
+
+        pid = PartitionIdentity(self.bundle.identity, table='tone', grain='deferred')
+        p = self.bundle.partitions.new_partition(pid)
+        p.create_with_tables('tone', clean=True, defer_indexes=True)
+
+        self.assertEquals(set(), index_names() & expected)
+
+        values = range(1, 1001)
+        random.shuffle(values)
+
+        # No tone_id, so the rowids are in the order the rows are written
+        with p.database.inserter('tone', sort=['integer'], defer_indexes=True) as ins:
+            for i in values:
+                ins.insert({'text': 'text'+str(i), 'integer': i, 'float': i})
+
+            self.assertEquals(set(), index_names() & expected)
+
+        self.assertEquals(expected, index_names() & expected)
+
+        ints = [ row[0] for row in p.database.connection.execute("SELECT integer FROM tone ORDER BY rowid") ]
+        self.assertEquals(range(1, 1001), ints)
+
+        # An existing table has its indexes dropped for the load, then rebuilt.
+        # The row is new, so it doesn't conflict with the unique index
+        with p.database.inserter('tone', defer_indexes=True) as ins:
+            self.assertEquals(set(), index_names() & expected)
+            ins.insert({'text': 'text1001', 'integer': 1001, 'float': 1001})
+
+        self.assertEquals(expected, index_names() & expected)
+        self.assertEquals(1001, p.database.connection.execute("SELECT count(*) FROM tone").scalar())
+
+    def test_hash_index(self):
+        from databundles.database import dedup_hashes
+
+        hashes = [30, 10, 30, 20, 10, 2**55]
+
+        first, unique, keys = dedup_hashes(hashes)
+
+        self.assertEquals([True, True, False, True, False, True], list(first))
+        self.assertEquals([10, 20, 30, 2**55], list(unique))
+        self.assertEquals([2, 3, 1, 4], list(keys))
+
+        hi = self.bundle.database.hash_index('tone')
+        hi.write(unique, keys)
+
+        self.assertTrue(hi.exists)
+        self.assertEquals(4, len(hi))
+        self.assertEquals([1, 2, 1, 3, 2, 4], list(hi.lookup(hashes)))
+        self.assertEquals(4, hi[str(2**55)])
+
+        with self.assertRaises(KeyError):
+            hi.lookup([15])
+
+        hi.delete()
+        self.assertFalse(hi.exists)
+
     def x_test_tempfile(self):
   
         self.test_generate_schema()
@@ -437,7 +743,93 @@ class Test(TestBase):
         
         for i in range(10):
             w.writerow([i,i,i])
-        
+
+    def test_tasks(self):
+        from databundles.tasks import TaskGraph
+        from databundles.dbexceptions import ProcessError
+
+        journal = self.bundle.filesystem.build_path('test-tasks.journal')
+        in_f = self.bundle.filesystem.build_path('test-tasks-input')
+        out_f = self.bundle.filesystem.build_path('test-tasks-output')
+
+        for f in (journal, out_f):
+            if os.path.exists(f):
+                os.remove(f)
+
+        with open(in_f, 'w') as f:
+            f.write('one')
+
+        calls = []
+
+        def write_output(v):
+            calls.append(('write', v))
+            with open(out_f, 'w') as f:
+                f.write(v)
+
+        def read_output():
+            calls.append(('read',))
+
+        def make_graph():
+            g = TaskGraph(self.bundle, journal=journal)
+            g.add('read', read_output, depends=['write'], group='second')
+            g.add('write', write_output, ('a',), inputs=[in_f], outputs=[out_f], group='first')
+            return g
+
+        g = make_graph()
+        self.assertEquals(['write', 'read'], g.run())
+        self.assertEquals([('write','a'), ('read',)], calls)
+
+        # A new graph resumes from the journal
+        g = make_graph()
+        self.assertEquals([], g.run())
+        self.assertEquals(['write'], g.group('first'))
+        self.assertEquals(set(['write','read']), set([ t[0] for t in g.timings()]))
+
+        # Touching the input without changing it doesn't re-run the task
+        import time
+        time.sleep(1)
+        with open(in_f, 'w') as f:
+            f.write('one')
+        self.assertEquals([], make_graph().run())
+
+        # Changing the input re-runs the task and its dependents
+        with open(in_f, 'w') as f:
+            f.write('two')
+        self.assertEquals(['write', 'read'], make_graph().run(['read']))
+
+        os.remove(out_f)
+        self.assertEquals(['write', 'read'], make_graph().run())
+
+        g = make_graph()
+        g.invalidate(['read'])
+        self.assertEquals(['read'], g.run())
+
+        def fail():
+            raise Exception("failed")
+
+        g = make_graph()
+        g.add('fail', fail)
+        with self.assertRaises(ProcessError):
+            g.run(['fail'])
+
+        self.assertEquals('failed', g.journal['fail']['status'])
+
+        # Markers from a build that ran before the journal existed
+        marker_f = self.bundle.filesystem.build_path('test-tasks-marker')
+        with open(marker_f, 'w') as f:
+            f.write('done')
+
+        os.remove(journal)
+        g = make_graph()
+        self.assertEquals(['write'], g.import_markers({'write': marker_f, 'read': marker_f+'-missing'}))
+        self.assertEquals(['read'], g.run())
+
+        # But only on the first run
+        g = make_graph()
+        g.invalidate(['write'])
+        self.assertEquals([], g.import_markers({'write': marker_f}))
+        self.assertEquals(['write', 'read'], g.run())
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Test))
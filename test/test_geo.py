@@ -94,6 +94,351 @@ class Test(TestBase):
         sfs1.close()
         sfs2.close()
 
+    def test_sfschema_batch(self):
+        import tempfile, shutil
+        from databundles.geo.sfschema import TableShapefile
+
+        rows = [ {'geot1_id': i, 'name': 'p{}'.format(i), 'code': i % 7,
+                  'lon': 500000 + i * 10.0, 'lat': 3700000 + i * 5.0 } for i in range(2500) ]
+
+        d = tempfile.mkdtemp()
+        try:
+            def features(path):
+                ds = ogr.Open(path)
+                layer = ds.GetLayer(0)
+                return [ (f.GetField('name'), f.GetField('code'), f.GetGeometryRef().ExportToWkt())
+                         for f in layer ]
+
+            path1 = os.path.join(d, 'single', 'geot1.shp')
+            with TableShapefile(self.bundle, path1, 'geot1', source_srs=26911) as sf:
+                for row in rows:
+                    sf.add_feature(row)
+
+            path2 = os.path.join(d, 'batch', 'geot1.shp')
+            with TableShapefile(self.bundle, path2, 'geot1', source_srs=26911) as sf:
+                self.assertEquals(len(rows), sf.add_features(iter(rows), transaction_size=1000))
+
+            f1 = features(path1)
+            self.assertEquals(len(rows), len(f1))
+            self.assertEquals(f1, features(path2))
+        finally:
+            shutil.rmtree(d)
+
+    def test_reproject(self):
+        import numpy as np
+
+        gp = self.bundle.partitions.new_geo_partition(table='geot1', grain='reproject')
+        gp.database.connection.execute("DELETE FROM geot1")
+
+        rs = np.random.RandomState(0)
+        lons = rs.uniform(-117.3, -116.9, 500)
+        lats = rs.uniform(32.6, 33.0, 500)
+
+        with gp.database.inserter(source_srs=4326) as ins:
+            for i, (lon, lat) in enumerate(zip(lons, lats)):
+                ins.insert({'geot1_id': i+1, 'name': 'p{}'.format(i), 'code': i, 'lon': lon, 'lat': lat})
+
+        ct = gp.get_transform(26911)
+        expected = [ ct.TransformPoint(lon, lat)[:2] for lon, lat in zip(lons, lats) ]
+
+        q = "SELECT lon, lat FROM geot1 ORDER BY geot1_id"
+
+        # The destination columns must be given
+        with self.assertRaises(ValueError):
+            gp.reproject(26911)
+
+        self.assertEquals(500, gp.reproject(26911, x_col='lon', y_col='lat', chunk_size=100))
+        self.assertTrue(np.allclose(expected, [ tuple(r) for r in gp.database.query(q) ]))
+
+        # The geometries are unchanged, so running in a pool gives the same result
+        self.assertEquals(500, gp.reproject(26911, x_col='lon', y_col='lat', chunk_size=100, processes=2))
+        self.assertTrue(np.allclose(expected, [ tuple(r) for r in gp.database.query(q) ]))
+
+    def test_combine_envelopes(self):
+        import databundles.geo as dg
+
+        def box(x, y, size=1):
+            return dg.create_bb((x, x+size, y, y+size), None)
+
+        # Two chains of overlapping boxes, and one box by itself
+        geos = [box(0,0), box(10,10), box(0.5,0.5), box(1.2,1.2), box(20,20), box(10.5, 10.5)]
+
+        combined = dg.combine_envelopes(geos, use_bb=False)
+        self.assertEquals(3, len(combined))
+        self.assertEquals((0, 2.2, 0, 2.2), combined[0].GetEnvelope())
+        self.assertEquals((10, 11.5, 10, 11.5), combined[1].GetEnvelope())
+
+        # A gap of 1 is joined by the distance
+        geos.append(box(12.5, 10))
+        self.assertEquals(4, len(dg.combine_envelopes(geos, use_bb=False)))
+        self.assertEquals(3, len(dg.combine_envelopes(geos, use_bb=False, use_distance=1.1)))
+
+        # The bounding box of a group can reach boxes that none of its members touch
+        geos = [box(0,0), box(0.9,0.9), box(1.5, 0.1, 0.2)]
+        self.assertEquals(2, len(dg.combine_envelopes(geos, use_bb=False)))
+        self.assertEquals(1, len(dg.combine_envelopes(geos, use_bb=True)))
+
+    def test_points_in_rings(self):
+        import numpy as np
+        from databundles.geo.util import geometry_rings, points_in_rings
+
+        # A square with a square hole, and a second square
+        g = ogr.CreateGeometryFromWkt("MULTIPOLYGON(((0 0,10 0,10 10,0 10,0 0),(4 4,6 4,6 6,4 6,4 4)),"
+                                      "((20 0,30 0,30 10,20 10,20 0)))")
+        rings = geometry_rings(g)
+        self.assertEquals(3, len(rings))
+
+        x = np.array([1, 5, 9, 15, 25, -1, 5])
+        y = np.array([1, 5, 9,  5,  5,  5, 11])
+
+        expected = [ g.Contains(ogr.CreateGeometryFromWkt("POINT({} {})".format(*p))) for p in zip(x, y) ]
+
+        self.assertEquals([True, False, True, False, True, False, False], expected)
+        self.assertEquals(expected, list(points_in_rings(x, y, rings)))
+
+    def test_classify_points(self):
+        from databundles.geo.util import classify_points
+
+        areas = self.bundle.partitions.new_geo_partition(table='geot2', grain='classify')
+        areas.database.connection.execute("DELETE FROM geot2")
+
+        with areas.database.inserter(source_srs=4326) as ins:
+            ins.insert({'geot2_id': 1, 'name': 'a', 'code': 10, 'wkt': "POLYGON((0 0,4 0,4 4,0 4,0 0))"})
+            ins.insert({'geot2_id': 2, 'name': 'b', 'code': 20, 'wkt': "POLYGON((6 6,10 6,10 10,6 10,6 6))"})
+
+        points = self.bundle.partitions.new_geo_partition(table='geot1', grain='classify')
+        points.database.connection.execute("DELETE FROM geot1")
+
+        expected = {}
+        with points.database.inserter(source_srs=4326) as ins:
+            for i in range(10):
+                for j in range(10):
+                    id_ = i * 10 + j + 1
+                    # One point in the first area already has a value
+                    code = 99 if (i, j) == (1, 1) else None
+                    ins.insert({'geot1_id': id_, 'name': str(id_), 'code': code, 'lon': i + .5, 'lat': j + .5})
+
+                    if code:
+                        expected[id_] = code
+                    elif i < 4 and j < 4:
+                        expected[id_] = 10
+                    elif i >= 6 and j >= 6:
+                        expected[id_] = 20
+                    else:
+                        expected[id_] = None
+
+        counts = classify_points(areas, points, places_query="SELECT *, AsText(geometry) AS wkt FROM geot2 ORDER BY geot2_id",
+                                 target_col='code', value_col='code', chunk_size=7)
+
+        self.assertEquals({'code': 31}, counts)
+
+        codes = dict( (row[0], row[1]) for row in points.database.connection.execute("SELECT geot1_id, code FROM geot1") )
+        self.assertEquals(expected, codes)
+
+        # Nothing is left to assign
+        self.assertEquals({'code': 0}, classify_points(areas, points,
+                          places_query="SELECT *, AsText(geometry) AS wkt FROM geot2 ORDER BY geot2_id",
+                          target_col='code', value_col='code'))
+
+    def test_tiled_kernel(self):
+        import numpy as np
+        import tempfile
+        from databundles.geo import Point
+        from databundles.geo.analysisarea import AnalysisArea
+        from databundles.geo.kernel import GaussianKernel
+
+        aa = AnalysisArea('test', 'CG0000000', 0, 1000, 0, 800, 0, 1, 0, 1,
+                          srid=26911, srswkt=None, scale=10)
+
+        self.assertEquals(12, len(list(aa.tiles(32))))
+
+        k = GaussianKernel(11, 6)
+
+        rs = np.random.RandomState(0)
+        x = rs.randint(0, aa.size_x, 200)
+        y = rs.randint(0, aa.size_y, 200)
+
+        a1 = aa.new_array()
+        for px, py in zip(x, y):
+            k.apply_add(a1, Point(px, py))
+
+        a2 = aa.apply_kernel(aa.new_array(), k, x, y, tile_size=32)
+        self.assertTrue(np.allclose(a1, a2))
+
+        with tempfile.NamedTemporaryFile() as f:
+            a3 = aa.apply_kernel(aa.new_array(path=f.name), k, x, y, tile_size=32, processes=2)
+            self.assertTrue(np.allclose(a1, a3))
+
+    def test_density_counts(self):
+        import numpy as np
+        from databundles.geo.density import DensityImage
+
+        def new_image():
+            d = DensityImage()
+            d.a = np.zeros((20, 30))
+            d.bin_scale = 10
+            d.x_offset_c = -50
+            d.y_offset_c = 30
+            return d
+
+        rs = np.random.RandomState(0)
+        x = rs.uniform(-4.9, -2.0, 1000)
+        y = rs.uniform(3.0, 4.9, 1000)
+        w = rs.uniform(0, 1, 1000)
+
+        d1 = new_image()
+        for px, py, pw in zip(x, y, w):
+            d1.add_count(px, py, pw)
+
+        d2 = new_image()
+        self.assertEquals(1000, d2.add_counts(x, y, w))
+        self.assertTrue(np.allclose(d1.a, d2.a))
+
+        # Points outside the image, or with missing values, are skipped
+        self.assertEquals(1, d2.add_counts([-4.0, 100, np.nan], [4.0, 4.0, 4.0]))
+        self.assertAlmostEqual(d1.a.sum() + 1, d2.a.sum())
+
+    def test_colormap_histogram(self):
+        import numpy as np
+        import tempfile
+        from databundles.geo.colormap import ArrayHistogram, write_colormap, get_colormap
+
+        # Three clusters of values, and zeros, which are ignored
+        rs = np.random.RandomState(0)
+        a = np.concatenate((rs.uniform(1, 2, 30000), rs.uniform(10, 11, 30000),
+                            rs.uniform(100, 101, 30000), np.zeros(10000)))
+        rs.shuffle(a)
+        a = a.reshape((500, 200))
+
+        v = a[a != 0]
+
+        # Small blocks, so the range of the bins has to grow
+        h = ArrayHistogram().add_array(a, block_size=1000)
+
+        self.assertEquals(90000, h.count)
+        self.assertEquals(90000, h.counts.sum())
+        self.assertEquals(v.min(), h.min)
+        self.assertEquals(v.max(), h.max)
+        self.assertAlmostEqual(v.mean(), h.mean)
+        self.assertAlmostEqual(v.std(), h.std)
+
+        # Every class boundary falls in a gap between the clusters
+        breaks = h.jenks_breaks(3)
+        self.assertEquals(4, len(breaks))
+        self.assertTrue(2 <= breaks[1] <= 10)
+        self.assertTrue(11 <= breaks[2] <= 100)
+
+        # The outer breaks are the range of the data, not the edges of the bins
+        self.assertEquals(h.min, breaks[0])
+        self.assertEquals(h.max, breaks[-1])
+
+        g = ArrayHistogram().add_array(rs.gamma(2, 2, 100000), block_size=1000)
+        breaks = g.jenks_breaks(5)
+        self.assertTrue(breaks[0] >= g.min > 0)
+        self.assertTrue(breaks[-1] <= g.max)
+
+        with tempfile.NamedTemporaryFile() as f:
+            for scheme in ('even', 'jenks', 'geometric', 'logistic', 'exponential', 'stddev'):
+                write_colormap(f.name, h, get_colormap('YlOrRd', 5), break_scheme=scheme)
+
+    def test_hdf5_geo_window(self):
+        import numpy as np
+        import tempfile, shutil
+        from databundles.hdf5 import Hdf5File
+        from databundles.geo.analysisarea import AnalysisArea
+
+        aa = AnalysisArea('test', 'CG0000000', 0, 6000, 0, 5000, 0, 1, 0, 1,
+                          srid=26911, srswkt=None, scale=10)
+
+        a = np.arange(aa.size_x * aa.size_y, dtype=float).reshape((aa.size_y, aa.size_x))
+
+        d = tempfile.mkdtemp()
+        try:
+            hdf = Hdf5File(os.path.join(d, 'geo.hdf5'))
+
+            ds = hdf.put_geo('a', a, aa)
+            self.assertEquals('lzf', ds.compression)
+            self.assertEquals((256, 256), ds.chunks)
+
+            for tile in aa.tiles(300):
+                self.assertTrue(np.array_equal(a[tile.core], hdf.get_geo_window('a', tile)))
+
+            # An envelope, in the area's coordinates
+            self.assertTrue(np.array_equal(a[10:20, 5:15], hdf.get_geo_window('a', (50, 150, 100, 200))))
+
+            ds = hdf.put_geo('b', a, aa, compression=None)
+            self.assertIsNone(ds.chunks)
+            m, _ = hdf.get_geo_mmap('b')
+            self.assertTrue(np.array_equal(a, m))
+
+            hdf.close()
+        finally:
+            shutil.rmtree(d)
+
+    def test_place_mask_cache(self):
+        import json
+        import numpy as np
+        import tempfile, shutil
+        from databundles.hdf5 import Hdf5File
+        from databundles.geo.analysisarea import AnalysisArea
+        import numpy.ma as ma
+        import databundles.datasets.geo as dsgeo
+
+        aa = AnalysisArea('test', 'CG0000000', 0, 6000, 0, 5000, 0, 1, 0, 1,
+                          srid=26911, srswkt=None, scale=10)
+
+        place = dsgeo.Place(None, {'code': 'test', 'srid': 26911, 'aa': json.dumps(aa.__dict__),
+                                   'wkt': 'POLYGON((1000 1000, 3000 1000, 3000 4000, 1000 4000, 1000 1000))'})
+
+        expected, _ = place._rasterize_mask(10)
+
+        dsgeo._masks.clear()
+
+        d = tempfile.mkdtemp()
+        try:
+            hdf = Hdf5File(os.path.join(d, 'masks.hdf5'))
+
+            # Rasterized, and saved in the cache
+            mask = place.mask(scale=10, cache=hdf)
+            self.assertTrue(np.array_equal(expected, mask))
+            self.assertFalse(mask.flags.writeable)
+
+            # Reused from memory
+            self.assertIs(mask, place.mask(scale=10, cache=hdf))
+
+            # Loaded from the cache file, memory mapped
+            dsgeo._masks.clear()
+            loaded = place._load_mask(hdf, ('test', 10, 26911))
+            self.assertTrue(isinstance(loaded, np.memmap) or isinstance(loaded.base, np.memmap))
+            self.assertEquals(expected.shape, loaded.shape)
+            self.assertTrue(np.array_equal(expected, loaded))
+
+            mask = place.mask(scale=10, cache=hdf)
+            self.assertTrue(np.array_equal(expected, mask))
+            self.assertFalse(mask.flags.writeable)
+
+            # A masked array of the mask can be assigned to, without changing
+            # the shared mask
+            a = place.mask(np.arange(mask.size, dtype=float).reshape(mask.shape), scale=10, cache=hdf)
+            a[1, 1] = 5
+            a[a > 3] = 0
+            a[2] = ma.masked
+            self.assertTrue(a.mask[2].all())
+            self.assertTrue(np.array_equal(expected, place.mask(scale=10, cache=hdf)))
+
+            # Least recently used masks are dropped
+            for i in range(dsgeo.MASK_CACHE_SIZE):
+                dsgeo._masks[('other', i, 0)] = mask
+            place.mask(scale=20)
+            self.assertNotIn(('test', 10, 26911), dsgeo._masks)
+            self.assertIn(('test', 20, 26911), dsgeo._masks)
+            self.assertEquals(dsgeo.MASK_CACHE_SIZE, len(dsgeo._masks))
+
+            hdf.close()
+        finally:
+            dsgeo._masks.clear()
+            shutil.rmtree(d)
+
 
 
 
@@ -40,6 +40,54 @@ class Test(TestBase):
                     print "  ", r['coded_address']
 
 
+    def test_index(self):
+        import tempfile, shutil
+        from databundles.geo.geocoder import Geocoder, GeocoderIndex
+
+        g1 = Geocoder(self.bundle.library)
+
+        d = tempfile.mkdtemp()
+        try:
+            index = GeocoderIndex.build(g1.addresses, os.path.join(d, 'geocoder.gcindex'))
+
+            g2 = Geocoder(self.bundle.library, index=index.path)
+            self.assertEquals(g1.by_name, g2.by_name)
+
+            def key(r):
+                return tuple(r.get(k) for k in ('x', 'y', 'gctype', 'gcquality', 'codedaddress')) if r else None
+
+            f_input =  os.path.join(os.path.dirname(__file__),'support','good_segments.txt')
+
+            with open(f_input) as f:
+                for line in f:
+                    addr = line.strip()
+                    self.assertEquals(key(g1.geocode_address(addr)), key(g2.geocode_address(addr)))
+
+            self.assertTrue(index.is_current(g1.addresses))
+
+            # Changing the database makes the index stale
+            db_path = g1.addresses.database.path
+            stat = os.stat(db_path)
+            os.utime(db_path, (stat.st_atime, stat.st_mtime + 10))
+            try:
+                self.assertFalse(index.is_current(g1.addresses))
+
+                # The dependency isn't resolved, or checked, until it is used
+                g3 = Geocoder(self.bundle.library, index=index.path)
+                self.assertIsNone(g3._addresses)
+
+                with self.assertRaises(ValueError):
+                    g3.addresses
+
+                # Loading rebuilds it
+                index = GeocoderIndex.load(g1.addresses, index.path)
+                self.assertTrue(index.is_current(g1.addresses))
+                self.assertEquals(g1.by_name, Geocoder(self.bundle.library, index=index.path).by_name)
+            finally:
+                os.utime(db_path, (stat.st_atime, stat.st_mtime))
+        finally:
+            shutil.rmtree(d)
+
     def write_error_row(self, code, arg, p, w, address, city):
         
         try: ps = p.parse(address)
@@ -119,7 +119,38 @@ class Test(TestBase):
 
         self.assertTrue(l.database.needs_dump())
       
-      
+
+    def test_rebuild(self):
+        from databundles.library import scan_bundle_files
+
+        l = self.get_library()
+
+        l.put(self.bundle)
+        for partition in self.bundle.partitions:
+            l.put(partition)
+
+        entries = scan_bundle_files([self.bundle.database.path])
+        entry = entries[self.bundle.database.path]
+        self.assertEquals('bundle', entry['type'])
+        self.assertEquals(self.bundle.identity.id_, entry['d_id'])
+        self.assertIsNone(entry['error'])
+
+        bundles = l.rebuild()
+        self.assertEquals([self.bundle.identity.id_], [b.identity.id_ for b in bundles])
+        self.assertEquals(self.bundle.identity.name, l.get(self.bundle.identity.name).identity.name)
+
+        manifest = l.database.rebuild_manifest
+        self.assertEquals([self.bundle.identity.id_],
+                          [ e['d_id'] for e in manifest.values() if e['type'] == 'bundle'])
+
+        # Nothing has changed, so the second rebuild installs nothing
+        bundles = l.rebuild()
+        self.assertEquals([], bundles)
+        self.assertEquals(self.bundle.identity.name, l.get(self.bundle.identity.name).identity.name)
+
+        bundles = l.rebuild(force=True)
+        self.assertEquals(1, len(bundles))
+
     def test_resolve(self):
         """Test the resolve_id() function"""
         from databundles import resolve_id
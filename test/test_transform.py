@@ -54,8 +54,53 @@ class Test(TestBase):
         for row in rows:
             values=[ f(row) for f in processors['all'] ]
             print values
-        
-           
+
+    def test_fixed_width(self):
+        from StringIO import StringIO
+
+        # The 'all' table has widths 3,4,3,4,5,5 for text1 through float
+        table = self.bundle.schema.table('all')
+        reader = table.get_fixed_reader()
+
+        self.assertEquals(['text1','text2','integer1','integer2','integer3','float'], reader.header)
+        self.assertEquals(24, reader.length)
+
+        header, unpack_str, length = table.get_fixed_unpack()
+        self.assertEquals(reader.unpack_str, unpack_str)
+
+        lines = ("abcdefg  1   2    3 6.34\n"+
+                 "hijklmn 10  20   30 1.50\n")
+
+        rows = list(reader.rows(StringIO(lines)))
+
+        self.assertEquals(('abc','defg',1,2,3,6.34), rows[0])
+        self.assertEquals(('hij','klmn',10,20,30,1.5), rows[1])
+
+        # Block reads must produce the same rows, for aligned lines and
+        # for a last line without a line ending.
+        for data in (lines, lines.rstrip('\n')):
+            blocks = list(reader.blocks(StringIO(data), block_rows=1))
+            self.assertEquals(2, len(blocks))
+            brows = [ reader.convert(r) for b in blocks for r in b.tolist() ]
+            self.assertEquals(rows, brows)
+
+            # convert_block() converts the same way as convert()
+            brows = []
+            for b in blocks:
+                cols = reader.convert_block(b)
+                brows.extend(zip(*[ cols[name] for name in reader.header ]))
+            self.assertEquals(rows, brows)
+
+        # Blank numbers are None
+        cols = reader.convert_block(list(reader.blocks(StringIO("abcdefg      2    3 6.34\n")))[0])
+        self.assertEquals([None], cols['integer1'])
+
+        # Lines that are longer or shorter than the layout are errors
+        import struct
+        for data in (lines.replace('6.34\n','6.34   \n'), lines.replace('6.34\n','6.3\n')):
+            self.assertRaises(struct.error, lambda: list(reader.rows(StringIO(data))))
+            self.assertRaises(struct.error, lambda: list(reader.blocks(StringIO(data))))
+
         
 def suite():
     suite = unittest.TestSuite()